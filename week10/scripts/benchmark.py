@@ -0,0 +1,258 @@
+#!/usr/bin/env/python3
+"""Benchmarks for the week10 pipeline
+
+load: compare loading diversity files (and computing mean/std) with the original
+per-file pd.read_csv + column insert and with the bulk loader at several thread counts,
+on synthetic diversity folders of each size
+e.g.
+    python3 benchmark.py load --samples 10 1000 10000 --threads 1 8
+
+select: compare selecting the samples to plot with the original full sort and
+with partial selection, on synthetic cohorts of each size
+e.g.
+    python3 benchmark.py select --samples 1000 1000000 --num-high 2 --num-low 1
+
+Run from the scripts folder (imports pipeline.py).
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import pipeline
+
+DIVERSITY_FILENAME_SUFFIX = ".diversity.txt"
+
+
+def write_diversity_dir(
+    diversity_dir: pathlib.Path, num_samples: int, num_values: int, seed: int = 0
+) -> list:
+    """write a synthetic diversity folder (like the assignment's: 2 decimal values)
+
+    Args:
+        diversity_dir (pathlib.Path): output folder (created)
+        num_samples (int): # diversity files
+        num_values (int): # values per file
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        list: diversity files
+    """
+    rng = np.random.default_rng(seed)
+    diversity_dir.mkdir(parents=True, exist_ok=True)
+    diversity_filenames = []
+    for i in range(num_samples):
+        diversity_filename = pathlib.Path(
+            diversity_dir, f"sample{i}{DIVERSITY_FILENAME_SUFFIX}"
+        )
+        np.savetxt(diversity_filename, rng.gamma(2.0, 5.0, num_values), fmt="%.2f")
+        diversity_filenames.append(diversity_filename)
+    return diversity_filenames
+
+
+def benchmark_load(
+    diversity_filenames: list, threads: list, repeats: int = 1, legacy: bool = True
+) -> dict:
+    """time loading diversity files and computing their mean/std
+
+    The best of several passes is reported to reduce noise.
+
+    Args:
+        diversity_filenames (list): diversity files
+        threads (list): thread counts of the bulk loader
+        repeats (int, optional): number of passes per loader. Defaults to 1.
+        legacy (bool, optional): include the original loader. Defaults to True.
+
+    Returns:
+        dict: {loader: (best time in seconds, files/sec)}
+    """
+    loaders = {}
+    if legacy:
+        loaders["pd.read_csv per file"] = lambda: _legacy_stats(diversity_filenames)
+    for nthreads in threads:
+        loaders[f"bulk ({nthreads} threads)"] = lambda nthreads=nthreads: _bulk_stats(
+            diversity_filenames, nthreads
+        )
+    results = {}
+    for (loader, load) in loaders.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            load()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[loader] = (best, len(diversity_filenames) / best if best else 0.0)
+    return results
+
+
+def benchmark_select(
+    num_samples: int, num_high: int, num_low: int, repeats: int = 3, seed: int = 0
+) -> dict:
+    """time selecting the highest/lowest average samples of a synthetic cohort
+
+    Averages are rounded to 3 decimals (as in the clinical data output), so there are ties.
+    The best of several passes is reported to reduce noise.
+
+    Args:
+        num_samples (int): # samples
+        num_high (int): number of highest averages
+        num_low (int): number of lowest averages
+        repeats (int, optional): number of passes per method. Defaults to 3.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: {method: (best time in seconds, selected code names)}
+    """
+    rng = np.random.default_rng(seed)
+    code_names = [f"sample{i}" for i in range(num_samples)]
+    clinical_data = pd.DataFrame(
+        {
+            "code_name": code_names,
+            "averages": np.round(rng.gamma(2.0, 5.0, num_samples), 3),
+        },
+        index=code_names,
+    )
+    methods = {
+        "full sort": lambda: _legacy_select(clinical_data.copy(), num_high, num_low),
+        "partial selection": lambda: pipeline.get_extreme_diversity_samples(
+            clinical_data, num_high, num_low
+        ),
+    }
+    results = {}
+    for (method, select) in methods.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            selected = select()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[method] = (best, selected)
+    return results
+
+
+def _legacy_select(clinical_data: pd.DataFrame, num_high: int, num_low: int) -> list:
+    """samples to plot as the original get_extreme_diversity_samples selected them"""
+    clinical_data.sort_values("averages", inplace=True, ascending=False)
+    clinical_data_to_plot = pd.concat(
+        [clinical_data.head(num_high), clinical_data.tail(num_low)]
+    )
+    clinical_data_to_plot.drop_duplicates(inplace=True)
+    return list(clinical_data_to_plot.index)
+
+
+def _legacy_stats(diversity_filenames: list) -> tuple:
+    """mean/std as the original generate_diversity_stats computed them"""
+    diversity_data = pd.DataFrame()
+    for diversity_filename in diversity_filenames:
+        code_name = diversity_filename.parts[-1].split(".")[0]
+        diversity_data[code_name] = pd.read_csv(diversity_filename, header=None)
+    return (diversity_data.mean(), diversity_data.std())
+
+
+def _bulk_stats(diversity_filenames: list, threads: int) -> tuple:
+    """mean/std as generate_diversity_stats computes them"""
+    diversity_data = pipeline.load_diversity_files(diversity_filenames, threads)
+    return (diversity_data.mean(axis=1), diversity_data.std(axis=1, ddof=1))
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parses input arguments
+
+    Returns:
+        argparse.Namespace: argument object
+    """
+    parser = argparse.ArgumentParser(description="week10 pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    load_parser = subparsers.add_parser(
+        "load", help="diversity file loading & statistics throughput"
+    )
+    load_parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[10, 1000, 10000],
+        help="# diversity files of each folder (default 10 1000 10000)",
+    )
+    load_parser.add_argument(
+        "--values",
+        type=int,
+        default=1200,
+        help="# values per diversity file (default 1200, as in the assignment)",
+    )
+    load_parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1, 8],
+        help="bulk loader thread counts (default 1 8)",
+    )
+    load_parser.add_argument(
+        "--repeats", type=int, default=1, help="passes per loader (default 1)"
+    )
+    load_parser.add_argument(
+        "--skip-legacy", action="store_true", help="skip the original loader"
+    )
+
+    select_parser = subparsers.add_parser(
+        "select", help="selection of the highest/lowest average samples"
+    )
+    select_parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[1000, 1000000],
+        help="# samples of each cohort (default 1000 1000000)",
+    )
+    select_parser.add_argument(
+        "--num-high", type=int, default=2, help="highest averages (default 2)"
+    )
+    select_parser.add_argument(
+        "--num-low", type=int, default=1, help="lowest averages (default 1)"
+    )
+    select_parser.add_argument(
+        "--repeats", type=int, default=3, help="passes per method (default 3)"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """main"""
+    args = parse_arguments()
+    if args.benchmark == "load":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for num_samples in args.samples:
+                diversity_filenames = write_diversity_dir(
+                    pathlib.Path(tmp_dir, f"samples{num_samples}"),
+                    num_samples,
+                    args.values,
+                )
+                results = benchmark_load(
+                    diversity_filenames,
+                    args.threads,
+                    args.repeats,
+                    legacy=not args.skip_legacy,
+                )
+                for (loader, (elapsed, rate)) in results.items():
+                    print(
+                        f"{num_samples} files, {loader}: {elapsed:.3f}s ({rate:,.0f} files/sec)"
+                    )
+    elif args.benchmark == "select":
+        for num_samples in args.samples:
+            results = benchmark_select(
+                num_samples, args.num_high, args.num_low, args.repeats
+            )
+            for (method, (elapsed, selected)) in results.items():
+                print(f"{num_samples} samples, {method}: {elapsed:.4f}s {selected}")
+    else:
+        sys.exit(f"unknown benchmark {args.benchmark}")
+
+
+if __name__ == "__main__":
+    main()
@@ -25,17 +25,26 @@ outputs:
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import itertools
 import logging
 import matplotlib
 import matplotlib.backends.backend_pdf as backend_pdf
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import pathlib
 import pandas as pd
 import scipy.spatial.distance as sp_distance
 import seaborn as sns
 import sklearn.cluster
 import sys
+import tempfile
+import threading
+import time
 import typing
 
 LOGGER = logging.getLogger(__name__)  # logger for entire module
@@ -56,6 +65,73 @@ class OutputFiles(typing.NamedTuple):
     output_dir: pathlib.Path
 
 
+class ParsedFileCache:
+    """persistent cache of parsed text files as .npy arrays
+
+    Each source file is cached as <md5 of its path>_<size>_<mtime>.npy, so an entry is
+    only used while the source file is unchanged; when it changes, its old entry is replaced
+    (other files' entries are unaffected). Entries are memory-mapped when loaded.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path):
+        """constructor
+
+        Args:
+            cache_dir (pathlib.Path): cache folder (created if missing)
+        """
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def entry(self, source: pathlib.Path) -> pathlib.Path:
+        """cache entry of the current version of a source file
+
+        Args:
+            source (pathlib.Path): source file
+
+        Returns:
+            pathlib.Path: entry path
+        """
+        source = pathlib.Path(source).resolve()
+        stat = source.stat()
+        key = hashlib.md5(str(source).encode()).hexdigest()
+        return pathlib.Path(
+            self.cache_dir, f"{key}_{stat.st_size}_{stat.st_mtime_ns}.npy"
+        )
+
+    def load(
+        self, source: pathlib.Path, parse: typing.Callable[[pathlib.Path], np.ndarray]
+    ) -> np.ndarray:
+        """parsed contents of a source file, from the cache if it is unchanged
+
+        Args:
+            source (pathlib.Path): source file
+            parse (typing.Callable[[pathlib.Path], np.ndarray]): parser used on a miss
+
+        Returns:
+            np.ndarray: parsed array (read-only memory map on a hit)
+        """
+        entry = self.entry(source)
+        if entry.exists():
+            with self._lock:
+                self.hits += 1
+            return np.load(entry, mmap_mode="r")
+
+        array = parse(source)
+        for stale in self.cache_dir.glob(f"{entry.name.split('_')[0]}_*.npy"):
+            stale.unlink(missing_ok=True)
+        (fd, tmp_file) = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_file, entry)
+        with self._lock:
+            self.misses += 1
+        LOGGER.debug(f"cached {source} as {entry}")
+        return array
+
+
 def parse_arguments() -> argparse.Namespace:
     """parse arguments
 
@@ -67,6 +143,10 @@ def parse_arguments() -> argparse.Namespace:
     DEFAULT_NUM_LOW = 1
     DEFAULT_NEW_CLINICAL_DATA = "clinical_data_with_diversity.txt"
     DEFAULT_OUTPUT_DIR = "."
+    DEFAULT_THREADS = 8
+    DEFAULT_WORKERS = 1
+    DEFAULT_CACHE_DIR = None
+    DEFAULT_CHUNK_SIZE = 100000
     LOG_DEFAULT = "pipeline.log"
 
     parser = argparse.ArgumentParser(
@@ -105,6 +185,41 @@ def parse_arguments() -> argparse.Namespace:
         default=DEFAULT_NEW_CLINICAL_DATA,
         help=f"new clinical data file name for output directory (default {DEFAULT_NEW_CLINICAL_DATA})",
     )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default=DEFAULT_THREADS,
+        type=int,
+        help=f"threads reading the diversity files (default {DEFAULT_THREADS})",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=DEFAULT_WORKERS,
+        type=int,
+        help=f"processes rendering the plots (default {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="cache the parsed diversity & distance files in this folder (default: no cache)",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="compute the diversity statistics reading each file in chunks (memory independent of file length; no cache)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=DEFAULT_CHUNK_SIZE,
+        type=int,
+        help=f"values per chunk in streaming mode (default {DEFAULT_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--extra-stats",
+        action="store_true",
+        help="also add min, max and quartiles (q25, q50, q75) to the clinical data (streaming mode)",
+    )
     parser.add_argument(
         "-f", "--force", action="store_true", help="force overwrite of existing output"
     )
@@ -121,6 +236,10 @@ def parse_arguments() -> argparse.Namespace:
         default=LOG_DEFAULT,
     )
     args = parser.parse_args()
+    if args.extra_stats and not args.streaming:
+        parser.error("--extra-stats requires --streaming")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be positive")
 
     #
     # setup log file
@@ -139,6 +258,13 @@ def parse_arguments() -> argparse.Namespace:
     LOGGER.info(f"New clinical data file: {args.clinical_data_output}")
     LOGGER.info(f"Number high average to plot: {args.num_high}")
     LOGGER.info(f"Number low average to plot: {args.num_low}")
+    LOGGER.info(f"Threads: {args.threads}")
+    LOGGER.info(f"Workers: {args.workers}")
+    LOGGER.info(f"Cache directory: {args.cache_dir}")
+    LOGGER.info(f"Streaming statistics: {args.streaming}")
+    if args.streaming:
+        LOGGER.info(f"Chunk size: {args.chunk_size}")
+        LOGGER.info(f"Extra statistics: {args.extra_stats}")
     LOGGER.info(f"Force overwrite: {args.force}")
     LOGGER.info(f"Verbose: {args.verbose}")
     LOGGER.info(f"Log file: {args.logfile}")
@@ -217,12 +343,175 @@ def setup_inputs_outputs(
     return (inputs, outputs)
 
 
+class RunningStats:
+    """streaming statistics of a series of values, updated one chunk at a time
+
+    - mean & variance with Welford's algorithm, merging each chunk's statistics
+      (Chan et al.), so memory does not depend on the number of values
+    - min & max
+    - a quantile sketch: a uniform reservoir sample of up to sample_size values
+      (quantiles are exact while there are no more values than that)
+    """
+
+    def __init__(self, sample_size: int = 10000, seed: int = 0):
+        """constructor
+
+        Args:
+            sample_size (int, optional): quantile sketch size. Defaults to 10000.
+            seed (int, optional): reservoir sampling seed. Defaults to 0.
+        """
+        self.count = 0
+        self.mean = np.nan
+        self._m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+        self._sample = np.empty(sample_size)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray) -> None:
+        """add a chunk of values
+
+        Args:
+            values (np.ndarray): values
+        """
+        count = len(values)
+        if not count:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + count
+        if self.count:
+            delta = mean - self.mean
+            self.mean += delta * count / total
+            self._m2 += m2 + delta**2 * self.count * count / total
+        else:
+            (self.mean, self._m2) = (mean, m2)
+        self.min = np.fmin(self.min, values.min())
+        self.max = np.fmax(self.max, values.max())
+
+        # reservoir sampling: value i replaces a random slot with probability size / (i + 1)
+        size = len(self._sample)
+        fill = min(max(size - self.count, 0), count)
+        self._sample[self.count : self.count + fill] = values[:fill]
+        if fill < count:
+            slots = self._rng.integers(0, np.arange(self.count + fill, total) + 1)
+            keep = slots < size
+            self._sample[slots[keep]] = values[fill:][keep]
+        self.count = total
+
+    @property
+    def std(self) -> float:
+        """sample standard deviation (ddof=1; NaN for fewer than 2 values)"""
+        return np.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+    def quantiles(self, q: typing.Sequence) -> np.ndarray:
+        """estimated quantiles (from the reservoir sample)
+
+        Args:
+            q (typing.Sequence): quantiles (0-1)
+
+        Returns:
+            np.ndarray: quantile values (NaN if there are no values)
+        """
+        sample = self._sample[: min(self.count, len(self._sample))]
+        if not len(sample):
+            return np.full(len(q), np.nan)
+        return np.quantile(sample, q)
+
+
+def load_diversity_files(
+    diversity_filenames: list, threads: int = 1, cache: ParsedFileCache = None
+) -> np.ndarray:
+    """Read diversity files into one array (one row per file)
+
+    Files are read by a thread pool and parsed by NumPy straight into a preallocated array.
+    With a cache, unchanged files are read from their parsed arrays instead.
+
+    Args:
+        diversity_filenames (list): diversity files (single column of values; no header)
+        threads (int, optional): number of reading threads. Defaults to 1.
+        cache (ParsedFileCache, optional): parsed file cache. Defaults to None.
+
+    Raises:
+        ValueError: if the files do not all have the same number of values
+
+    Returns:
+        np.ndarray: (# files x # values) array
+    """
+    if not diversity_filenames:
+        return np.empty((0, 0))
+
+    def parse(diversity_filename: pathlib.Path) -> np.ndarray:
+        return np.loadtxt(diversity_filename, dtype=np.float64, ndmin=1)
+
+    def load(diversity_filename: pathlib.Path) -> np.ndarray:
+        if cache is None:
+            return parse(diversity_filename)
+        return cache.load(diversity_filename, parse)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as executor:
+        values = executor.map(load, diversity_filenames)
+        first = next(values)
+        diversity_data = np.empty((len(diversity_filenames), len(first)))
+        diversity_data[0] = first
+        for (i, (diversity_filename, row)) in enumerate(
+            zip(diversity_filenames[1:], values), start=1
+        ):
+            if len(row) != len(first):
+                raise ValueError(
+                    f"{diversity_filename} has {len(row)} values; expected {len(first)}"
+                )
+            diversity_data[i] = row
+    return diversity_data
+
+
+def streaming_diversity_stats(
+    diversity_filenames: list,
+    threads: int = 1,
+    chunk_size: int = 100000,
+    quantiles: typing.Sequence = (),
+) -> pd.DataFrame:
+    """Compute statistics of each diversity file reading it one chunk of values at a time
+
+    Memory depends on the chunk size, not on the file length (see RunningStats).
+    Files are processed by a thread pool.
+
+    Args:
+        diversity_filenames (list): diversity files (single column of values; no header)
+        threads (int, optional): number of reading threads. Defaults to 1.
+        chunk_size (int, optional): values per chunk. Defaults to 100000.
+        quantiles (typing.Sequence, optional): quantiles to estimate (0-1). Defaults to ().
+
+    Returns:
+        pd.DataFrame: one row per file (in order) with columns mean, std, min, max
+                      and q<percent> for each quantile
+    """
+
+    def file_stats(diversity_filename: pathlib.Path) -> list:
+        stats = RunningStats()
+        with open(diversity_filename) as f:
+            for lines in iter(lambda: list(itertools.islice(f, chunk_size)), []):
+                stats.update(np.loadtxt(lines, dtype=np.float64, ndmin=1))
+        summary = [stats.mean, stats.std, stats.min, stats.max]
+        return summary + list(stats.quantiles(quantiles))
+
+    columns = ["mean", "std", "min", "max"] + [f"q{q * 100:g}" for q in quantiles]
+    with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as executor:
+        rows = list(executor.map(file_stats, diversity_filenames))
+    return pd.DataFrame(rows, columns=columns, dtype=np.float64)
+
+
 def generate_diversity_stats(
     clinical_data_file: pathlib.Path,
     diversity_dir: pathlib.Path,
     clinical_data_output: pathlib.Path,
     output_dir: pathlib.Path = None,
     verbose: bool = False,
+    threads: int = 1,
+    cache: ParsedFileCache = None,
+    streaming: bool = False,
+    chunk_size: int = 100000,
+    extra_stats: bool = False,
 ) -> pd.DataFrame:
     """Generate mean/std dev for each diversity data set and add to clinical data to create a new file
 
@@ -232,6 +521,11 @@ def generate_diversity_stats(
         clinical_data_output (pathlib.Path): output clinical file
         output_dir (pathlib.Path, optional): output for any additional reporting.   Required if verbose=True.   Defaults to None.
         verbose (bool, optional): Write additional logging information. Defaults to False.
+        threads (int, optional): number of threads reading the diversity files. Defaults to 1.
+        cache (ParsedFileCache, optional): parsed file cache. Defaults to None.
+        streaming (bool, optional): compute the statistics one chunk at a time (see streaming_diversity_stats; no cache). Defaults to False.
+        chunk_size (int, optional): values per chunk in streaming mode. Defaults to 100000.
+        extra_stats (bool, optional): also add min, max and quartiles (streaming mode only). Defaults to False.
 
     Returns:
         pd.DataFrame: clinical data plus statistical data as a dataframe
@@ -239,6 +533,8 @@ def generate_diversity_stats(
 
     if verbose and output_dir is None:
         raise ValueError("If verbose is set, you must specify output_dir")
+    if extra_stats and not streaming:
+        raise ValueError("extra_stats requires streaming")
 
     DIVERSITY_FILENAME_SUFFIX = ".diversity.txt"
     CLINICAL_INDEX = "code_name"
@@ -249,21 +545,33 @@ def generate_diversity_stats(
     LOGGER.debug("-- clinical data input --")
     LOGGER.debug(clinical_data)
 
-    # read all the diversity files into a dataframe
+    # read all the diversity files into an array (one row per code name)
     diversity_filenames = [
         f for f in diversity_dir.iterdir() if str(f).endswith(DIVERSITY_FILENAME_SUFFIX)
     ]
     LOGGER.debug(diversity_filenames)
-    diversity_data = pd.DataFrame()
-    for diversity_filename in diversity_filenames:
-        code_name = diversity_filename.parts[-1].split(".")[0]
-        diversity_data[code_name] = pd.read_csv(diversity_filename, header=None)
-    LOGGER.debug("-- diversity data input --")
-    LOGGER.debug(diversity_data)
+    code_names = [f.parts[-1].split(".")[0] for f in diversity_filenames]
+    if streaming:
+        # generate stats one chunk at a time
+        diversity_stats = streaming_diversity_stats(
+            diversity_filenames,
+            threads,
+            chunk_size,
+            quantiles=(0.25, 0.5, 0.75) if extra_stats else (),
+        )
+        diversity_stats.index = code_names
+        LOGGER.debug("-- diversity stats --")
+        LOGGER.debug(diversity_stats)
+        diversity_mean = diversity_stats["mean"].rename(None)
+        diversity_std = diversity_stats["std"].rename(None)
+    else:
+        diversity_data = load_diversity_files(diversity_filenames, threads, cache)
+        LOGGER.debug("-- diversity data input --")
+        LOGGER.debug(diversity_data)
 
-    # generate stats, add to the dataframe & write the result
-    diversity_mean = diversity_data.mean()
-    diversity_std = diversity_data.std()
+        # generate stats (vectorized over all code names)
+        diversity_mean = pd.Series(diversity_data.mean(axis=1), index=code_names)
+        diversity_std = pd.Series(diversity_data.std(axis=1, ddof=1), index=code_names)
 
     LOGGER.debug("-- mean --")
     LOGGER.debug(diversity_mean)
@@ -274,8 +582,12 @@ def generate_diversity_stats(
         diversity_mean.to_csv(pathlib.Path(output_dir, "diversity_mean.csv"))
         diversity_std.to_csv(pathlib.Path(output_dir, "diversity_std.csv"))
 
+    # add to the dataframe & write the result
     clinical_data["averages"] = diversity_mean
     clinical_data["std"] = diversity_std
+    if extra_stats:
+        for column in diversity_stats.columns.drop(["mean", "std"]):
+            clinical_data[column] = diversity_stats[column]
 
     LOGGER.debug("-- clinical data output --")
     LOGGER.debug(clinical_data)
@@ -292,6 +604,10 @@ def get_extreme_diversity_samples(
 ) -> list:
     """Get extreme samples (high/low diversity averages)
 
+    Samples are ranked by descending average, ties in file order (a stable sort);
+    the N highest & M lowest are found by partial selection (O(n)) without sorting
+    or modifying the clinical data. Samples without an average are never selected.
+
     Args:
         clinical_data (pd.DataFrame): full set of clinical data with average diversity score
         num_high (int, optional): number of highest average scores to plot.   Defaults to 2.
@@ -299,14 +615,12 @@ def get_extreme_diversity_samples(
 
     Returns:
         list: sample code names with N highest/M lowest diversity averages
+              (highest first, then lowest, in rank order; each sample once)
     """
-    clinical_data.sort_values("averages", inplace=True, ascending=False)
-    clinical_data_to_plot = pd.concat(
-        [clinical_data.head(num_high), clinical_data.tail(num_low)]
+    positions = _extreme_positions(
+        clinical_data["averages"].to_numpy(dtype=np.float64), num_high, num_low
     )
-    clinical_data_to_plot.drop_duplicates(
-        inplace=True
-    )  # cleanup in case the ranges overlap
+    clinical_data_to_plot = clinical_data.iloc[positions]
 
     LOGGER.debug("-- clinical data to plot --")
     LOGGER.debug(clinical_data_to_plot)
@@ -319,30 +633,58 @@ def generate_plots(
     distance_dir: pathlib.Path,
     output_dir: pathlib.Path,
     verbose: bool = False,
+    cache: ParsedFileCache = None,
+    workers: int = 1,
 ) -> None:
     """Generate all plots as PDFs
 
+    With workers > 1, the samples' PDFs are rendered concurrently by a process pool
+    (each worker with its own non-GUI backend); the PDFs are the same either way.
+    The rendering time of each plot is logged.
+
     Args:
         code_names (list): names of samples to plot
         distance_dir (pathlib.Path): directory of distance data
         output_dir (pathlib.Path): output directory
         verbose (bool, optional): Write additional logging information. Defaults to False.
+        cache (ParsedFileCache, optional): parsed file cache. Defaults to None.
+        workers (int, optional): number of rendering processes. Defaults to 1.
     """
     DISTANCE_FILE_SUFFIX = ".distance.txt"
 
-    for code_name in code_names:
-        LOGGER.info(f"plotting {code_name} ...")
-        distance_file = pathlib.Path(distance_dir, f"{code_name}{DISTANCE_FILE_SUFFIX}")
-        if not distance_file.exists():
-            LOGGER.warning(f"missing distance file: {distance_file} .. skipping plot")
-            continue
-
-        distance_data = pd.read_csv(distance_file, header=None, names=["x", "y"])
-        LOGGER.debug("-- distance data --")
-        LOGGER.debug(distance_data)
+    def plot_inputs() -> typing.Iterator[tuple]:
+        for code_name in code_names:
+            LOGGER.info(f"plotting {code_name} ...")
+            distance_file = pathlib.Path(
+                distance_dir, f"{code_name}{DISTANCE_FILE_SUFFIX}"
+            )
+            if not distance_file.exists():
+                LOGGER.warning(
+                    f"missing distance file: {distance_file} .. skipping plot"
+                )
+                continue
+
+            distance_data = _read_distances(distance_file, cache)
+            LOGGER.debug("-- distance data --")
+            LOGGER.debug(distance_data)
+            yield (code_name, distance_data)
+
+    render = functools.partial(_render_plots, output_dir=output_dir)
+    with contextlib.ExitStack() as stack:
+        if workers > 1 and len(code_names) > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(
+                    min(workers, len(code_names)), initializer=_init_plot_worker
+                )
+            )
+            timings = executor.map(render, plot_inputs())
+        else:
+            timings = map(render, plot_inputs())
 
-        _scatter_plot(code_name, distance_data, output_dir)
-        _kmeans_plots(code_name, distance_data, output_dir)
+        for (code_name, scatter_time, kmeans_time) in timings:
+            LOGGER.info(
+                f"plotted {code_name} in {scatter_time + kmeans_time:.3f}s (scatter {scatter_time:.3f}s, K-means {kmeans_time:.3f}s)"
+            )
 
 
 #
@@ -350,6 +692,85 @@ def generate_plots(
 #
 
 
+def _extreme_positions(values: np.ndarray, num_high: int, num_low: int) -> np.ndarray:
+    """positions of the N highest and M lowest values (see get_extreme_diversity_samples)
+
+    Args:
+        values (np.ndarray): values (NaNs are ignored)
+        num_high (int): number of highest values
+        num_low (int): number of lowest values
+
+    Returns:
+        np.ndarray: positions of the highest values, then of the lowest values not among them,
+                    each in (descending value, position) order
+    """
+    positions = np.flatnonzero(~np.isnan(values))
+    values = values[positions]
+
+    def select(count: int, highest: bool) -> np.ndarray:
+        count = min(max(count, 0), len(values))
+        if not count:
+            return np.empty(0, dtype=np.int64)
+        keys = -values if highest else values
+        threshold = np.partition(keys, count - 1)[count - 1]
+        ties = np.flatnonzero(keys == threshold)
+        need = count - np.count_nonzero(keys < threshold)
+        # ties rank by position: earliest among the highest, latest among the lowest
+        ties = ties[:need] if highest else ties[len(ties) - need :]
+        selected = np.concatenate((np.flatnonzero(keys < threshold), ties))
+        return selected[np.lexsort((selected, -values[selected]))]
+
+    high = select(num_high, highest=True)
+    low = select(num_low, highest=False)
+    low = low[~np.isin(low, high)]
+    return positions[np.concatenate((high, low))]
+
+
+def _read_distances(
+    distance_file: pathlib.Path, cache: ParsedFileCache = None
+) -> pd.DataFrame:
+    """read a distance file (x,y csv; no header)
+
+    Args:
+        distance_file (pathlib.Path): distance file
+        cache (ParsedFileCache, optional): parsed file cache. Defaults to None.
+
+    Returns:
+        pd.DataFrame: distance data (columns x, y)
+    """
+
+    def parse(source: pathlib.Path) -> np.ndarray:
+        return pd.read_csv(source, header=None, names=["x", "y"]).to_numpy()
+
+    if cache is None:
+        return pd.read_csv(distance_file, header=None, names=["x", "y"])
+    return pd.DataFrame(np.array(cache.load(distance_file, parse)), columns=["x", "y"])
+
+
+def _init_plot_worker() -> None:
+    """plot worker process initializer: use a non-GUI backend"""
+    matplotlib.use("pdf")
+
+
+def _render_plots(plot_input: tuple, output_dir: pathlib.Path) -> tuple:
+    """render the scatter & K-means PDFs of a sample (see generate_plots)
+
+    Args:
+        plot_input (tuple): (code name, distance data)
+        output_dir (pathlib.Path): output directory
+
+    Returns:
+        tuple: (code name, scatter plot seconds, K-means plots seconds)
+    """
+    (code_name, distance_data) = plot_input
+    start = time.perf_counter()
+    _scatter_plot(code_name, distance_data, output_dir)
+    scatter_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _kmeans_plots(code_name, distance_data, output_dir)
+    return (code_name, scatter_time, time.perf_counter() - start)
+
+
 def _scatter_plot(
     code_name: str, distance_data: pd.DataFrame, output_dir: pathlib.Path
 ) -> None:
@@ -497,6 +918,7 @@ def main():
         args.clinical_data_output,
         args.force,
     )
+    cache = None if args.cache_dir is None else ParsedFileCache(args.cache_dir)
     LOGGER.info("-- Generate Diversity Statistics --")
     clinical_data = generate_diversity_stats(
         inputs.clinical_file,
@@ -504,13 +926,27 @@ def main():
         outputs.clinical_file,
         outputs.output_dir,
         args.verbose,
+        args.threads,
+        cache,
+        args.streaming,
+        args.chunk_size,
+        args.extra_stats,
     )
     LOGGER.info("-- Get clinical samples to plot --")
     code_names = get_extreme_diversity_samples(
         clinical_data, args.num_low, args.num_high
     )
     LOGGER.info("-- Generate plots --")
-    generate_plots(code_names, inputs.distances_dir, outputs.output_dir, args.verbose)
+    generate_plots(
+        code_names,
+        inputs.distances_dir,
+        outputs.output_dir,
+        args.verbose,
+        cache,
+        args.workers,
+    )
+    if cache is not None:
+        LOGGER.info(f"Parsed file cache: {cache.hits} hits, {cache.misses} misses")
     LOGGER.info("-- DONE --")
 
 
@@ -0,0 +1,755 @@
+#!/usr/bin/env/python3
+"""Benchmarks for the week6 pipeline
+
+parse: compare fastq parsing throughput (records/sec) of the original
+line-based ParseFastQ parser and the block-based FastqReader
+e.g.
+    python3 benchmark.py parse ../data/assignment/hawkins_pooled_sequences.fastq.gz
+
+compression: read throughput of a gzipped fastq with and without background
+decompression, and compression throughput & disk footprint of the trimmed fastq
+output for each compression and level
+e.g.
+    python3 benchmark.py compression ../data/assignment/hawkins_pooled_sequences.fastq.gz --levels 1 6 9
+
+generate: write a synthetic dataset (reference, sample file, pooled fastq and the
+injected SNPs) with N samples, M reads, a read length and a quality profile
+e.g.
+    python3 benchmark.py generate synthetic --samples 20 --reads 100000 --read-length 250
+
+stages: time each pipeline stage (parse, demultiplex/trim, index, align, convert,
+pileup, report) on synthetic datasets over a sweep of sample and read counts,
+and save the results (with the git commit) as JSON
+e.g.
+    python3 benchmark.py stages --samples 10 50 --reads 10000 100000 --output before.json
+
+compare: compare the stage timings of two stages results, e.g. of two commits
+e.g.
+    python3 benchmark.py compare before.json after.json
+
+Run from the scripts folder (imports pipeline.py).
+"""
+
+import argparse
+import datetime
+import gzip
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import pipeline
+
+STAGES = ("parse", "demultiplex", "index", "align", "convert", "pileup", "report")
+QUALITY_PROFILES = ("tail", "decay")
+COLORS = ("Black", "Orange", "Green", "Yellow", "Mauve", "Blue", "Red", "White")
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+HIGH_QUALITY = 40  # I
+GENERATE_CHUNK_READS = 100_000
+MIN_COMPARE_TIME = 0.01  # seconds; shorter stages are too noisy to flag
+
+
+def benchmark_parse(fastq_file: str, repeats: int = 3) -> dict:
+    """time a full pass of each fastq parser over a file
+
+    The best of several passes is reported to reduce noise.
+
+    Args:
+        fastq_file (str): fastq (or fastq.gz) path
+        repeats (int, optional): number of passes per parser. Defaults to 3.
+
+    Returns:
+        dict: {parser name: (# records, best time in seconds, records/sec)}
+    """
+    parsers = {
+        "ParseFastQ": lambda: pipeline.ParseFastQ(fastq_file),
+        "FastqReader": lambda: pipeline.FastqReader(fastq_file),
+    }
+    results = {}
+    for (parser_name, parser_factory) in parsers.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            nrecords = sum(1 for _ in parser_factory())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[parser_name] = (nrecords, best, nrecords / best if best else 0.0)
+    return results
+
+
+def benchmark_read(fastq_file: str, repeats: int = 3) -> dict:
+    """time reading (and parsing) a fastq with inline and background decompression
+
+    Args:
+        fastq_file (str): fastq (or fastq.gz) path
+        repeats (int, optional): number of passes per mode. Defaults to 3.
+
+    Returns:
+        dict: {mode: (# records, best time in seconds, records/sec)}
+    """
+    modes = {
+        "inline decompression": 0,
+        "background decompression": pipeline.FASTQ_PREFETCH_BLOCKS,
+    }
+    results = {}
+    for (mode, prefetch) in modes.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            nrecords = sum(
+                len(batch)
+                for batch in pipeline.FastqReader(
+                    fastq_file, prefetch=prefetch
+                ).batches()
+            )
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[mode] = (nrecords, best, nrecords / best if best else 0.0)
+    return results
+
+
+def benchmark_compression(fastq_file: str, levels: list, repeats: int = 1) -> dict:
+    """time compressing a fastq as the demultiplexing does (chunk by chunk)
+
+    Args:
+        fastq_file (str): fastq (or fastq.gz) path
+        levels (list): compression levels
+        repeats (int, optional): number of passes per setting. Defaults to 1.
+
+    Returns:
+        dict: {(compression, level): (input bytes, output bytes, best time in seconds)}
+    """
+    chunks = [chunk for (_, chunk) in pipeline.FastqReader(fastq_file).chunks()]
+    nbytes = sum(len(chunk) for chunk in chunks)
+    results = {("none", None): (nbytes, nbytes, 0.0)}
+    for compression in pipeline.FASTQ_COMPRESSIONS[1:]:
+        for level in levels:
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                compressed = sum(
+                    len(pipeline.compress_fastq(chunk, compression, level))
+                    for chunk in chunks
+                )
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if compression == "bgzf":
+                compressed += len(pipeline.BGZF_EOF)
+            results[(compression, level)] = (nbytes, compressed, best)
+    return results
+
+
+def generate_dataset(
+    out_dir: str,
+    n_samples: int,
+    n_reads: int,
+    read_length: int = 250,
+    reference: str = None,
+    reference_length: int = 217,
+    quality_profile: str = "tail",
+    snp_fraction: float = 0.5,
+    error_rate: float = 0.0,
+    barcode_length: int = 5,
+    seed: int = 0,
+    compress: bool = False,
+) -> dict:
+    """write a synthetic pooled sequencing dataset like the assignment's
+
+    - reference: the given fasta (first contig), or random bases
+    - samples: Sample<i> with unique random barcodes; colors are assigned round-robin
+    - each color has one SNP (position & mutation base) and every read of one of its
+      samples covering the position carries the mutation with probability snp_fraction
+    - reads: barcode + reference bases from a random start (bases past the end of a
+      short reference are random), with substitution errors at error_rate
+    - quality profiles:
+        tail: I (Phred 40) with a tail of D/F scores over the last few bases
+              (covering any bases past the end of the reference), like the assignment data
+        decay: Phred scores with a mean falling from 38 to 18 along the read
+
+    Args:
+        out_dir (str): output folder (created)
+        n_samples (int): # samples
+        n_reads (int): # reads
+        read_length (int, optional): read length (without the barcode). Defaults to 250.
+        reference (str, optional): reference fasta to use. Defaults to None (random).
+        reference_length (int, optional): random reference length. Defaults to 217.
+        quality_profile (str, optional): tail or decay. Defaults to "tail".
+        snp_fraction (float, optional): fraction of reads carrying their sample's SNP. Defaults to 0.5.
+        error_rate (float, optional): per-base substitution rate. Defaults to 0.0.
+        barcode_length (int, optional): barcode length. Defaults to 5.
+        seed (int, optional): random seed. Defaults to 0.
+        compress (bool, optional): gzip the pooled fastq. Defaults to False.
+
+    Raises:
+        ValueError: if there are more samples than barcodes or colors than reference positions
+
+    Returns:
+        dict: paths (fastq, samples, reference) and snps: {color: (1-based position, wildtype, mutation)}
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    if n_samples > 4 ** barcode_length:
+        raise ValueError(
+            f"{n_samples} samples need barcodes longer than {barcode_length}"
+        )
+
+    # reference
+    if reference is None:
+        ref = BASES[rng.integers(0, 4, reference_length)]
+        contig = "synthetic"
+    else:
+        with pipeline.ReferenceFasta(reference) as reference_fasta:
+            contig = reference_fasta.contigs[0]
+            ref = np.frombuffer(
+                reference_fasta.sequence(
+                    contig, 0, reference_fasta.length(contig)
+                ).encode(),
+                dtype=np.uint8,
+            )
+    reference_file = os.path.join(out_dir, "reference.fa")
+    with open(reference_file, "w") as f:
+        f.write(f">{contig}\n{ref.tobytes().decode()}\n")
+
+    # samples, colors & SNPs
+    colors = [
+        COLORS[i] if i < len(COLORS) else f"Color{i}"
+        for i in range(min(n_samples, len(ref)))
+    ]
+    barcode_ids = rng.choice(4 ** barcode_length, n_samples, replace=False)
+    barcodes = BASES[(barcode_ids[:, None] // 4 ** np.arange(barcode_length)[::-1]) % 4]
+    names = [f"Sample{i}" for i in range(n_samples)]
+    sample_color = np.arange(n_samples) % len(colors)
+    samples_file = os.path.join(out_dir, "samples.txt")
+    with open(samples_file, "w") as f:
+        f.write("Name\tColor\tBarcode\n")
+        for (name, color, barcode) in zip(names, sample_color, barcodes):
+            f.write(f"{name}\t{colors[color]}\t{barcode.tobytes().decode()}\n")
+    snp_positions = rng.choice(len(ref), len(colors), replace=False)
+    snp_mutations = np.array(
+        [rng.choice(BASES[BASES != ref[position]]) for position in snp_positions],
+        dtype=np.uint8,
+    )
+    snps = {
+        color: (int(position) + 1, chr(ref[position]), chr(mutation))
+        for (color, position, mutation) in zip(colors, snp_positions, snp_mutations)
+    }
+
+    # reads
+    fastq_file = os.path.join(out_dir, "pooled.fastq" + (".gz" if compress else ""))
+    span = min(read_length, len(ref))
+    with (gzip.open if compress else open)(fastq_file, "wb") as f:
+        for first in range(0, n_reads, GENERATE_CHUNK_READS):
+            n = min(GENERATE_CHUNK_READS, n_reads - first)
+            sample = rng.integers(0, n_samples, n)
+            starts = rng.integers(0, len(ref) - span + 1, n)
+            seqs = BASES[rng.integers(0, 4, (n, read_length))]
+            seqs[:, :span] = ref[starts[:, None] + np.arange(span)]
+
+            # SNPs of each read's color
+            offsets = snp_positions[sample_color[sample]] - starts
+            carriers = np.flatnonzero(
+                (offsets >= 0) & (offsets < span) & (rng.random(n) < snp_fraction)
+            )
+            seqs[carriers, offsets[carriers]] = snp_mutations[
+                sample_color[sample[carriers]]
+            ]
+
+            # sequencing errors
+            errors = rng.random((n, read_length)) < error_rate
+            seqs[errors] = BASES[rng.integers(0, 4, np.count_nonzero(errors))]
+
+            quals = _quality_scores(rng, n, read_length, span, quality_profile)
+            records = np.hstack((barcodes[sample], seqs))
+            qualities = np.hstack(
+                (np.full((n, barcode_length), HIGH_QUALITY, dtype=np.uint8), quals)
+            )
+            qualities += pipeline.PHRED_OFFSET
+            f.write(
+                b"".join(
+                    b"@read%d\n%s\n+\n%s\n"
+                    % (first + i, record.tobytes(), quality.tobytes())
+                    for (i, (record, quality)) in enumerate(zip(records, qualities))
+                )
+            )
+
+    with open(os.path.join(out_dir, "snps.json"), "w") as f:
+        json.dump(snps, f, indent=1)
+    return {
+        "fastq": fastq_file,
+        "samples": samples_file,
+        "reference": reference_file,
+        "snps": snps,
+    }
+
+
+def _quality_scores(
+    rng: np.random.Generator, n: int, read_length: int, span: int, profile: str
+) -> np.ndarray:
+    """Phred quality scores of synthetic reads (see generate_dataset)
+
+    Args:
+        rng (np.random.Generator): random generator
+        n (int): # reads
+        read_length (int): read length
+        span (int): # reference bases in each read
+        profile (str): tail or decay
+
+    Returns:
+        np.ndarray: (n x read_length) scores
+    """
+    if profile == "decay":
+        mean = np.linspace(38, 18, read_length)
+        scores = np.rint(rng.normal(mean, 3, (n, read_length)))
+        return np.clip(scores, 2, 41).astype(np.uint8)
+    # D (35) / F (37) tail starting within the last 5% of the reference bases
+    scores = np.full((n, read_length), HIGH_QUALITY, dtype=np.uint8)
+    tail_starts = span - rng.integers(0, max(1, span // 20), n)
+    tail = np.arange(read_length) >= tail_starts[:, None]
+    scores[tail] = rng.choice(
+        np.array([35, 37], dtype=np.uint8), np.count_nonzero(tail)
+    )
+    return scores
+
+
+def benchmark_stages(
+    dataset: dict,
+    work_dir: str,
+    repeats: int = 1,
+    workers: int = 1,
+    threads: int = 1,
+) -> dict:
+    """time each pipeline stage on a dataset (best of several runs)
+
+    Stages: parse (FastqReader pass), demultiplex (create_fastqs: demultiplex & trim),
+    index (bwa index), align (align_reads), convert (sam_to_bam),
+    pileup (call_variants) and report (generate_report).
+
+    Args:
+        dataset (dict): dataset (see generate_dataset)
+        work_dir (str): folder for the outputs of each run
+        repeats (int, optional): # runs. Defaults to 1.
+        workers (int, optional): worker processes (demultiplex, pileup). Defaults to 1.
+        threads (int, optional): alignment & conversion threads. Defaults to 1.
+
+    Returns:
+        dict: {"stages": {stage: {"wall_time", "cpu_time"[, "reads_per_sec"]}},
+               "snps_found": # colors whose SNP was reported}
+    """
+    samples = pipeline.SampleFile(dataset["samples"])
+    best = {}
+    for repeat in range(repeats):
+        run_dir = os.path.join(work_dir, f"run{repeat}")
+        fastqs_dir = os.path.join(run_dir, "fastqs")
+        bams_dir = os.path.join(run_dir, "bams")
+        reference = os.path.join(run_dir, os.path.basename(dataset["reference"]))
+        os.makedirs(run_dir)
+        with open(dataset["reference"]) as src, open(reference, "w") as dst:
+            dst.write(src.read())
+
+        stages = {
+            "parse": lambda: sum(
+                len(batch) for batch in pipeline.FastqReader(dataset["fastq"]).batches()
+            ),
+            "demultiplex": lambda: pipeline.create_fastqs(
+                samples, dataset["fastq"], fastqs_dir, workers=workers
+            ),
+            "index": lambda: subprocess.run(
+                ["bwa", "index", reference], check=True, capture_output=True
+            ),
+            "align": lambda: pipeline.align_reads(
+                reference, fastqs_dir, bams_dir, threads=threads
+            ),
+            "convert": lambda: pipeline.sam_to_bam(bams_dir, threads=threads),
+            "pileup": lambda: pipeline.call_variants(
+                bams_dir, reference, workers=workers
+            ),
+            "report": lambda: pipeline.generate_report(
+                variants, samples, os.path.join(run_dir, "report.txt")
+            ),
+        }
+        for (stage, run) in stages.items():
+            start_wall = time.perf_counter()
+            start_cpu = _cpu_time()
+            result = run()
+            timing = {
+                "wall_time": time.perf_counter() - start_wall,
+                "cpu_time": _cpu_time() - start_cpu,
+            }
+            if stage == "parse":
+                nreads = result
+            elif stage == "pileup":
+                variants = result
+            if stage not in best or timing["wall_time"] < best[stage]["wall_time"]:
+                best[stage] = timing
+
+    for timing in best.values():
+        if timing["wall_time"] > 0:
+            timing["reads_per_sec"] = round(nreads / timing["wall_time"])
+        timing["wall_time"] = round(timing["wall_time"], 4)
+        timing["cpu_time"] = round(timing["cpu_time"], 4)
+
+    # SNPs reported by at least one sample of their color
+    found = {
+        color
+        for (name, name_variants) in variants.items()
+        for variant in name_variants
+        for color in [samples.name_color[name]]
+        if (variant.position, variant.wildtype, variant.mutation)
+        == tuple(dataset["snps"][color])
+    }
+    return {"stages": best, "snps_found": len(found)}
+
+
+def benchmark_sweep(
+    samples_counts: list,
+    read_counts: list,
+    generate_options: dict,
+    repeats: int = 1,
+    workers: int = 1,
+    threads: int = 1,
+    data_dir: str = None,
+) -> list:
+    """time the pipeline stages over every combination of sample and read counts
+
+    Args:
+        samples_counts (list): # samples of each dataset
+        read_counts (list): # reads of each dataset
+        generate_options (dict): other generate_dataset arguments
+        repeats (int, optional): runs per dataset. Defaults to 1.
+        workers (int, optional): worker processes. Defaults to 1.
+        threads (int, optional): alignment & conversion threads. Defaults to 1.
+        data_dir (str, optional): folder to keep the datasets & outputs in. Defaults to None (temporary).
+
+    Returns:
+        list: one result per dataset (parameters, stage timings & SNPs found)
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_dir = data_dir or tmp_dir
+        for (n_samples, n_reads) in itertools.product(samples_counts, read_counts):
+            dataset_dir = os.path.join(base_dir, f"samples{n_samples}_reads{n_reads}")
+            dataset = generate_dataset(
+                os.path.join(dataset_dir, "data"),
+                n_samples,
+                n_reads,
+                **generate_options,
+            )
+            result = benchmark_stages(
+                dataset,
+                os.path.join(dataset_dir, "runs"),
+                repeats=repeats,
+                workers=workers,
+                threads=threads,
+            )
+            results.append(
+                dict(
+                    samples=n_samples,
+                    reads=n_reads,
+                    snps=len(dataset["snps"]),
+                    **result,
+                )
+            )
+            _print_stages(results[-1])
+    return results
+
+
+def compare_results(old: dict, new: dict, threshold: float = 1.2) -> list:
+    """compare the stage wall times of two stages results (matched by # samples & reads)
+
+    Stages shorter than MIN_COMPARE_TIME in the new results are never regressions.
+
+    Args:
+        old (dict): baseline results (see main)
+        new (dict): new results
+        threshold (float, optional): new/old wall time ratio counted as a regression. Defaults to 1.2.
+
+    Returns:
+        list: tuples (samples, reads, stage, old time, new time, ratio, regression)
+    """
+    old_results = {(r["samples"], r["reads"]): r for r in old["results"]}
+    comparisons = []
+    for result in new["results"]:
+        key = (result["samples"], result["reads"])
+        if key not in old_results:
+            continue
+        for stage in STAGES:
+            old_time = old_results[key]["stages"].get(stage, {}).get("wall_time")
+            new_time = result["stages"].get(stage, {}).get("wall_time")
+            if not old_time or new_time is None:
+                continue
+            ratio = new_time / old_time
+            regression = ratio > threshold and new_time >= MIN_COMPARE_TIME
+            comparisons.append((*key, stage, old_time, new_time, ratio, regression))
+    return comparisons
+
+
+def _generate_options(args: argparse.Namespace) -> dict:
+    """generate_dataset arguments from the command line options"""
+    return dict(
+        read_length=args.read_length,
+        reference=args.reference,
+        reference_length=args.reference_length,
+        quality_profile=args.quality_profile,
+        snp_fraction=args.snp_fraction,
+        error_rate=args.error_rate,
+        barcode_length=args.barcode_length,
+        seed=args.seed,
+    )
+
+
+def _cpu_time() -> float:
+    """user + system CPU seconds of this process and its waited-for children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _git_commit() -> str:
+    """current git commit of the scripts folder (None outside a git checkout)"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_stages(result: dict) -> None:
+    """print the stage timings of one dataset"""
+    print(
+        f"{result['samples']} samples, {result['reads']:,} reads: {result['snps_found']}/{result['snps']} SNPs found"
+    )
+    for (stage, timing) in result["stages"].items():
+        rate = timing.get("reads_per_sec", 0)
+        print(
+            f"  {stage}: {timing['wall_time']:.3f}s wall, {timing['cpu_time']:.3f}s CPU ({rate:,} reads/sec)"
+        )
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parses input arguments
+
+    Returns:
+        argparse.Namespace: argument object
+    """
+    parser = argparse.ArgumentParser(description="week6 pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parse_parser = subparsers.add_parser("parse", help="fastq parser throughput")
+    parse_parser.add_argument("fastq", help="fastq (or fastq.gz) to parse")
+    parse_parser.add_argument(
+        "--repeats", type=int, default=3, help="passes per parser (default 3)"
+    )
+
+    compression_parser = subparsers.add_parser(
+        "compression", help="decompression and compressed output throughput"
+    )
+    compression_parser.add_argument("fastq", help="fastq (or fastq.gz) to read")
+    compression_parser.add_argument(
+        "--levels",
+        type=int,
+        nargs="+",
+        default=[1, 6, 9],
+        help="compression levels (default 1 6 9)",
+    )
+    compression_parser.add_argument(
+        "--repeats", type=int, default=1, help="passes per setting (default 1)"
+    )
+
+    generate_parser = subparsers.add_parser(
+        "generate", help="write a synthetic pooled dataset"
+    )
+    generate_parser.add_argument("out_dir", help="output folder")
+    generate_parser.add_argument(
+        "--samples", type=int, default=10, help="# samples (default 10)"
+    )
+    generate_parser.add_argument(
+        "--reads", type=int, default=10000, help="# reads (default 10000)"
+    )
+    generate_parser.add_argument(
+        "--gzip", action="store_true", help="gzip the pooled fastq"
+    )
+    _add_generate_arguments(generate_parser)
+
+    stages_parser = subparsers.add_parser(
+        "stages", help="pipeline stage timings over synthetic datasets"
+    )
+    stages_parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[10],
+        help="# samples of each dataset (default 10)",
+    )
+    stages_parser.add_argument(
+        "--reads",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="# reads of each dataset (default 1000 10000)",
+    )
+    stages_parser.add_argument(
+        "--repeats", type=int, default=1, help="runs per dataset (default 1)"
+    )
+    stages_parser.add_argument(
+        "--workers", type=int, default=1, help="worker processes (default 1)"
+    )
+    stages_parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="alignment & conversion threads (default 1)",
+    )
+    stages_parser.add_argument(
+        "--data-dir", help="keep the datasets & outputs in this folder"
+    )
+    stages_parser.add_argument(
+        "--output",
+        default="benchmark.json",
+        help="results file (default benchmark.json)",
+    )
+    _add_generate_arguments(stages_parser)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two stages results")
+    compare_parser.add_argument("old", help="baseline results (json)")
+    compare_parser.add_argument("new", help="new results (json)")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="new/old wall time ratio counted as a regression (default 1.2)",
+    )
+
+    return parser.parse_args()
+
+
+def _add_generate_arguments(parser: argparse.ArgumentParser) -> None:
+    """add the synthetic dataset options (see generate_dataset)"""
+    parser.add_argument(
+        "--read-length", type=int, default=250, help="read length (default 250)"
+    )
+    parser.add_argument("--reference", help="reference fasta (default: random bases)")
+    parser.add_argument(
+        "--reference-length",
+        type=int,
+        default=217,
+        help="random reference length (default 217)",
+    )
+    parser.add_argument(
+        "--quality-profile",
+        choices=QUALITY_PROFILES,
+        default="tail",
+        help="tail: D/F tail; decay: falling scores (default tail)",
+    )
+    parser.add_argument(
+        "--snp-fraction",
+        type=pipeline._parse_fraction,
+        default=0.5,
+        help="fraction of reads carrying their sample's SNP (default 0.5)",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=pipeline._parse_fraction,
+        default=0.0,
+        help="per-base substitution rate (default 0)",
+    )
+    parser.add_argument(
+        "--barcode-length", type=int, default=5, help="barcode length (default 5)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+
+
+def main():
+    """main"""
+    args = parse_arguments()
+    if args.benchmark == "parse":
+        results = benchmark_parse(args.fastq, args.repeats)
+        baseline = results["ParseFastQ"][2]
+        for (parser_name, (nrecords, elapsed, rate)) in results.items():
+            speedup = rate / baseline if baseline else 0.0
+            print(
+                f"{parser_name}: {nrecords} records in {elapsed:.3f}s ({rate:,.0f} records/sec; {speedup:.1f}x)"
+            )
+    elif args.benchmark == "compression":
+        for (mode, (nrecords, elapsed, rate)) in benchmark_read(
+            args.fastq, args.repeats
+        ).items():
+            print(
+                f"read, {mode}: {nrecords} records in {elapsed:.3f}s ({rate:,.0f} records/sec)"
+            )
+        results = benchmark_compression(args.fastq, args.levels, args.repeats)
+        for ((compression, level), (nbytes, compressed, elapsed)) in results.items():
+            if compression == "none":
+                print(f"none: {compressed:,} bytes")
+                continue
+            rate = nbytes / elapsed / 1e6 if elapsed else 0.0
+            print(
+                f"{compression} (level {level}): {compressed:,} bytes ({compressed / nbytes:.1%}) in {elapsed:.3f}s ({rate:,.1f} MB/s)"
+            )
+    elif args.benchmark == "generate":
+        dataset = generate_dataset(
+            args.out_dir,
+            args.samples,
+            args.reads,
+            compress=args.gzip,
+            **_generate_options(args),
+        )
+        for (color, (position, wildtype, mutation)) in dataset["snps"].items():
+            print(f"{color}: {wildtype}{position}{mutation}")
+    elif args.benchmark == "stages":
+        results = benchmark_sweep(
+            args.samples,
+            args.reads,
+            _generate_options(args),
+            repeats=args.repeats,
+            workers=args.workers,
+            threads=args.threads,
+            data_dir=args.data_dir,
+        )
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": _git_commit(),
+                    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "cpus": os.cpu_count(),
+                    "parameters": dict(
+                        repeats=args.repeats,
+                        workers=args.workers,
+                        threads=args.threads,
+                        **_generate_options(args),
+                    ),
+                    "results": results,
+                },
+                f,
+                indent=1,
+            )
+    elif args.benchmark == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        print(f"{old.get('commit')} -> {new.get('commit')}")
+        comparisons = compare_results(old, new, args.threshold)
+        for (samples, reads, stage, old_time, new_time, ratio, regression) in comparisons:
+            flag = " REGRESSION" if regression else ""
+            print(
+                f"{samples} samples, {reads:,} reads, {stage}: {old_time:.3f}s -> {new_time:.3f}s ({ratio:.2f}x){flag}"
+            )
+        if any(comparison[-1] for comparison in comparisons):
+            sys.exit(1)
+    else:
+        sys.exit(f"unknown benchmark {args.benchmark}")
+
+
+if __name__ == "__main__":
+    main()
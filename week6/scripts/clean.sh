@@ -5,6 +5,7 @@ rm -f ../data/${NAME}/*.fa.*
 rm -rf ../analysis/${NAME}/bams
 rm -rf ../analysis/${NAME}/fastqs
 rm -f ../analysis/${NAME}/report.txt
+rm -f ../analysis/${NAME}/metrics.json
 rm -f ../analysis/md5sum_${NAME}_fastqs.txt
 rm -f ${NAME}.out
 
@@ -4,4 +4,6 @@
 ./clean.sh test
 ./clean.sh tiny0vartest
 ./clean.sh tiny2vartest
+rm -rf ../analysis/batch
+rm -f ../analysis/md5sum_batch_*_fastqs.txt
 rm -f pipeline.log
\ No newline at end of file
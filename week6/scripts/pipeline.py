@@ -6,7 +6,7 @@ Given a fastq file, reference fasta and a sample file:
 Part 1: for each entry in the fastq file:
 (1) assign each barcode to a sample
 (2) trim the barcode
-(3) trim the reads starting wth the first occurrence of consecutive D and/or F scores
+(3) trim the reads starting wth the first occurrence of consecutive D and/or F scores (or of scores below --min-quality)
 (4) Write the trimmed read to a fastq file (by sample name) to a fastqs output folder
 
 Part 2: Align each fastq to the reference usng bwa
@@ -18,6 +18,7 @@ Part 3: convert each SAM to BAM
 (1) within the bam folder, convert SAM to BAM
 (2) sort the BAM
 (3) remove the SAM and unsorted BAM files
+(with --stream, parts 2 and 3 are combined: alignments are piped straight into sorted BAMs)
 
 Part 4: identify mutations using pysam
 (1) Report all SNPs
@@ -41,24 +42,71 @@ outputs:
 (1) folder of fastqs
 (2) folder of sorted bam files
 (3) report (text file)
+
+batch mode (--batch): a batch file lists several (fastq, sample file, reference) runs,
+which are processed together with per-run outputs and a combined summary
 """
 
 import argparse
 import collections
+import concurrent.futures
+import contextlib
 import csv
+import fcntl
+import functools
 import gzip
+import hashlib
+import itertools
+import json
 import logging
+import numpy as np
 import os
 import pysam
 import pathlib
+import queue
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import typing
+import zlib
 
 TRIMMED_FASTQ = "_trimmed.fastq"
+TRIMMED_FASTQ_GZ = TRIMMED_FASTQ + ".gz"
 SORTED_BAM = "_sorted.bam"
+PILEUP_BASES = "ACGT"  # row order of base count arrays (see count_bases)
+MIN_BASE_QUALITY = 13  # minimum base quality counted in a pileup
+SKIPPED_READ_FLAGS = 0x704  # unmapped, secondary, QC-fail, duplicate
+ALIGNED_OPS = (pysam.CMATCH, pysam.CEQUAL, pysam.CDIFF)  # CIGAR M/=/X
+INDEL_OPS = (pysam.CINS, pysam.CDEL)
+FASTQ_BUFFER_SIZE = 1024 * 1024  # per-sample write buffer (bytes)
+MAX_OPEN_FASTQS = 256  # cap on simultaneously open per-sample fastqs
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024  # fastq read block size (bytes)
+METRICS_FILE = "metrics.json"
+TOP_UNASSIGNED_BARCODES = 10  # most frequent unassigned barcodes reported
+FASTQ_PREFETCH_BLOCKS = 4  # blocks decompressed ahead by the background thread
+# trimmed fastq output compression (see compress_fastq)
+FASTQ_COMPRESSIONS = ("none", "gzip", "bgzf")
+COMPRESS_LEVEL = 6
+BGZF_BLOCK_SIZE = 0xFF00  # uncompressed bytes per BGZF block (as htslib)
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# samtools sort -m (bytes per thread) without a memory budget, and the limits
+# for sort memory sized from a budget
+SORT_MEMORY = 100 * 1024 * 1024
+SORT_MEMORY_MIN = 16 * 1024 * 1024
+SORT_MEMORY_MAX = 1024 * 1024 * 1024
+# bwa mem -K: fixed batch size so output does not depend on -t
+BWA_BATCH_BASES = 10000000
+BWA_INDEX_EXTENSIONS = (".amb", ".ann", ".bwt", ".pac", ".sa")
+INDEX_CACHE_ENTRIES = 8  # default max # of cached bwa indexes
 LOGGER = logging.getLogger(__name__) # logger for entire module
+# trim starting at consecutive D/F quality scores (unless a Phred threshold is given)
+LOW_QUALITY_SCORES = b"DF"
+PHRED_OFFSET = 33
+# per-process state for demultiplexing (see _init_demultiplex_worker)
+_DEMULTIPLEX_STATE = {}
 
 #
 # class & exception definitions
@@ -71,18 +119,25 @@ class SampleFile:
     SAMPLE_HEADER_NAME = "Name"
     SAMPLE_HEADER_COLOR = "Color"
     SAMPLE_HEADER_BC = "Barcode"
+    BC_ALPHABET = "ACGTN"  # substitutions considered for barcode neighbors
 
-    def __init__(self, sample_file):
+    def __init__(self, sample_file, max_mismatches: int = 0):
         """constructor
 
         Parses the file and saves some fields about the data.
         Assumes the file isn't very big.
 
+        With max_mismatches > 0, every barcode within max_mismatches substitutions
+        of a sample barcode is precomputed into a single lookup table (see bc_lookup),
+        so a read barcode is still matched with one dict lookup.
+
         Args:
             sample_file (str): sample file path
+            max_mismatches (int, optional): barcode substitutions to tolerate. Defaults to 0.
 
         Raises:
             BCLengthException: if there is more than 1 barcode length
+            ValueError: if max_mismatches is negative or not less than the barcode length
         """
         self._bc_name = {}
         self._name_color = {}
@@ -111,6 +166,57 @@ class SampleFile:
 
         self._bc_length = list(bc_lengths)[0]
 
+        if not 0 <= max_mismatches < self._bc_length:
+            raise ValueError(
+                f"barcode mismatches must be between 0 and {self._bc_length - 1} (got {max_mismatches})"
+            )
+        self._max_mismatches = max_mismatches
+        (self._bc_lookup, self._bc_collisions) = self._build_bc_lookup()
+
+    def _build_bc_lookup(self) -> tuple:
+        """map every barcode within max_mismatches of a sample barcode to the sample
+
+        A neighbor is assigned to the sample barcode(s) it is closest to;
+        if that is more than one sample it is a collision and is not assigned.
+
+        Returns:
+            tuple: ({barcode: name}, {colliding barcode: sorted sample names})
+        """
+        # barcode: (distance, set of names at that distance)
+        closest = {bc: (0, {name}) for (bc, name) in self._bc_name.items()}
+        for distance in range(1, self._max_mismatches + 1):
+            for (bc, name) in self._bc_name.items():
+                for positions in itertools.combinations(range(len(bc)), distance):
+                    substitutions = [
+                        [base for base in self.BC_ALPHABET if base != bc[i]]
+                        for i in positions
+                    ]
+                    for bases in itertools.product(*substitutions):
+                        neighbor = list(bc)
+                        for (i, base) in zip(positions, bases):
+                            neighbor[i] = base
+                        neighbor = "".join(neighbor)
+                        if neighbor not in closest:
+                            closest[neighbor] = (distance, {name})
+                        elif closest[neighbor][0] == distance:
+                            closest[neighbor][1].add(name)
+
+        bc_lookup = {}
+        bc_collisions = {}
+        for (bc, (distance, names)) in closest.items():
+            if len(names) == 1:
+                bc_lookup[bc] = next(iter(names))
+            else:
+                bc_collisions[bc] = sorted(names)
+                LOGGER.debug(
+                    f"barcode {bc} is {distance} mismatches from {', '.join(sorted(names))} ... not assigned"
+                )
+        if bc_collisions:
+            LOGGER.warning(
+                f"{len(bc_collisions)} barcodes within {self._max_mismatches} mismatches match more than one sample and will not be corrected"
+            )
+        return (bc_lookup, bc_collisions)
+
     @property
     def bc_length(self):
         return self._bc_length
@@ -119,6 +225,20 @@ class SampleFile:
     def bc_name(self):
         return self._bc_name
 
+    @property
+    def max_mismatches(self):
+        return self._max_mismatches
+
+    @property
+    def bc_lookup(self):
+        """{barcode: name} for exact barcodes and their unambiguous neighbors"""
+        return self._bc_lookup
+
+    @property
+    def bc_collisions(self):
+        """{barcode: sample names} for neighbors equally close to more than one sample"""
+        return self._bc_collisions
+
     @property
     def name_color(self):
         return self._name_color
@@ -128,6 +248,67 @@ class SampleFile:
         return self._color_names
 
 
+class BatchRun(typing.NamedTuple):
+    """one pooled sequencing run of a batch"""
+
+    name: str
+    fastq: str
+    samples: str
+    reference: str
+
+
+class BatchFile:
+    """representation of a batch file: one pooled sequencing run per line"""
+
+    BATCH_HEADER_NAME = "Name"
+    BATCH_HEADER_FASTQ = "Fastq"
+    BATCH_HEADER_SAMPLES = "Samples"
+    BATCH_HEADER_REFERENCE = "Reference"
+
+    def __init__(self, batch_file: str):
+        """constructor
+
+        Tab-delimited with headers Name, Fastq, Samples, Reference;
+        relative paths are relative to the batch file's folder.
+
+        Args:
+            batch_file (str): batch file path
+
+        Raises:
+            ValueError: if a run name is missing, repeated or not a plain folder name
+        """
+        self._runs = []
+        batch_dir = os.path.dirname(os.path.abspath(batch_file))
+        with open(batch_file) as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            for line in reader:
+                name = line[self.BATCH_HEADER_NAME]
+                if not name or name != os.path.basename(name) or name.startswith("."):
+                    raise ValueError(f"{batch_file}: invalid run name {name!r}")
+                if name in self.names:
+                    raise ValueError(f"{batch_file}: run {name} is repeated")
+                self._runs.append(
+                    BatchRun(
+                        name=name,
+                        fastq=os.path.join(batch_dir, line[self.BATCH_HEADER_FASTQ]),
+                        samples=os.path.join(
+                            batch_dir, line[self.BATCH_HEADER_SAMPLES]
+                        ),
+                        reference=os.path.join(
+                            batch_dir, line[self.BATCH_HEADER_REFERENCE]
+                        ),
+                    )
+                )
+
+    @property
+    def runs(self):
+        return self._runs
+
+    @property
+    def names(self):
+        return [run.name for run in self._runs]
+
+
 class BCLengthException(Exception):
     """exception if barcodes are not all the same length
 
@@ -138,423 +319,3653 @@ class BCLengthException(Exception):
     pass
 
 
-class VariantFrequency(typing.NamedTuple):
-    """representation of a variant position"""
-
-    position: int
-    nreads: int
-    wildtype: str
-    mutation: str
-    frequencies: tuple
+class FastqFormatException(Exception):
+    """exception if a fastq file is malformed
 
+    Args:
+        Exception (Exception): exception
+    """
 
-#
-# code from the week6 necessary_scripts folder
-#
+    pass
 
 
-class ParseFastQ(object):
-    """Returns a read-by-read fastQ parser analogous to file.readline()"""
+class FastqRecord:
+    """lightweight fastq record; all fields are bytes without the trailing newline"""
 
-    def __init__(self, filePath, headerSymbols=["@", "+"]):
-        """Returns a read-by-read fastQ parser analogous to file.readline().
-        Exmpl: parser.next()
-        -OR-
-        Its an iterator so you can do:
-        for rec in parser:
-            ... do something with rec ...
+    __slots__ = ("header", "seq", "qual_header", "qual")
 
-        rec is tuple: (seqHeader,seqStr,qualHeader,qualStr)
-        """
-        if filePath.endswith(".gz"):
-            self._file = gzip.open(filePath, "rt")
-        else:
-            self._file = open(filePath, "r")
-        self._currentLineNumber = 0
-        self._hdSyms = headerSymbols
+    def __init__(self, header: bytes, seq: bytes, qual_header: bytes, qual: bytes):
+        self.header = header
+        self.seq = seq
+        self.qual_header = qual_header
+        self.qual = qual
 
     def __iter__(self):
-        return self
+        return iter((self.header, self.seq, self.qual_header, self.qual))
 
-    def __next__(self):
-        """Reads in next element, parses, and does minimal verification.
-        Returns: tuple: (seqHeader,seqStr,qualHeader,qualStr)"""
-        # ++++ Get Next Four Lines ++++
-        elemList = []
-        for i in range(4):
-            line = self._file.readline()
-            self._currentLineNumber += 1  ## increment file position
-            if line:
-                elemList.append(line.strip("\n"))
-            else:
-                elemList.append(None)
+    def __repr__(self):
+        return f"FastqRecord({self.header!r}, {self.seq!r}, {self.qual_header!r}, {self.qual!r})"
 
-        # ++++ Check Lines For Expected Form ++++
-        trues = [bool(x) for x in elemList].count(True)
-        nones = elemList.count(None)
-        # -- Check for acceptable end of file --
-        if nones == 4:
-            raise StopIteration
-        # -- Make sure we got 4 full lines of data --
-        assert trues == 4, (
-            "** ERROR: It looks like I encountered a premature EOF or empty line.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
-            % (self._currentLineNumber)
-        )
-        # -- Make sure we are in the correct "register" --
-        assert elemList[0].startswith(self._hdSyms[0]), (
-            "** ERROR: The 1st line in fastq element does not start with '%s'.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
-            % (self._hdSyms[0], self._currentLineNumber)
-        )
-        assert elemList[2].startswith(self._hdSyms[1]), (
-            "** ERROR: The 3rd line in fastq element does not start with '%s'.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
-            % (self._hdSyms[1], self._currentLineNumber)
-        )
-        # -- Make sure the seq line and qual line have equal lengths --
-        assert len(elemList[1]) == len(elemList[3]), (
-            "** ERROR: The length of Sequence data and Quality data of the last record aren't equal.\n\
-               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
-            % (self._currentLineNumber)
-        )
 
-        # ++++ Return fatsQ data as tuple ++++
-        return tuple(elemList)
+class FastqReader:
+    """block-based fastq reader
 
+    Reads the (optionally gzipped) file in large binary blocks and splits
+    all complete records in a block at once instead of calling readline()
+    per line.  Performs the same verification as ParseFastQ:
+    (1) no premature EOF or empty lines
+    (2) header lines start with the expected symbols
+    (3) sequence and quality lengths match
+    Errors report the line number of the last line of the offending record.
 
-def pileup(indexed_bam_file: str) -> list:
-    """Generate pileup and identify positons where > 1 base is present
+    Usage:
+        for rec in FastqReader(path):
+            ... do something with rec (FastqRecord) ...
+    """
 
-    Iterate through the columns of a pileup, and count the number of bases of each type at each position.
-    If more than one base is observed, create a tuple of position, # reads, & base frequency
-    and add it to a list of such tuples
+    def __init__(
+        self,
+        file_path: str,
+        header_symbols: tuple = (b"@", b"+"),
+        block_size: int = FASTQ_BLOCK_SIZE,
+        prefetch: int = FASTQ_PREFETCH_BLOCKS,
+    ):
+        """constructor
 
-    Args:
-        indexed_bam_file (str): path to indexed bam file
+        Args:
+            file_path (str): fastq path (.gz is decompressed)
+            header_symbols (tuple, optional): sequence/quality header symbols. Defaults to (b"@", b"+").
+            block_size (int, optional): read block size in bytes. Defaults to FASTQ_BLOCK_SIZE.
+            prefetch (int, optional): .gz blocks decompressed ahead by a background thread
+                (0: decompress on the calling thread). Defaults to FASTQ_PREFETCH_BLOCKS.
+        """
+        self._file_path = file_path
+        self._hd_syms = header_symbols
+        self._block_size = block_size
+        self._prefetch = prefetch
 
-    Returns:
-        list: tuples (position, # reads, frequencies)
-    """
-    samfile = pysam.AlignmentFile(indexed_bam_file, "rb")
-    variants = []
+    def __iter__(self):
+        for columns in self._blocks():
+            yield from map(FastqRecord, *columns)
 
-    # Since our reference only has a single sequence, we're going to pile up ALL of the reads. Usually you would do it in a specific region (such as chromosome 1, position 1023 to 1050 for example)
-    for pileupcolumn in samfile.pileup():
-        LOGGER.debug("coverage at base %s = %s" % (pileupcolumn.pos, pileupcolumn.n))
-        # use a dictionary to count up the bases at each position (auto-intialized to 0)
-        ntdict = collections.defaultdict(int)
-        for pileupread in pileupcolumn.pileups:
-            if not pileupread.is_del and not pileupread.is_refskip:
-                # You can uncomment the below line to see what is happening in the pileup.
-                # print ('\tbase in read %s = %s' % (pileupread.alignment.query_name, pileupread.alignment.query_sequence[pileupread.query_position]))
-                base = pileupread.alignment.query_sequence[pileupread.query_position]
-                # Populate the ntdict with the counts of each base
-                # This dictionary will hold all of the base read counts per nucletoide per position.
-                # Use the dictionary to calculate the frequency of each site, and report it if if the frequency is NOT  100% / 0%.
-                ntdict[base] += 1
-        LOGGER.debug(ntdict)
-        if len(ntdict) > 1:  # found more than 1 base at the position
-            # need position, count, and base frequency
-            frequencies = [
-                (base, ntdict[base] / pileupcolumn.n) for base in ["A", "C", "T", "G"]
-            ]
-            variants.append((pileupcolumn.pos, pileupcolumn.n, tuple(frequencies)))
+    def batches(self) -> typing.Iterator[list]:
+        """generate lists of records, one list per block read
 
-    samfile.close()
+        Raises:
+            FastqFormatException: if the file is malformed
 
-    return variants
+        Yields:
+            list: FastqRecord objects
+        """
+        for columns in self._blocks():
+            yield list(map(FastqRecord, *columns))
 
+    def chunks(self) -> typing.Iterator[tuple]:
+        """generate record-aligned raw chunks of the (decompressed) file
 
-#
-# top-level functions
-#
+        Every chunk but the last ends with a complete record, so chunks can be
+        parsed independently (e.g. by other processes) with parse_chunk.
+        No verification is done here.
 
+        Yields:
+            tuple: (# records preceding the chunk, chunk bytes)
+        """
+        nrecords = 0
+        tail = b""  # incomplete record at the end of the previous block
+        for block in _read_blocks(self._file_path, self._block_size, self._prefetch):
+            data = tail + block if tail else block
+            nlines = data.count(b"\n")
+            if nlines < 4:
+                tail = data
+                continue
+
+            # cut after the newline ending the last complete record
+            cut = len(data)
+            for _ in range(nlines % 4 + 1):
+                cut = data.rfind(b"\n", 0, cut)
+            cut += 1
+            yield (nrecords, data[:cut])
+            nrecords += (nlines - nlines % 4) // 4
+            tail = data[cut:]
+
+        # the last line need not be newline-terminated
+        if tail:
+            yield (nrecords, tail)
+
+    def parse_chunk(self, chunk: bytes, first_record: int = 0) -> tuple:
+        """split a record-aligned chunk into verified record columns
 
-def parse_arguments() -> argparse.Namespace:
-    """Parses input arguments
+        Args:
+            chunk (bytes): raw fastq data (see chunks)
+            first_record (int, optional): # records preceding the chunk (for error reporting). Defaults to 0.
 
-    Returns:
-        argparse.Namespace: argument object
-    """
+        Raises:
+            FastqFormatException: if any record is malformed
 
-    REPORT_DEFAULT = "report.txt"
-    FASTQS_DEFAULT = "fastqs"
-    BAMS_DEFAULT = "bams"
-    LOG_DEFAULT = "pipeline.log"
+        Returns:
+            tuple: (headers, seqs, qual_headers, quals) lists of bytes
+        """
+        lines = chunk.split(b"\n")
+        if not lines[-1]:
+            lines.pop()  # newline-terminated chunk
+        if len(lines) % 4:
+            self._raise_format_error(
+                first_record + len(lines) // 4 + 1, "premature EOF or empty line"
+            )
 
-    parser = argparse.ArgumentParser(
-        description="Demultiplex and trim reads by barcode"
-    )
-    parser.add_argument("fastq", help="barcoded fastq sequence data")
-    parser.add_argument("samples", help="tab-delimited sample file")
-    parser.add_argument("reference", help="fasta reference")
-    parser.add_argument(
-        "--fastqs-dir",
-        dest="fastqs_dir",
-        help="output fastq folder",
-        default=FASTQS_DEFAULT,
-    )
-    parser.add_argument(
-        "--bams-dir", dest="bams_dir", help="output bam folder", default=BAMS_DEFAULT
-    )
-    parser.add_argument("--report", help="output fastq folder", default=REPORT_DEFAULT)
-    parser.add_argument(
-        "--reindex", action="store_true", help="force re-indexing of reference"
-    )
-    parser.add_argument("--force", action="store_true", help="overwrite outputs")
-    parser.add_argument(
-        "--savesam", action="store_true", help="save intermediate SAM (debugging)"
-    )
-    parser.add_argument(
-        "--debug", action="store_true", help="debug mode (for reporting)"
-    )
-    parser.add_argument(
-        "--logfile", help="log file name", default=LOG_DEFAULT
-    )
-    args = parser.parse_args()
+        headers = lines[0::4]
+        seqs = lines[1::4]
+        qual_headers = lines[2::4]
+        quals = lines[3::4]
 
-    #
-    # setup log file
-    #
-    print(f"Logging to {args.logfile} with debug: {args.debug}")
-    _setup_logger(args.debug, args.logfile)
+        # cheap whole-chunk checks; locate the bad record only on failure
+        (seq_sym, qual_sym) = self._hd_syms
+        if not (
+            all(seqs)
+            and all(quals)
+            and all(map(bytes.startswith, headers, itertools.repeat(seq_sym)))
+            and all(map(bytes.startswith, qual_headers, itertools.repeat(qual_sym)))
+            and list(map(len, seqs)) == list(map(len, quals))
+        ):
+            self._check_records(first_record, headers, seqs, qual_headers, quals)
 
-    LOGGER.info("-- START ANALYSIS --")
-    LOGGER.info("-- Parse and validate input --")
+        return (headers, seqs, qual_headers, quals)
 
-    # echo inputs
-    LOGGER.info(f"sequencing fastq: {args.fastq}")
-    LOGGER.info(f"sample file: {args.samples}")
-    LOGGER.info(f"reference fasta: {args.reference}")
-    LOGGER.info(f"fastqs dir: {args.fastqs_dir}")
-    LOGGER.info(f"bams dir: {args.bams_dir}")
-    LOGGER.info(f"report file: {args.report}")
-    LOGGER.info(f"re-index reference: {args.reindex}")
-    LOGGER.info(f"force: {args.force}")
-    LOGGER.info(f"save intermdiate SAM: {args.savesam}")
-    LOGGER.info(f"debug: {args.debug}")
-    LOGGER.info(f"log file: {args.logfile}")
+    def _blocks(self) -> typing.Iterator[tuple]:
+        """generate the verified records of each block as columns
 
-    #
-    # input/output validation
-    #
+        Raises:
+            FastqFormatException: if the file is malformed
 
-    # check input existence
-    for input_file in [args.fastq, args.samples, args.reference]:
-        if not os.path.exists(input_file):
-            LOGGER.info(f"{input_file} not found.  Exiting...")
-            sys.exit(1)
+        Yields:
+            tuple: (headers, seqs, qual_headers, quals) lists of bytes
+        """
+        for (first_record, chunk) in self.chunks():
+            yield self.parse_chunk(chunk, first_record)
+
+    def _check_records(
+        self,
+        first_record: int,
+        headers: list,
+        seqs: list,
+        qual_headers: list,
+        quals: list,
+    ) -> None:
+        """find the first malformed record and raise an error for it
 
-    # don't overwrite existing intermediates/outputs unless forced
-    for output in [args.fastqs_dir, args.bams_dir, args.report]:
-        if os.path.exists(output):
-            if not args.force:
-                LOGGER.info(
-                    f"{output} already exists.  Use --force to overwrite.  Exiting..."
+        Raises:
+            FastqFormatException: malformed record
+        """
+        (seq_sym, qual_sym) = self._hd_syms
+        for (i, rec) in enumerate(zip(headers, seqs, qual_headers, quals)):
+            (header, seq, qual_header, qual) = rec
+            record_number = first_record + i + 1
+            if not all(rec):
+                self._raise_format_error(record_number, "premature EOF or empty line")
+            if not header.startswith(seq_sym):
+                self._raise_format_error(
+                    record_number,
+                    f"The 1st line in fastq element does not start with '{seq_sym.decode()}'",
+                )
+            if not qual_header.startswith(qual_sym):
+                self._raise_format_error(
+                    record_number,
+                    f"The 3rd line in fastq element does not start with '{qual_sym.decode()}'",
+                )
+            if len(seq) != len(qual):
+                self._raise_format_error(
+                    record_number,
+                    "The length of Sequence data and Quality data of the last record aren't equal",
                 )
-                sys.exit(1)
-            else:
-                LOGGER.info(f"Deleting existing {output} ...")
-                if os.path.isdir(output):
-                    _rm_tree(output)
-                else:
-                    pathlib.Path(output).unlink()
-
-    return args
 
+    def _raise_format_error(self, record_number: int, message: str) -> None:
+        """raise a format error for a record (1-based count from the start of the file)
 
-def verify_prerequisites() -> None:
-    """Verify required third-party applications are present"""
-    for app in ["bwa", "samtools"]:
-        cmd = ["which", app]
-        _run_subprocess(cmd, None)
+        Raises:
+            FastqFormatException: always
+        """
+        line_number = record_number * 4
+        raise FastqFormatException(
+            f"{message}: please check {self._file_path} near line number {line_number} (plus or minus ~4 lines)"
+        )
 
 
-def create_fastqs(samples: SampleFile, fastq_file: str, fastqs_dir: str) -> None:
-    """demultplex a fastq by barcode; trim barcodes and low-quality bases
-       (1st occurrence of consecutive D/F quality scores)
-       and write the new per-barcode fastqs named <name>_trimmed.fastq
-       to the output folder. (name = Name field from sample file)
+class FastqWriterPool:
+    """pool of buffered per-sample fastq writers
 
-       - Assumes barcodes are of the same length - will raise an exception otherwise
-       - Assumes barcodes start at the beginning of the read
-       - Skips barcodes with no assigned name
+    Keeps one buffered handle open per sample for the whole demultiplexing pass
+    instead of opening/closing the output for every read.
+    If more than max_open samples are active, the least recently used handle
+    is flushed and closed; it is re-opened in append mode on its next write,
+    so the output is identical to writing every read in order.
 
-    Args:
-        samples (SampleFile): object representation of sample file
-        fastq_file (str): fastqs input sequence data
-        fastqs_dir (str): output folder of fastqs
+    Compressed outputs (.gz) are written as already compressed gzip members
+    (see compress_fastq); a BGZF end-of-file block is appended on close.
     """
 
-    # setup
-    regex = re.compile(r"[DF]{2}")  # low quality
+    def __init__(
+        self,
+        fastqs_dir: str,
+        buffer_size: int = FASTQ_BUFFER_SIZE,
+        max_open: int = MAX_OPEN_FASTQS,
+        compression: str = "none",
+    ):
+        """constructor
 
-    # fastq iterator setup
-    SEQHEADER = 0
-    SEQ = 1
-    QUALHEADER = 2
-    QUAL = 3
+        Args:
+            fastqs_dir (str): output folder of fastqs
+            buffer_size (int, optional): write buffer size per handle. Defaults to FASTQ_BUFFER_SIZE.
+            max_open (int, optional): maximum number of open handles. Defaults to MAX_OPEN_FASTQS.
+            compression (str, optional): one of FASTQ_COMPRESSIONS. Defaults to "none".
 
-    fastq_parser = ParseFastQ(fastq_file)
-    os.makedirs(fastqs_dir)
+        Raises:
+            ValueError: if max_open is less than 1 or the compression is unknown
+        """
+        if max_open < 1:
+            raise ValueError(f"max_open must be at least 1 (got {max_open})")
+        if compression not in FASTQ_COMPRESSIONS:
+            raise ValueError(f"unknown compression {compression}")
+        self._fastqs_dir = fastqs_dir
+        self._buffer_size = buffer_size
+        self._max_open = max_open
+        self._compression = compression
+        self._handles = collections.OrderedDict()  # name: file handle (LRU order)
+        self._written = set()
+        self._evictions = 0
+
+    def __enter__(self):
+        return self
 
-    # parse sequence data one read at a time
-    for read in fastq_parser:
-        # get the barcode
-        bc = read[SEQ][: samples.bc_length]
-        name = samples.bc_name.get(bc)
-        if name:
-            # find starting point for trimming low-quality bases
-            match = regex.search(read[QUAL])
-            end_pos = match.start() if match else None
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-            # trim
-            seq_str = (
-                read[SEQ][samples.bc_length : end_pos]
-                if end_pos
-                else read[SEQ][samples.bc_length :]
-            )
-            qual_str = (
-                read[QUAL][samples.bc_length : end_pos]
-                if end_pos
-                else read[QUAL][samples.bc_length :]
-            )
-
-            # write read - append to existing
-            # seems like a lot of I/O - might be a better way to do this
-            filename = os.path.join(fastqs_dir, f"{name}{TRIMMED_FASTQ}")
-            with open(filename, "a+") as f:
-                for read_line in (read[SEQHEADER], seq_str, read[QUALHEADER], qual_str):
-                    f.write(f"{read_line}\n")
-        else:
-            LOGGER.debug(f"barcode {bc} has no assigned sample ... skipping")
+    def filename(self, name: str) -> str:
+        """output fastq path for a sample name
 
+        Args:
+            name (str): sample name
 
-def align_reads(reference: str, fastqs_dir: str, bams_dir: str, reindex=False) -> None:
+        Returns:
+            str: path to <name>_trimmed.fastq(.gz) in the output folder
+        """
+        suffix = TRIMMED_FASTQ if self._compression == "none" else TRIMMED_FASTQ_GZ
+        return os.path.join(self._fastqs_dir, f"{name}{suffix}")
+
+    def write(self, name: str, record: bytes) -> None:
+        """write (append) a formatted record to a sample's fastq
+
+        Args:
+            name (str): sample name
+            record (bytes): formatted fastq record(s) (4 newline-terminated lines each),
+                compressed as the output (see compress_fastq)
+        """
+        handle = self._handles.get(name)
+        if handle is None:
+            if len(self._handles) >= self._max_open:
+                (_, lru_handle) = self._handles.popitem(last=False)
+                lru_handle.close()
+                self._evictions += 1
+            handle = open(self.filename(name), "ab", buffering=self._buffer_size)
+            self._handles[name] = handle
+            self._written.add(name)
+        else:
+            self._handles.move_to_end(name)
+        handle.write(record)
+
+    def close(self) -> None:
+        """flush and close all open handles"""
+        while self._handles:
+            (_, handle) = self._handles.popitem(last=False)
+            handle.close()
+        if self._compression == "bgzf":
+            for name in self._written:
+                with open(self.filename(name), "ab") as f:
+                    f.write(BGZF_EOF)
+        self._written.clear()
+        if self._evictions:
+            LOGGER.debug(f"{self._evictions} fastq handle evictions")
+
+
+class ReferenceFasta:
+    """random access to reference bases through a faidx (.fai) index
+
+    Bases are fetched from disk per contig & position on request,
+    so multi-contig and multi-line fastas are supported and whole
+    chromosomes are never loaded into memory.
+    """
+
+    def __init__(self, fasta_file: str):
+        """constructor
+
+        Args:
+            fasta_file (str): indexed fasta (see ReferenceFasta.index)
+        """
+        self._fasta = pysam.FastaFile(fasta_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def index(fasta_file: str, reindex: bool = False) -> str:
+        """create the .fai index of a fasta if it is missing or older than the fasta
+
+        Args:
+            fasta_file (str): fasta path
+            reindex (bool, optional): force re-indexing. Defaults to False.
+
+        Returns:
+            str: index path
+        """
+        fai_file = fasta_file + ".fai"
+        if (
+            reindex
+            or not os.path.exists(fai_file)
+            or os.path.getmtime(fai_file) < os.path.getmtime(fasta_file)
+        ):
+            LOGGER.debug(f"Creating fasta index {fai_file}")
+            pysam.faidx(fasta_file)
+        return fai_file
+
+    @property
+    def contigs(self):
+        return self._fasta.references
+
+    def length(self, contig: str) -> int:
+        """length of a contig
+
+        Args:
+            contig (str): contig name
+
+        Raises:
+            KeyError: if the contig is not in the reference
+
+        Returns:
+            int: # bases
+        """
+        return self._fasta.get_reference_length(contig)
+
+    def base(self, contig: str, position: int) -> str:
+        """reference base at a position
+
+        Args:
+            contig (str): contig name
+            position (int): 0-based position
+
+        Raises:
+            KeyError: if the contig is not in the reference
+            IndexError: if the position is outside the contig
+
+        Returns:
+            str: base (upper case)
+        """
+        if not 0 <= position < self.length(contig):
+            raise IndexError(f"position {position + 1} is outside {contig}")
+        return self._fasta.fetch(contig, position, position + 1).upper()
+
+    def sequence(self, contig: str, start: int, stop: int) -> str:
+        """reference bases of a region
+
+        Args:
+            contig (str): contig name
+            start (int): 0-based start
+            stop (int): 0-based stop (exclusive; clipped to the contig length)
+
+        Raises:
+            KeyError: if the contig is not in the reference
+
+        Returns:
+            str: bases (upper case)
+        """
+        return self._fasta.fetch(contig, start, stop).upper()
+
+    def close(self) -> None:
+        """close the fasta"""
+        self._fasta.close()
+
+
+class BwaIndexCache:
+    """shared cache of bwa indexes, keyed by reference content and bwa version
+
+    Each entry is a directory <md5 of the reference>-<bwa version> holding the
+    index files (prefix: the reference file name), so a modified reference gets
+    a new index and identical references anywhere share one.
+
+    An entry is built in a temporary directory and renamed into place under an
+    exclusive lock (<entry>.lock), so concurrent runs never build the same index
+    twice or see a partial one. While an index is in use its lock is held shared.
+    After each use, the least recently used entries which are not in use are
+    evicted beyond max_entries or max_bytes.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_entries: int = INDEX_CACHE_ENTRIES,
+        max_bytes: int = None,
+    ):
+        """constructor
+
+        Args:
+            cache_dir (str): cache directory (created if needed)
+            max_entries (int, optional): max # of entries. Defaults to INDEX_CACHE_ENTRIES.
+            max_bytes (int, optional): max total size of the entries. Defaults to None (unlimited).
+        """
+        self._cache_dir = cache_dir
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+
+    @staticmethod
+    def key(reference: str) -> str:
+        """cache key of a reference: content checksum and bwa version
+
+        Args:
+            reference (str): reference fasta
+
+        Returns:
+            str: key
+        """
+        md5 = hashlib.md5()
+        with open(reference, "rb") as f:
+            for block in iter(functools.partial(f.read, FASTQ_BLOCK_SIZE), b""):
+                md5.update(block)
+        version = re.sub(r"[^\w.-]", "_", _bwa_version())
+        return f"{md5.hexdigest()}-{version}"
+
+    @contextlib.contextmanager
+    def open(self, reference: str, rebuild: bool = False):
+        """get the index of a reference, building it if it is not cached
+
+        Args:
+            reference (str): reference fasta
+            rebuild (bool, optional): rebuild the index even if it is cached. Defaults to False.
+
+        Yields:
+            str: index prefix (for bwa mem), valid until the context exits
+        """
+        key = self.key(reference)
+        entry = os.path.join(self._cache_dir, key)
+        prefix = os.path.join(entry, os.path.basename(reference))
+        os.makedirs(self._cache_dir, exist_ok=True)
+        with open(f"{entry}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if rebuild or not os.path.isdir(entry):
+                    self._build(reference, entry, prefix)
+                else:
+                    LOGGER.info(f"using cached bwa index {entry}")
+                os.utime(entry)  # last used
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                self.evict(keep=key)
+                yield prefix
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def entries(self) -> list:
+        """cached entries, least recently used first
+
+        Returns:
+            list: tuples (key, last used time, size in bytes)
+        """
+        entries = []
+        for item in os.scandir(self._cache_dir):
+            if item.name.startswith(".") or not item.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(item.path))
+                entries.append((item.name, item.stat().st_mtime, size))
+            except FileNotFoundError:  # evicted by another run
+                continue
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def evict(self, keep: str = None) -> list:
+        """evict least recently used entries beyond max_entries or max_bytes
+
+        Entries in use by any run (or being built) are skipped.
+
+        Args:
+            keep (str, optional): key never to evict. Defaults to None.
+
+        Returns:
+            list: evicted keys
+        """
+        entries = self.entries()
+        (nentries, nbytes) = (len(entries), sum(size for (_, _, size) in entries))
+        evicted = []
+        for (key, _, size) in entries:
+            if not (
+                nentries > self._max_entries
+                or (self._max_bytes is not None and nbytes > self._max_bytes)
+            ):
+                break
+            if key == keep:
+                continue
+            entry = os.path.join(self._cache_dir, key)
+            with open(f"{entry}.lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    LOGGER.debug(f"bwa index {entry} is in use; not evicted")
+                    continue
+                if os.path.isdir(entry):
+                    _rm_tree(entry)
+                    LOGGER.info(f"evicted bwa index {entry} ({size:,} bytes)")
+                    evicted.append(key)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            (nentries, nbytes) = (nentries - 1, nbytes - size)
+        return evicted
+
+    def _build(self, reference: str, entry: str, prefix: str) -> None:
+        """build an index in a temporary directory and rename it into place (lock held)
+
+        Args:
+            reference (str): reference fasta
+            entry (str): entry directory
+            prefix (str): index prefix in the entry directory
+        """
+        LOGGER.info(f"building bwa index {entry}")
+        tmp_dir = tempfile.mkdtemp(
+            prefix=f".{os.path.basename(entry)}.", dir=self._cache_dir
+        )
+        try:
+            cmd = [
+                "bwa",
+                "index",
+                "-p",
+                os.path.join(tmp_dir, os.path.basename(prefix)),
+                reference,
+            ]
+            _run_subprocess(cmd, None)
+            os.chmod(tmp_dir, 0o755)  # mkdtemp is private; the cache is shared
+            if os.path.isdir(entry):  # rebuild
+                old_dir = f"{tmp_dir}.old"
+                os.rename(entry, old_dir)
+                _rm_tree(old_dir)
+            os.rename(tmp_dir, entry)
+        finally:
+            if os.path.isdir(tmp_dir):
+                _rm_tree(tmp_dir)
+
+
+class StageManifest:
+    """record of completed pipeline stages, used to resume a run
+
+    For each stage (and for per-sample stages, each sample) the manifest
+    stores the checksums of the inputs, the parameters which affect the outputs,
+    the checksums of the outputs written and optionally a (JSON) result.
+    A record is current if its inputs and parameters are unchanged and every
+    output still exists with the recorded checksum - like make, but by content.
+
+    The manifest is saved (atomically) after every record, so the completed work
+    of a failed run is kept.
+    A manifest without a file is disabled: nothing is current, nothing is recorded
+    and no checksums are computed.
+    """
+
+    VERSION = 1
+    ALL = "*"  # key of stages which are not per sample
+
+    def __init__(self, manifest_file: str = None):
+        """constructor
+
+        Args:
+            manifest_file (str, optional): JSON manifest path; loaded if it exists. Defaults to None (disabled).
+        """
+        self._manifest_file = manifest_file
+        self._stages = {}
+        self._checksums = {}  # path: ((size, mtime), checksum)
+        if manifest_file is not None and os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == self.VERSION:
+                self._stages = manifest["stages"]
+            else:
+                LOGGER.info(f"{manifest_file} has an unknown version - ignoring it")
+
+    @property
+    def enabled(self):
+        return self._manifest_file is not None
+
+    def checksum(self, path: str) -> str:
+        """md5 checksum of a file
+
+        Checksums are cached by path, size & modification time within a run.
+
+        Args:
+            path (str): file path
+
+        Returns:
+            str: hex digest (empty if the manifest is disabled)
+        """
+        if not self.enabled:
+            return ""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._checksums.get(path)
+        if cached is None or cached[0] != signature:
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for block in iter(functools.partial(f.read, FASTQ_BLOCK_SIZE), b""):
+                    md5.update(block)
+            cached = (signature, md5.hexdigest())
+            self._checksums[path] = cached
+        return cached[1]
+
+    def is_current(self, stage: str, key: str, inputs: dict, parameters: dict) -> bool:
+        """check whether a stage (sample) is complete and up to date
+
+        Args:
+            stage (str): stage name
+            key (str): sample name (or StageManifest.ALL)
+            inputs (dict): {input label: checksum}
+            parameters (dict): {parameter name: JSON-serializable value}
+
+        Returns:
+            bool: True if the stage (sample) can be skipped
+        """
+        record = self._stages.get(stage, {}).get(key)
+        if record is None:
+            return False
+        if record["inputs"] != inputs or record["parameters"] != _to_json(parameters):
+            return False
+        for (path, checksum) in record["outputs"].items():
+            if not os.path.exists(path) or self.checksum(path) != checksum:
+                return False
+        return True
+
+    def record(
+        self,
+        stage: str,
+        key: str,
+        inputs: dict,
+        parameters: dict,
+        outputs: list = (),
+        result=None,
+    ) -> None:
+        """record a completed stage (sample) and save the manifest
+
+        Args:
+            stage (str): stage name
+            key (str): sample name (or StageManifest.ALL)
+            inputs (dict): {input label: checksum}
+            parameters (dict): {parameter name: JSON-serializable value}
+            outputs (list, optional): paths of the files written. Defaults to ().
+            result (optional): JSON-serializable result of the stage. Defaults to None.
+        """
+        if not self.enabled:
+            return
+        self._stages.setdefault(stage, {})[key] = {
+            "inputs": inputs,
+            "parameters": _to_json(parameters),
+            "outputs": {os.path.abspath(path): self.checksum(path) for path in outputs},
+            "result": result,
+        }
+        self.save()
+
+    def result(self, stage: str, key: str):
+        """result of a recorded stage (sample)
+
+        Args:
+            stage (str): stage name
+            key (str): sample name (or StageManifest.ALL)
+
+        Returns:
+            JSON result (None if there is no record)
+        """
+        return self._stages.get(stage, {}).get(key, {}).get("result")
+
+    def discard(self, stage: str, keep: typing.Iterable) -> None:
+        """drop the records of a stage except for some keys (e.g. removed samples)
+
+        Args:
+            stage (str): stage name
+            keep (typing.Iterable): keys to keep
+        """
+        records = self._stages.get(stage, {})
+        for key in set(records) - set(keep):
+            LOGGER.debug(f"discarding {stage} record of {key}")
+            del records[key]
+
+    def save(self) -> None:
+        """write the manifest (via a temporary file, so it is never partially written)"""
+        if not self.enabled:
+            return
+        tmp_file = f"{self._manifest_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"version": self.VERSION, "stages": self._stages}, f, indent=1)
+        os.replace(tmp_file, self._manifest_file)
+
+
+class PipelineMetrics:
+    """per-stage timings and counters, saved as JSON (metrics.json)
+
+    Usage:
+        with metrics.stage("align") as stage:
+            ... run the stage ...
+            stage["samples"] = 10
+
+    Each stage records its wall time and CPU time (this process plus waited-for
+    child processes, i.e. workers and bwa/samtools); if a "reads" counter is set,
+    reads/sec is added.
+    Metrics without a file are disabled: stages are not timed and nothing is saved.
+    """
+
+    def __init__(self, metrics_file: str = None):
+        """constructor
+
+        Args:
+            metrics_file (str, optional): JSON output path. Defaults to None (disabled).
+        """
+        self._metrics_file = metrics_file
+        self._metrics = {"stages": {}}
+
+    @property
+    def enabled(self):
+        return self._metrics_file is not None
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[dict]:
+        """time a stage
+
+        Args:
+            name (str): stage name
+
+        Yields:
+            dict: the stage's counters (may be updated by the caller)
+        """
+        counters = {}
+        if not self.enabled:
+            yield counters
+            return
+        start_wall = time.perf_counter()
+        start_cpu = self._cpu_time()
+        try:
+            yield counters
+        finally:
+            wall_time = time.perf_counter() - start_wall
+            stage = {
+                "wall_time": round(wall_time, 3),
+                "cpu_time": round(self._cpu_time() - start_cpu, 3),
+            }
+            stage.update(counters)
+            if "reads" in counters and wall_time > 0:
+                stage["reads_per_sec"] = round(counters["reads"] / wall_time)
+            self._metrics["stages"][name] = stage
+
+    def set(self, name: str, value) -> None:
+        """record a (JSON-serializable) top-level value, e.g. per-sample counts
+
+        Args:
+            name (str): key
+            value: value
+        """
+        if self.enabled:
+            self._metrics[name] = value
+
+    def save(self) -> None:
+        """write the metrics"""
+        if not self.enabled:
+            return
+        with open(self._metrics_file, "w") as f:
+            json.dump(self._metrics, f, indent=1)
+            f.write("\n")
+        LOGGER.info(f"metrics written to {self._metrics_file}")
+
+    @staticmethod
+    def _cpu_time() -> float:
+        """user + system CPU seconds of this process and its waited-for children"""
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+
+class SampleCounts(typing.NamedTuple):
+    """# reads assigned to a sample by exact and corrected barcode, and # bases after trimming"""
+
+    exact: int
+    corrected: int
+    bases: int
+
+
+class DemultiplexStats(typing.NamedTuple):
+    """results of create_fastqs"""
+
+    samples: dict  # {sample name: SampleCounts} for samples with at least 1 read
+    unassigned: collections.Counter  # {barcode: # reads} with no sample
+
+
+class PipelineJob(typing.NamedTuple):
+    """a unit of work for _run_jobs"""
+
+    name: str
+    threads: int  # threads used by the job
+    run: typing.Callable  # called with no arguments
+    memory: int = 0  # memory used by the job (bytes)
+
+
+class SubprocessUsage(typing.NamedTuple):
+    """resources used by a completed subprocess"""
+
+    wall_time: float  # seconds
+    cpu_time: float  # user + system seconds
+
+
+class CallThresholds(typing.NamedTuple):
+    """thresholds of allele calling (see call_alleles)"""
+
+    min_allele_freq: float = 0.0
+    min_depth: int = 1
+
+
+class VariantFrequency(typing.NamedTuple):
+    """representation of a variant position"""
+
+    position: int
+    nreads: int
+    wildtype: str
+    mutation: str
+    frequencies: tuple
+    contig: str = None
+
+
+class VariantTable:
+    """columnar table of variants: one row per sample and variant position
+
+    Columns are NumPy arrays of equal length:
+    - sample: index into samples (sample names)
+    - contig: index into contigs (contig names)
+    - position: 1-based position
+    - depth: # reads (A/C/G/T bases counted)
+    - wildtype, mutation: alleles (bases; VCF-style anchored alleles for indels)
+    - counts: (rows x 4) base counts in PILEUP_BASES order
+    - mutation_count: # reads with the mutation
+    Rows are in sample name order, then in the order of each sample's variants.
+    """
+
+    def __init__(
+        self,
+        samples: list,
+        contigs: list,
+        sample: np.ndarray,
+        contig: np.ndarray,
+        position: np.ndarray,
+        depth: np.ndarray,
+        wildtype: np.ndarray,
+        mutation: np.ndarray,
+        counts: np.ndarray,
+        mutation_count: np.ndarray,
+    ):
+        """constructor (see from_variants)"""
+        self.samples = samples
+        self.contigs = contigs
+        self.sample = sample
+        self.contig = contig
+        self.position = position
+        self.depth = depth
+        self.wildtype = wildtype
+        self.mutation = mutation
+        self.counts = counts
+        self.mutation_count = mutation_count
+
+    def __len__(self):
+        return len(self.position)
+
+    @classmethod
+    def from_variants(cls, variants: dict) -> "VariantTable":
+        """build a table from the variants of each sample
+
+        Args:
+            variants (dict): dictionary of {name: list of VariantFrequency tuples} (see call_variants)
+
+        Returns:
+            VariantTable: table
+        """
+        samples = sorted(variants)
+        rows = [
+            (sample_index, variant)
+            for (sample_index, name) in enumerate(samples)
+            for variant in variants[name]
+        ]
+        contig_index = {}
+        for (_, variant) in rows:
+            contig_index.setdefault(variant.contig, len(contig_index))
+
+        # frequencies are count / depth, so the counts are recovered exactly
+        (counts, mutation_count) = ([], [])
+        for (_, variant) in rows:
+            frequencies = dict(variant.frequencies)
+            counts.append(
+                [
+                    round(frequencies.get(base, 0) * variant.nreads)
+                    for base in PILEUP_BASES
+                ]
+            )
+            mutation_count.append(_mutation_count(variant))
+
+        return cls(
+            samples=samples,
+            contigs=list(contig_index),
+            sample=np.array([i for (i, _) in rows], dtype=np.int64),
+            contig=np.array(
+                [contig_index[variant.contig] for (_, variant) in rows], dtype=np.int64
+            ),
+            position=np.array(
+                [variant.position for (_, variant) in rows], dtype=np.int64
+            ),
+            depth=np.array([variant.nreads for (_, variant) in rows], dtype=np.int64),
+            wildtype=np.array([variant.wildtype for (_, variant) in rows], dtype=str),
+            mutation=np.array([variant.mutation for (_, variant) in rows], dtype=str),
+            counts=np.array(counts, dtype=np.int64).reshape(
+                len(rows), len(PILEUP_BASES)
+            ),
+            mutation_count=np.array(mutation_count, dtype=np.int64),
+        )
+
+    def sample_rows(self) -> dict:
+        """row indices of each sample (groupby sample)
+
+        Returns:
+            dict: {sample name: array of row indices}
+        """
+        boundaries = np.searchsorted(self.sample, np.arange(len(self.samples) + 1))
+        return {
+            name: np.arange(boundaries[i], boundaries[i + 1])
+            for (i, name) in enumerate(self.samples)
+        }
+
+    def locations(self) -> list:
+        """report location of each row: the position, or contig:position if there are several contigs
+
+        Returns:
+            list: locations
+        """
+        if len(self.contigs) > 1:
+            return [
+                f"{self.contigs[contig]}:{position}"
+                for (contig, position) in zip(
+                    self.contig.tolist(), self.position.tolist()
+                )
+            ]
+        return self.position.tolist()
+
+    def sites(self, contig_order: list = None) -> list:
+        """group the rows by variant site (contig, position, wildtype, mutation)
+
+        Args:
+            contig_order (list, optional): contig names in output order. Defaults to None (table order).
+
+        Returns:
+            list: row index arrays, one per site, in contig & position order
+        """
+        if not len(self):
+            return []
+        rank = np.arange(len(self.contigs))
+        if contig_order is not None:
+            order_index = {name: i for (i, name) in enumerate(contig_order)}
+            rank = np.array(
+                [order_index.get(name, len(order_index)) for name in self.contigs]
+            )
+        contig_rank = rank[self.contig]
+        order = np.lexsort(
+            (self.sample, self.mutation, self.wildtype, self.position, contig_rank)
+        )
+        keys = (contig_rank, self.position, self.wildtype, self.mutation)
+        changed = np.zeros(len(order), dtype=bool)
+        changed[0] = True
+        for key in keys:
+            changed[1:] |= key[order][1:] != key[order][:-1]
+        return np.split(order, np.flatnonzero(changed)[1:])
+
+
+class ReportWriter:
+    """streaming variants report (the report of generate_report, written as samples finish)
+
+    The variants of each sample may be added in any order, e.g. as their variant calls
+    complete. Each sample section is spooled to a temporary file next to the report
+    as it is added; only compact per-color aggregates are kept in memory (each distinct
+    variant of a color and the first sample & row it was seen in), with the spool offsets
+    of each sample. close() writes the color section, then copies the sample sections
+    in sample file order, so memory does not grow with the number of samples.
+    """
+
+    def __init__(self, samples: SampleFile, report_file: str):
+        """constructor
+
+        Args:
+            samples (SampleFile): sample object
+            report_file (str): path to write report
+        """
+        self._samples = samples
+        self._report_file = report_file
+        self._sample_colors = {
+            name: (color, rank)
+            for (color, names) in samples.color_names.items()
+            for (rank, name) in enumerate(names)
+        }
+        self._color_variants = {color: {} for color in samples.color_names}
+        self._sections = {}
+        self._contigs = {}
+        self._spool = tempfile.TemporaryFile(
+            dir=os.path.dirname(os.path.abspath(report_file))
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._spool.close()
+
+    def add(self, name: str, variants: list) -> None:
+        """add the variants of a sample
+
+        Samples which are not in the sample file are ignored.
+
+        Args:
+            name (str): sample name
+            variants (list): list of VariantFrequency tuples (see call_variants)
+
+        Raises:
+            ValueError: if the sample was already added
+        """
+        if name in self._sections:
+            raise ValueError(f"variants of {name} were already added")
+        if name not in self._sample_colors:
+            return
+        (color, rank) = self._sample_colors[name]
+        color_variants = self._color_variants[color]
+        lines = []
+        for (row, variant) in enumerate(variants):
+            contig = self._contigs.setdefault(variant.contig, len(self._contigs))
+            key = (contig, variant.position, variant.wildtype, variant.mutation)
+            color_variants[key] = min(color_variants.get(key, (rank, row)), (rank, row))
+            lines.append(
+                f"{contig}\t{variant.position}\t{variant.nreads}\t{_mutation_count(variant)}\t{variant.mutation}\n"
+            )
+        section = "".join(lines).encode()
+        self._sections[name] = (self._spool.tell(), len(section), len(lines))
+        self._spool.write(section)
+
+    def close(self) -> None:
+        """write the report"""
+        if self._spool.closed:
+            return
+        contigs = list(self._contigs)
+
+        def location(contig: int, position) -> str:
+            return f"{contigs[contig]}:{position}" if len(contigs) > 1 else position
+
+        with open(self._report_file, "w") as f:
+
+            # the variants of each color, in order of first occurrence
+            for (color, color_variants) in self._color_variants.items():
+
+                # in the event a color has # SNPs != 1
+                if len(color_variants) != 1:
+                    f.write(f"{len(color_variants)} variants identified for {color}\n")
+
+                for (contig, position, wildtype, mutation) in sorted(
+                    color_variants, key=color_variants.get
+                ):
+                    msg = f"The {color} mold was caused by a mutation in position {location(contig, position)}.  The wildtype base was {wildtype} and the mutation was {mutation}\n"
+                    f.write(msg)
+
+            f.write("\n")
+
+            # copy the per-sample sections in sample file order
+            for (name, color) in self._samples.name_color.items():
+                (offset, size, count) = self._sections.get(name, (0, 0, 0))
+
+                # in the event a name has # SNPs != 1
+                if count != 1:
+                    f.write(f"{count} variants identified for {name}\n")
+
+                self._spool.seek(offset)
+                for line in self._spool.read(size).decode().splitlines():
+                    (contig, position, depth, mutation_count, mutation) = line.split("\t")
+                    frequency = int(mutation_count) / max(int(depth), 1)
+                    msg = f"Sample {name} had a {color} mold, {depth} reads, and had {frequency:.0%} of the reads at position {location(int(contig), position)} had the mutation {mutation}\n"
+                    f.write(msg)
+        self._spool.close()
+
+
+#
+# code from the week6 necessary_scripts folder
+#
+
+
+class ParseFastQ(object):
+    """Returns a read-by-read fastQ parser analogous to file.readline()"""
+
+    def __init__(self, filePath, headerSymbols=["@", "+"]):
+        """Returns a read-by-read fastQ parser analogous to file.readline().
+        Exmpl: parser.next()
+        -OR-
+        Its an iterator so you can do:
+        for rec in parser:
+            ... do something with rec ...
+
+        rec is tuple: (seqHeader,seqStr,qualHeader,qualStr)
+        """
+        if filePath.endswith(".gz"):
+            self._file = gzip.open(filePath, "rt")
+        else:
+            self._file = open(filePath, "r")
+        self._currentLineNumber = 0
+        self._hdSyms = headerSymbols
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Reads in next element, parses, and does minimal verification.
+        Returns: tuple: (seqHeader,seqStr,qualHeader,qualStr)"""
+        # ++++ Get Next Four Lines ++++
+        elemList = []
+        for i in range(4):
+            line = self._file.readline()
+            self._currentLineNumber += 1  ## increment file position
+            if line:
+                elemList.append(line.strip("\n"))
+            else:
+                elemList.append(None)
+
+        # ++++ Check Lines For Expected Form ++++
+        trues = [bool(x) for x in elemList].count(True)
+        nones = elemList.count(None)
+        # -- Check for acceptable end of file --
+        if nones == 4:
+            raise StopIteration
+        # -- Make sure we got 4 full lines of data --
+        assert trues == 4, (
+            "** ERROR: It looks like I encountered a premature EOF or empty line.\n\
+               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
+            % (self._currentLineNumber)
+        )
+        # -- Make sure we are in the correct "register" --
+        assert elemList[0].startswith(self._hdSyms[0]), (
+            "** ERROR: The 1st line in fastq element does not start with '%s'.\n\
+               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
+            % (self._hdSyms[0], self._currentLineNumber)
+        )
+        assert elemList[2].startswith(self._hdSyms[1]), (
+            "** ERROR: The 3rd line in fastq element does not start with '%s'.\n\
+               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
+            % (self._hdSyms[1], self._currentLineNumber)
+        )
+        # -- Make sure the seq line and qual line have equal lengths --
+        assert len(elemList[1]) == len(elemList[3]), (
+            "** ERROR: The length of Sequence data and Quality data of the last record aren't equal.\n\
+               Please check FastQ file near line number %s (plus or minus ~4 lines) and try again**"
+            % (self._currentLineNumber)
+        )
+
+        # ++++ Return fatsQ data as tuple ++++
+        return tuple(elemList)
+
+
+def pileup(
+    indexed_bam_file: str,
+    region: str = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+) -> list:
+    """Generate pileup and identify positons where > 1 base is present
+
+    Count the number of bases of each type at each position (see count_bases).
+    If more than one base is observed, create a tuple of position, # reads, & base frequency
+    and add it to a list of such tuples
+
+    # reads is the number of A/C/G/T bases counted at the position
+    (reads with a deletion or an N at the position are not included).
+
+    Args:
+        indexed_bam_file (str): path to indexed bam file
+        region (str, optional): samtools-style region (contig[:start-stop]). Defaults to None (all contigs).
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+
+    Returns:
+        list: tuples (position, # reads, frequencies)
+    """
+    variants = []
+    for (start, counts) in count_bases(
+        indexed_bam_file, region, min_base_quality
+    ).values():
+        nreads = counts.sum(axis=0)
+        nbases = np.count_nonzero(counts, axis=0)
+        # found more than 1 base at the position
+        for offset in np.flatnonzero(nbases > 1):
+            # need position, count, and base frequency
+            n = int(nreads[offset])
+            frequencies = [
+                (base, int(counts[PILEUP_BASES.index(base), offset]) / n)
+                for base in ["A", "C", "T", "G"]
+            ]
+            variants.append((start + int(offset), n, tuple(frequencies)))
+
+    return variants
+
+
+def count_bases(
+    indexed_bam_file: str,
+    region: str = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+) -> dict:
+    """count the bases at every position in one pass over the reads
+
+    Uses pysam's count_coverage, which accumulates the counts in arrays
+    instead of walking every read of every pileup column in python.
+    Reads are filtered as in a pysam pileup (unmapped, secondary, QC-fail
+    and duplicate reads are skipped).
+
+    Args:
+        indexed_bam_file (str): path to indexed bam file
+        region (str, optional): samtools-style region (contig[:start-stop]). Defaults to None (all contigs).
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+
+    Returns:
+        dict: {contig: (0-based start, (4 x length) count array in PILEUP_BASES order)}
+    """
+    base_counts = {}
+    with pysam.AlignmentFile(indexed_bam_file, "rb") as samfile:
+        if region is None:
+            regions = [
+                (contig, 0, samfile.get_reference_length(contig))
+                for contig in samfile.references
+            ]
+        else:
+            (contig, start, stop) = _parse_region(region)
+            regions = [(contig, start, stop or samfile.get_reference_length(contig))]
+
+        for (contig, start, stop) in regions:
+            coverage = samfile.count_coverage(
+                contig,
+                start,
+                stop,
+                quality_threshold=min_base_quality,
+                read_callback="all",
+            )
+            base_counts[contig] = (start, np.array(coverage, dtype=np.int64))
+            LOGGER.debug(
+                f"{indexed_bam_file} {contig}:{start + 1}-{stop} max coverage {base_counts[contig][1].sum(axis=0).max(initial=0)}"
+            )
+
+    return base_counts
+
+
+def count_indels(
+    indexed_bam_file: str,
+    region: str = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+) -> dict:
+    """count the insertions and deletions in one pass over the reads
+
+    An indel is counted at its anchor: the aligned base before it.
+    Reads are filtered as in count_bases, and an indel is only counted
+    if its anchor base is (A/C/G/T and at least min_base_quality), so indel
+    reads are a subset of the reads counted at the anchor by count_bases.
+    Only reads with an I or D in their CIGAR are walked.
+
+    Args:
+        indexed_bam_file (str): path to indexed bam file
+        region (str, optional): samtools-style region (contig[:start-stop]). Defaults to None (all contigs).
+        min_base_quality (int, optional): minimum anchor base quality. Defaults to MIN_BASE_QUALITY.
+
+    Returns:
+        dict: {contig: Counter of {(0-based anchor position, # deleted bases, inserted bases): # reads}}
+    """
+    indel_counts = {}
+    with pysam.AlignmentFile(indexed_bam_file, "rb") as samfile:
+        if region is None:
+            regions = [
+                (contig, 0, samfile.get_reference_length(contig))
+                for contig in samfile.references
+            ]
+        else:
+            (contig, start, stop) = _parse_region(region)
+            regions = [(contig, start, stop or samfile.get_reference_length(contig))]
+
+        for (contig, start, stop) in regions:
+            counts = collections.Counter()
+            for read in samfile.fetch(contig, start, stop):
+                if read.flag & SKIPPED_READ_FLAGS or not any(
+                    op in INDEL_OPS for (op, _) in read.cigartuples
+                ):
+                    continue
+                seq = read.query_sequence
+                quals = read.query_qualities
+                (ref_pos, query_pos, previous_op) = (read.reference_start, 0, None)
+                for (op, length) in read.cigartuples:
+                    if (
+                        op in INDEL_OPS
+                        and previous_op in ALIGNED_OPS
+                        and start <= ref_pos - 1 < stop
+                        and seq[query_pos - 1] in PILEUP_BASES
+                        and (quals is None or quals[query_pos - 1] >= min_base_quality)
+                    ):
+                        if op == pysam.CINS:
+                            key = (ref_pos - 1, 0, seq[query_pos : query_pos + length])
+                        else:
+                            key = (ref_pos - 1, length, "")
+                        counts[key] += 1
+                    if op in ALIGNED_OPS or op == pysam.CINS or op == pysam.CSOFT_CLIP:
+                        query_pos += length
+                    if op in ALIGNED_OPS or op == pysam.CDEL or op == pysam.CREF_SKIP:
+                        ref_pos += length
+                    previous_op = op
+            indel_counts[contig] = counts
+
+    return indel_counts
+
+
+def call_alleles(
+    indexed_bam_file: str,
+    reference_fasta: ReferenceFasta,
+    region: str = None,
+    min_allele_freq: float = 0.0,
+    min_depth: int = 1,
+    min_base_quality: int = MIN_BASE_QUALITY,
+) -> list:
+    """call every non-reference allele (substitution, insertion or deletion) passing the thresholds
+
+    The base counts (see count_bases) are filtered as arrays, and the indel counts
+    (see count_indels) as they are read, so positions which fail the thresholds
+    (e.g. sequencing noise) are never turned into variants.
+    A site with several passing alleles gives one variant per allele.
+
+    Depth is the # of A/C/G/T bases counted at the position (at the anchor for indels).
+    Alleles are written as in a VCF: a substitution is a single base; an indel
+    is anchored on the reference base before it (e.g. wildtype GAT, mutation G
+    for a deletion of AT).
+
+    Args:
+        indexed_bam_file (str): path to indexed bam file
+        reference_fasta (ReferenceFasta): reference (for wildtype bases)
+        region (str, optional): samtools-style region (contig[:start-stop]). Defaults to None (all contigs).
+        min_allele_freq (float, optional): minimum fraction of the reads with the allele. Defaults to 0.0 (any read).
+        min_depth (int, optional): minimum # reads at the position. Defaults to 1.
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+
+    Returns:
+        list: tuples (contig, 0-based position, # reads, frequencies, wildtype, mutation) in position order;
+            frequencies are those of A/C/T/G, and for an indel also of the indel (see allele_label)
+    """
+    base_index = np.full(256, -1, dtype=np.int64)
+    for (i, base) in enumerate(PILEUP_BASES):
+        base_index[ord(base)] = i
+    base_counts = count_bases(indexed_bam_file, region, min_base_quality)
+    indel_counts = count_indels(indexed_bam_file, region, min_base_quality)
+
+    alleles = []
+    for (contig, (start, counts)) in base_counts.items():
+        sequence = reference_fasta.sequence(contig, start, start + counts.shape[1])
+        reference = base_index[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+        nreads = counts.sum(axis=0)
+        covered = nreads >= max(min_depth, 1)
+
+        # substitutions: (base, offset) pairs of non-reference bases passing the thresholds
+        passing = (
+            covered
+            & (counts > 0)
+            & (counts / np.maximum(nreads, 1) >= min_allele_freq)
+            & (np.arange(len(PILEUP_BASES))[:, None] != reference)
+        )
+        calls = [
+            (int(offset), 1, PILEUP_BASES[base], "")
+            for (base, offset) in zip(*np.nonzero(passing))
+        ]
+
+        # indels: anchored on a covered position, passing the frequency threshold
+        for ((position, deleted, inserted), count) in indel_counts[contig].items():
+            offset = position - start
+            if covered[offset] and count / nreads[offset] >= min_allele_freq:
+                calls.append((offset, 1 + deleted, None, inserted))
+
+        for (offset, ref_length, base, inserted) in sorted(
+            calls, key=lambda call: (call[0], call[1], call[2] or "", call[3])
+        ):
+            n = int(nreads[offset])
+            frequencies = [
+                (b, int(counts[PILEUP_BASES.index(b), offset]) / n)
+                for b in ["A", "C", "T", "G"]
+            ]
+            if base is None:
+                wildtype = reference_fasta.sequence(
+                    contig, start + offset, start + offset + ref_length
+                )
+                mutation = wildtype[0] + inserted
+                count = indel_counts[contig][(start + offset, ref_length - 1, inserted)]
+                frequencies.append((allele_label(wildtype, mutation), count / n))
+            else:
+                (wildtype, mutation) = (sequence[offset], base)
+            alleles.append(
+                (contig, start + offset, n, tuple(frequencies), wildtype, mutation)
+            )
+
+    return alleles
+
+
+def allele_label(wildtype: str, mutation: str) -> str:
+    """key of an allele in a variant's frequencies
+
+    A substitution is its base; an indel is written as in samtools mpileup:
+    +<inserted bases> or -<deleted bases>.
+
+    Args:
+        wildtype (str): wildtype allele
+        mutation (str): mutation allele
+
+    Returns:
+        str: label
+    """
+    if len(wildtype) == len(mutation):
+        return mutation
+    if len(mutation) > len(wildtype):
+        return "+" + mutation[len(wildtype) :]
+    return "-" + wildtype[len(mutation) :]
+
+
+def low_quality_table(min_quality: int = None) -> np.ndarray:
+    """lookup table of the low-quality score characters (see trim_positions)
+
+    Args:
+        min_quality (int, optional): Phred scores below this are low quality. Defaults to None (D and F).
+
+    Returns:
+        np.ndarray: boolean array indexed by quality character
+    """
+    table = np.zeros(256, dtype=bool)
+    if min_quality is None:
+        table[np.frombuffer(LOW_QUALITY_SCORES, dtype=np.uint8)] = True
+    else:
+        table[PHRED_OFFSET : PHRED_OFFSET + min_quality] = True
+    return table
+
+
+def trim_positions(quals: typing.Sequence, low_quality: np.ndarray) -> np.ndarray:
+    """find where to trim a batch of reads: the 1st pair of consecutive low-quality scores
+
+    All quality strings are scanned at once as one byte array;
+    pairs which span two reads are discarded and the first pair of each read is kept.
+    A pair at position 0 leaves the read untrimmed (as the original [DF]{2} search did).
+
+    Args:
+        quals (typing.Sequence): quality strings (bytes)
+        low_quality (np.ndarray): low-quality lookup table (see low_quality_table)
+
+    Returns:
+        np.ndarray: trim position of each read (its length if it is not trimmed)
+    """
+    lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+    ends = np.cumsum(lengths)
+    cuts = lengths.copy()
+
+    low = low_quality[np.frombuffer(b"".join(quals), dtype=np.uint8)]
+    pairs = np.flatnonzero(low[:-1] & low[1:])
+    reads = np.searchsorted(ends, pairs, side="right")
+    within_read = pairs + 1 < ends[reads]
+    (pairs, reads) = (pairs[within_read], reads[within_read])
+
+    # pairs are in order, so the 1st pair of a read is where the read index changes
+    first = np.flatnonzero(np.diff(reads, prepend=-1))
+    (reads, offsets) = (reads[first], pairs[first] - (ends - lengths)[reads[first]])
+    trimmed = offsets > 0
+    cuts[reads[trimmed]] = offsets[trimmed]
+    return cuts
+
+
+def compress_fastq(data: bytes, compression: str, level: int = COMPRESS_LEVEL) -> bytes:
+    """compress fastq data as self-contained gzip member(s)
+
+    Members can simply be concatenated (gzip readers decompress all members),
+    so chunks of a fastq can be compressed independently, e.g. by worker processes.
+    - gzip: one member
+    - bgzf: BGZF blocks (gzip members of <= BGZF_BLOCK_SIZE bytes with the block size
+      in the header) as written by bgzip; the file must end with BGZF_EOF
+
+    Args:
+        data (bytes): uncompressed data
+        compression (str): one of FASTQ_COMPRESSIONS
+        level (int, optional): compression level (1-9). Defaults to COMPRESS_LEVEL.
+
+    Raises:
+        ValueError: if the compression is unknown
+
+    Returns:
+        bytes: compressed data (data itself for "none")
+    """
+    if compression == "none" or not data:
+        return data
+    if compression == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    if compression == "bgzf":
+        blocks = []
+        for start in range(0, len(data), BGZF_BLOCK_SIZE):
+            block = data[start : start + BGZF_BLOCK_SIZE]
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            blocks.append(
+                b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+                + (len(cdata) + 25).to_bytes(2, "little")  # block size - 1
+                + cdata
+                + zlib.crc32(block).to_bytes(4, "little")
+                + len(block).to_bytes(4, "little")
+            )
+        return b"".join(blocks)
+    raise ValueError(f"unknown compression {compression}")
+
+
+#
+# top-level functions
+#
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Parses input arguments
+
+    Returns:
+        argparse.Namespace: argument object
+    """
+
+    REPORT_DEFAULT = "report.txt"
+    FASTQS_DEFAULT = "fastqs"
+    BAMS_DEFAULT = "bams"
+    LOG_DEFAULT = "pipeline.log"
+    BATCH_DIR_DEFAULT = "batch"
+    THREADS_DEFAULT = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(
+        description="Demultiplex and trim reads by barcode"
+    )
+    parser.add_argument("fastq", nargs="?", help="barcoded fastq sequence data")
+    parser.add_argument("samples", nargs="?", help="tab-delimited sample file")
+    parser.add_argument("reference", nargs="?", help="fasta reference")
+    parser.add_argument(
+        "--batch",
+        help="batch file (tab-delimited: Name, Fastq, Samples, Reference) of runs to process together, instead of fastq/samples/reference",
+        default=None,
+    )
+    parser.add_argument(
+        "--batch-dir",
+        dest="batch_dir",
+        help=f"batch output folder: a folder of fastqs, bams, report & variants per run, and a summary (default {BATCH_DIR_DEFAULT})",
+        default=BATCH_DIR_DEFAULT,
+    )
+    parser.add_argument(
+        "--fastqs-dir",
+        dest="fastqs_dir",
+        help="output fastq folder",
+        default=FASTQS_DEFAULT,
+    )
+    parser.add_argument(
+        "--bams-dir", dest="bams_dir", help="output bam folder", default=BAMS_DEFAULT
+    )
+    parser.add_argument("--report", help="output fastq folder", default=REPORT_DEFAULT)
+    parser.add_argument(
+        "--vcf", help="also write the variants as a multi-sample VCF", default=None
+    )
+    parser.add_argument(
+        "--tsv",
+        help="also write the variants as a tab-delimited table (one row per sample and variant)",
+        default=None,
+    )
+    parser.add_argument(
+        "--reindex", action="store_true", help="force re-indexing of reference"
+    )
+    parser.add_argument(
+        "--index-cache",
+        dest="index_cache",
+        help="shared bwa index cache directory (indexes keyed by reference content & bwa version; default: index next to the reference)",
+        default=None,
+    )
+    parser.add_argument(
+        "--index-cache-entries",
+        dest="index_cache_entries",
+        type=int,
+        help=f"max # of indexes kept in the cache (least recently used are evicted; default {INDEX_CACHE_ENTRIES})",
+        default=INDEX_CACHE_ENTRIES,
+    )
+    parser.add_argument(
+        "--index-cache-size",
+        dest="index_cache_size",
+        type=_parse_memory,
+        help="max total size of the index cache, e.g. 20G (default: unlimited)",
+        default=None,
+    )
+    parser.add_argument("--force", action="store_true", help="overwrite outputs")
+    parser.add_argument(
+        "--manifest",
+        help="stage manifest (JSON): record completed stages and samples, and skip the up-to-date ones on re-runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--savesam", action="store_true", help="save intermediate SAM (debugging)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="pipe alignments straight into sorted bam files (no intermediate SAM/BAM)",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        dest="buffer_size",
+        type=int,
+        help=f"write buffer size per output fastq in bytes (default {FASTQ_BUFFER_SIZE})",
+        default=FASTQ_BUFFER_SIZE,
+    )
+    parser.add_argument(
+        "--max-open-fastqs",
+        dest="max_open_fastqs",
+        type=int,
+        help=f"maximum number of simultaneously open output fastqs (default {MAX_OPEN_FASTQS})",
+        default=MAX_OPEN_FASTQS,
+    )
+    parser.add_argument(
+        "--barcode-mismatches",
+        dest="barcode_mismatches",
+        type=int,
+        help="correct barcodes within this many substitutions of exactly one sample (default 0)",
+        default=0,
+    )
+    parser.add_argument(
+        "--min-quality",
+        dest="min_quality",
+        type=int,
+        help="trim reads from the first 2 consecutive bases with Phred quality below this (default: trim at consecutive D/F scores)",
+        default=None,
+    )
+    parser.add_argument(
+        "--min-allele-freq",
+        dest="min_allele_freq",
+        type=_parse_fraction,
+        help="call every substitution/insertion/deletion allele in at least this fraction of the reads (default: report positions with > 1 base)",
+        default=None,
+    )
+    parser.add_argument(
+        "--min-depth",
+        dest="min_depth",
+        type=int,
+        help="with allele calling, minimum # reads at a position (default 1; implies allele calling)",
+        default=None,
+    )
+    parser.add_argument(
+        "--min-base-quality",
+        dest="min_base_quality",
+        type=int,
+        help=f"minimum base quality counted in the pileup (default {MIN_BASE_QUALITY})",
+        default=MIN_BASE_QUALITY,
+    )
+    parser.add_argument(
+        "--compress",
+        choices=FASTQ_COMPRESSIONS,
+        help="compression of the trimmed fastqs (default none)",
+        default="none",
+    )
+    parser.add_argument(
+        "--compress-level",
+        dest="compress_level",
+        type=int,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        help=f"compression level of the trimmed fastqs (default {COMPRESS_LEVEL})",
+        default=COMPRESS_LEVEL,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of worker processes for demultiplexing and variant calling (default 1)",
+        default=1,
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help=f"total threads for alignment (default {THREADS_DEFAULT})",
+        default=THREADS_DEFAULT,
+    )
+    parser.add_argument(
+        "--memory",
+        type=_parse_memory,
+        help="total memory for concurrent bam sorting, e.g. 8G (default: 3/4 of available memory)",
+        default=None,
+    )
+    parser.add_argument(
+        "--sort-memory",
+        dest="sort_memory",
+        type=_parse_memory,
+        help="samtools sort memory per thread, e.g. 512M (default: --memory / --threads, within 16M-1G)",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help=f"write per-stage timings and read/barcode counts to {METRICS_FILE} next to the report",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="debug mode (for reporting)"
+    )
+    parser.add_argument(
+        "--logfile", help="log file name", default=LOG_DEFAULT
+    )
+    args = parser.parse_args()
+    inputs = [args.fastq, args.samples, args.reference]
+    if args.batch is None and None in inputs:
+        parser.error("fastq, samples and reference are required (or --batch)")
+    if args.batch is not None:
+        if inputs != [None] * 3:
+            parser.error("fastq, samples and reference are given by the --batch file")
+        if args.manifest or args.vcf or args.tsv:
+            parser.error("--manifest, --vcf and --tsv are not supported with --batch")
+    args.metrics_file = (
+        os.path.join(
+            args.batch_dir if args.batch else os.path.dirname(args.report),
+            METRICS_FILE,
+        )
+        if args.metrics
+        else None
+    )
+    if args.memory is None:
+        args.memory = _available_memory() * 3 // 4
+    args.call_thresholds = (
+        None
+        if args.min_allele_freq is None and args.min_depth is None
+        else CallThresholds(
+            min_allele_freq=args.min_allele_freq or 0.0,
+            min_depth=args.min_depth or 1,
+        )
+    )
+
+    #
+    # setup log file
+    #
+    print(f"Logging to {args.logfile} with debug: {args.debug}")
+    _setup_logger(args.debug, args.logfile)
+
+    LOGGER.info("-- START ANALYSIS --")
+    LOGGER.info("-- Parse and validate input --")
+
+    # echo inputs
+    LOGGER.info(f"batch file: {args.batch}")
+    LOGGER.info(f"batch dir: {args.batch_dir}")
+    LOGGER.info(f"sequencing fastq: {args.fastq}")
+    LOGGER.info(f"sample file: {args.samples}")
+    LOGGER.info(f"reference fasta: {args.reference}")
+    LOGGER.info(f"fastqs dir: {args.fastqs_dir}")
+    LOGGER.info(f"bams dir: {args.bams_dir}")
+    LOGGER.info(f"report file: {args.report}")
+    LOGGER.info(f"vcf file: {args.vcf}")
+    LOGGER.info(f"tsv file: {args.tsv}")
+    LOGGER.info(f"re-index reference: {args.reindex}")
+    LOGGER.info(
+        f"bwa index cache: {args.index_cache} (max {args.index_cache_entries} entries, size {args.index_cache_size})"
+    )
+    LOGGER.info(f"force: {args.force}")
+    LOGGER.info(f"manifest: {args.manifest}")
+    LOGGER.info(f"save intermdiate SAM: {args.savesam}")
+    LOGGER.info(f"stream alignments: {args.stream}")
+    LOGGER.info(f"fastq buffer size: {args.buffer_size}")
+    LOGGER.info(f"max open fastqs: {args.max_open_fastqs}")
+    LOGGER.info(f"barcode mismatches: {args.barcode_mismatches}")
+    LOGGER.info(f"min quality: {args.min_quality}")
+    LOGGER.info(f"allele calling thresholds: {args.call_thresholds}")
+    LOGGER.info(f"min base quality: {args.min_base_quality}")
+    LOGGER.info(f"compression: {args.compress} (level {args.compress_level})")
+    LOGGER.info(f"workers: {args.workers}")
+    LOGGER.info(f"threads: {args.threads}")
+    LOGGER.info(f"memory: {_samtools_memory(args.memory)}")
+    if args.sort_memory is None:
+        args.sort_memory = _sort_memory_per_thread(args.memory, args.threads)
+    LOGGER.info(f"sort memory per thread: {_samtools_memory(args.sort_memory)}")
+    LOGGER.info(f"metrics file: {args.metrics_file}")
+    LOGGER.info(f"debug: {args.debug}")
+    LOGGER.info(f"log file: {args.logfile}")
+
+    #
+    # input/output validation
+    #
+
+    # check input existence
+    for input_file in [args.batch] if args.batch else inputs:
+        if not os.path.exists(input_file):
+            LOGGER.info(f"{input_file} not found.  Exiting...")
+            sys.exit(1)
+
+    # don't overwrite existing intermediates/outputs unless forced
+    # (with a manifest, existing outputs are re-used where they are up to date)
+    if args.batch:
+        outputs = [args.batch_dir]
+    else:
+        outputs = [
+            args.fastqs_dir,
+            args.bams_dir,
+            args.report,
+            args.vcf,
+            args.tsv,
+            args.manifest,
+            args.metrics_file,
+        ]
+    for output in outputs:
+        if output is None or (args.manifest and not args.force):
+            continue
+        if os.path.exists(output):
+            if not args.force:
+                LOGGER.info(
+                    f"{output} already exists.  Use --force to overwrite.  Exiting..."
+                )
+                sys.exit(1)
+            else:
+                LOGGER.info(f"Deleting existing {output} ...")
+                if os.path.isdir(output):
+                    _rm_tree(output)
+                else:
+                    pathlib.Path(output).unlink()
+
+    return args
+
+
+def verify_prerequisites() -> None:
+    """Verify required third-party applications are present"""
+    for app in ["bwa", "samtools"]:
+        cmd = ["which", app]
+        _run_subprocess(cmd, None)
+
+
+def create_fastqs(
+    samples: SampleFile,
+    fastq_file: str,
+    fastqs_dir: str,
+    buffer_size: int = FASTQ_BUFFER_SIZE,
+    max_open: int = MAX_OPEN_FASTQS,
+    workers: int = 1,
+    min_quality: int = None,
+    compression: str = "none",
+    compress_level: int = COMPRESS_LEVEL,
+) -> DemultiplexStats:
+    """demultplex a fastq by barcode; trim barcodes and low-quality bases
+       (1st occurrence of consecutive D/F quality scores, or of scores below min_quality)
+       and write the new per-barcode fastqs named <name>_trimmed.fastq
+       to the output folder. (name = Name field from sample file)
+
+       - Assumes barcodes are of the same length - will raise an exception otherwise
+       - Assumes barcodes start at the beginning of the read
+       - Skips barcodes with no assigned name
+       - Barcodes within samples.max_mismatches of one sample are corrected (see SampleFile)
+       - Output is written in a single pass through a pool of buffered per-sample handles
+       - With workers > 1, chunks of the input are demultiplexed/trimmed by a process pool;
+         the input is read once by the main process (a gzipped input is decompressed
+         by a background thread)
+       - Outputs are optionally gzip or BGZF compressed (<name>_trimmed.fastq.gz);
+         each chunk is compressed by the process which trimmed it
+
+    Args:
+        samples (SampleFile): object representation of sample file
+        fastq_file (str): fastqs input sequence data
+        fastqs_dir (str): output folder of fastqs
+        buffer_size (int, optional): write buffer size per sample. Defaults to FASTQ_BUFFER_SIZE.
+        max_open (int, optional): maximum number of open sample fastqs. Defaults to MAX_OPEN_FASTQS.
+        workers (int, optional): number of worker processes. Defaults to 1.
+        min_quality (int, optional): Phred threshold for trimming. Defaults to None (D/F scores).
+        compression (str, optional): output compression, one of FASTQ_COMPRESSIONS. Defaults to "none".
+        compress_level (int, optional): output compression level. Defaults to COMPRESS_LEVEL.
+
+    Returns:
+        DemultiplexStats: per-sample counts and unassigned barcode counts
+    """
+
+    # setup
+    bc_lookup = {bc.encode(): name for (bc, name) in samples.bc_lookup.items()}
+    bc_exact = {bc.encode() for bc in samples.bc_name}
+    fastq_reader = FastqReader(fastq_file)
+    os.makedirs(fastqs_dir)
+    nreads = collections.Counter()
+    ncorrected = collections.Counter()
+    nbases = collections.Counter()
+    unassigned = collections.Counter()
+
+    # demultiplex/trim record-aligned chunks of the input (in parallel if requested);
+    # results come back in input order so each sample's fastq is written in read order
+    initargs = (
+        fastq_file,
+        bc_lookup,
+        bc_exact,
+        samples.bc_length,
+        low_quality_table(min_quality),
+        compression,
+        compress_level,
+    )
+    with contextlib.ExitStack() as stack:
+        if workers > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(
+                    workers,
+                    initializer=_init_demultiplex_worker,
+                    initargs=initargs,
+                )
+            )
+            results = _ordered_map(
+                executor, _demultiplex_chunk, fastq_reader.chunks(), 2 * workers
+            )
+        else:
+            _init_demultiplex_worker(*initargs)
+            results = map(_demultiplex_chunk, fastq_reader.chunks())
+
+        writers = stack.enter_context(
+            FastqWriterPool(fastqs_dir, buffer_size, max_open, compression)
+        )
+        for (sample_records, sample_counts, chunk_unassigned) in results:
+            for (name, records) in sample_records.items():
+                writers.write(name, records)
+            for (name, (count, corrected, bases)) in sample_counts.items():
+                nreads[name] += count
+                ncorrected[name] += corrected
+                nbases[name] += bases
+            unassigned.update(chunk_unassigned)
+
+    sample_counts = {}
+    for name in sorted(nreads):
+        sample_counts[name] = SampleCounts(
+            exact=nreads[name] - ncorrected[name],
+            corrected=ncorrected[name],
+            bases=nbases[name],
+        )
+        if samples.max_mismatches:
+            LOGGER.info(
+                f"{name}: {nreads[name]} reads ({sample_counts[name].exact} exact, {ncorrected[name]} corrected barcodes)"
+            )
+    # one summary instead of a line per unassigned read
+    unassigned = collections.Counter(
+        {bc.decode(): count for (bc, count) in unassigned.items()}
+    )
+    LOGGER.debug(
+        f"{sum(unassigned.values())} reads with {len(unassigned)} barcodes have no assigned sample ... skipped"
+    )
+    for (bc, count) in unassigned.most_common(TOP_UNASSIGNED_BARCODES):
+        LOGGER.debug(f"barcode {bc} has no assigned sample: {count} reads")
+    return DemultiplexStats(samples=sample_counts, unassigned=unassigned)
+
+
+def align_reads(
+    reference: str,
+    fastqs_dir: str,
+    bams_dir: str,
+    reindex=False,
+    threads: int = 1,
+    stream=False,
+    savesam=False,
+    sort_memory: int = SORT_MEMORY,
+    memory: int = None,
+    names: typing.Iterable = None,
+    index: str = None,
+) -> None:
     """aligns reads for each fastq and generate a SAM file
 
-        - if index file fa.amb exists, assume the index is already generated
+        - the reference is indexed in place unless its index files exist and are newer than it,
+          or an index is given (e.g. from a BwaIndexCache)
+        - samples are aligned concurrently within a budget of threads;
+          each sample's bwa mem -t threads are sized by its share of the fastq data
+          and samples are started largest first
+        - in streaming mode, bwa mem output is piped straight into samtools sort
+          and the sorted bam is indexed, so no SAM or unsorted BAM is written
+          (sam_to_bam is not needed); savesam keeps a copy of the SAM
+
+    Args:
+        reference (str): reference fasta
+        fastqs_dir (str): input trimmed fastqs (filename convention: name_trimmed.fastq)
+        bams_dir (str): output folder (filename convention: name.sam, or name_sorted.bam if streaming)
+        reindex (bool): force reference re-index (default False)
+        threads (int): total threads available for alignment (default 1)
+        stream (bool): stream alignments into sorted bam files (default False)
+        savesam (bool): streaming mode only - also write the SAM file (default False)
+        sort_memory (int): streaming mode only - samtools sort memory in bytes (default SORT_MEMORY)
+        memory (int): streaming mode only - total memory for concurrent sorts in bytes (default None: unlimited)
+        names (typing.Iterable): only align these samples (default None: all fastqs)
+        index (str): bwa index prefix (default None: index the reference in place)
+    """
+
+    # setup (the folder exists if only some samples are re-aligned)
+    os.makedirs(bams_dir, exist_ok=names is not None)
+
+    # index reference (if needed)
+    if index is None:
+        index = reference
+        if reindex or not _bwa_index_current(reference):
+            LOGGER.debug("generate index...")
+            cmd = ["bwa", "index", reference]
+            _run_subprocess(cmd, None)
+
+    # size each trimmed fastq
+    fastqs = _trimmed_fastqs(fastqs_dir)
+    fastq_sizes = {
+        name: os.path.getsize(fastq)
+        for (name, fastq) in fastqs.items()
+        if names is None or name in names
+    }
+    sample_threads = _split_threads(fastq_sizes, threads)
+
+    # call bwa mem on every trimmed fastq - write to a SAM file
+    jobs = _align_jobs(
+        index,
+        {
+            name: fastqs[name]
+            for name in sorted(fastq_sizes, key=fastq_sizes.get, reverse=True)
+        },
+        bams_dir,
+        sample_threads,
+        stream=stream,
+        savesam=savesam,
+        sort_memory=sort_memory,
+    )
+    usages = _run_jobs(jobs, threads, memory)
+
+    for job in jobs:
+        _log_alignment(job, usages[job.name], bams_dir, job.name, stream)
+
+
+def sam_to_bam(
+    bams_dir: str,
+    savesam=False,
+    threads: int = 1,
+    memory: int = None,
+    sort_memory: int = None,
+    names: typing.Iterable = None,
+) -> None:
+    """Convert sam files to sorted, indexed bam files
+
+    Takes a directory of sam files
+    For each sam file
+    (1) converts to bam file and deletes the sam file
+    (2) sorts and indexes the bam file and deletes the unsorted bam file
+
+    Deletion occurs immediately to minimize disk usage.
+
+    Samples are converted concurrently within the thread and memory budgets;
+    each sample gets samtools -@ threads in proportion to its SAM size,
+    and samtools sort -m memory per thread (sized from the budgets unless given).
+
+    Args:
+        bams_dir (str): working directory of sam/bam files
+        savesam (bool): do not delete intermediate SAM file (Defaults to False).
+        threads (int): total threads available (Defaults to 1).
+        memory (int): total memory available for sorting in bytes (Defaults to None: SORT_MEMORY per thread).
+        sort_memory (int): samtools sort memory per thread in bytes (Defaults to None: sized automatically).
+        names (typing.Iterable): only convert these samples (Defaults to None: all sam files).
+    """
+    sam_sizes = {}
+    for sam_filename in [f for f in os.listdir(bams_dir) if f.endswith(".sam")]:
+        name = os.path.splitext(sam_filename)[0]
+        if names is not None and name not in names:
+            continue
+        sam_sizes[name] = os.path.getsize(os.path.join(bams_dir, sam_filename))
+    sample_threads = _split_threads(sam_sizes, threads)
+
+    if sort_memory is None:
+        sort_memory = _sort_memory_per_thread(memory, threads)
+    LOGGER.debug(f"sort memory per thread: {_samtools_memory(sort_memory)}")
+
+    jobs = _sam_to_bam_jobs(
+        bams_dir,
+        sorted(sam_sizes, key=sam_sizes.get, reverse=True),
+        sample_threads,
+        sort_memory,
+        savesam=savesam,
+    )
+    results = _run_jobs(jobs, threads, memory)
+
+    for job in jobs:
+        (usage, bytes_written) = results[job.name]
+        _log_usage(f"converted {job.name}", usage, job.threads)
+        _log_bytes_written(job.name, bytes_written)
+
+
+def call_variants(
+    bams_dir: str,
+    reference: str,
+    workers: int = 1,
+    reindex: bool = False,
+    names: typing.Iterable = None,
+    thresholds: CallThresholds = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+    executor: concurrent.futures.Executor = None,
+) -> dict:
+    """Reports bases for each bam where there is more than 1 base at a position
+
+    Samples are independent; with workers > 1 they are processed by a process pool
+    (or by a given executor, e.g. one shared by several runs).
+    Samples are returned in bam file name order either way.
+
+    With thresholds, every substitution, insertion and deletion whose frequency and
+    depth pass them is reported instead, one variant per allele (see call_alleles).
+
+    Wildtype bases are read lazily from the reference through its .fai index
+    (created if missing or out of date), so the reference may have any number of contigs.
+
+    Args:
+        bams_dir (str): bam file directory (name_sorted.bam)
+        reference (str): reference fasta path
+        workers (int, optional): number of worker processes. Defaults to 1.
+        reindex (bool, optional): force re-indexing of the reference. Defaults to False.
+        names (typing.Iterable, optional): only call these samples. Defaults to None (all bam files).
+        thresholds (CallThresholds, optional): allele calling thresholds. Defaults to None (pileup calling).
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+        executor (concurrent.futures.Executor, optional): pool to process the samples (instead of workers). Defaults to None.
+
+    One could in principle get the wildtype from the bam file MD tag
+    which would mitigate the need to read the reference
+
+    Returns:
+        dict: dictionary of {name: list of VariantFrequency tuples}
+    """
+    sample_variants = dict(
+        iter_variants(
+            bams_dir,
+            reference,
+            workers=workers,
+            reindex=reindex,
+            names=names,
+            thresholds=thresholds,
+            min_base_quality=min_base_quality,
+            executor=executor,
+        )
+    )
+    return {
+        name: sample_variants[name]
+        for (name, _) in _sorted_bams(bams_dir, names)
+        if sample_variants[name]
+    }
+
+
+def iter_variants(
+    bams_dir: str,
+    reference: str,
+    workers: int = 1,
+    reindex: bool = False,
+    names: typing.Iterable = None,
+    thresholds: CallThresholds = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+    executor: concurrent.futures.Executor = None,
+) -> typing.Iterator[tuple]:
+    """Calls the variants of each bam (see call_variants), yielding each sample as soon as it finishes
+
+    With a pool, samples are yielded in completion order (otherwise in bam file name order),
+    so their results can be consumed (e.g. by a ReportWriter) while others are still running.
+    Samples without variants are yielded too.
+
+    Args:
+        bams_dir (str): bam file directory (name_sorted.bam)
+        reference (str): reference fasta path
+        workers (int, optional): number of worker processes. Defaults to 1.
+        reindex (bool, optional): force re-indexing of the reference. Defaults to False.
+        names (typing.Iterable, optional): only call these samples. Defaults to None (all bam files).
+        thresholds (CallThresholds, optional): allele calling thresholds. Defaults to None (pileup calling).
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+        executor (concurrent.futures.Executor, optional): pool to process the samples (instead of workers). Defaults to None.
+
+    Yields:
+        tuple: (name, list of VariantFrequency tuples)
+    """
+
+    # index the reference once up front (workers only read the index)
+    ReferenceFasta.index(reference, reindex=reindex)
+
+    bamfiles = _sorted_bams(bams_dir, names)
+    call = functools.partial(
+        _call_sample_variants,
+        reference=reference,
+        thresholds=thresholds,
+        min_base_quality=min_base_quality,
+    )
+    with contextlib.ExitStack() as stack:
+        if executor is None and workers > 1 and len(bamfiles) > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(min(workers, len(bamfiles)))
+            )
+        if executor is not None:
+            futures = {
+                executor.submit(call, bamfile): name for (name, bamfile) in bamfiles
+            }
+            results = (
+                (futures.pop(future), future.result())
+                for future in concurrent.futures.as_completed(futures)
+            )
+        else:
+            results = ((name, call(bamfile)) for (name, bamfile) in bamfiles)
+
+        for (name, (variants_complete, elapsed)) in results:
+            LOGGER.debug(
+                f"Processed {name}{SORTED_BAM} in {elapsed:.3f}s: {len(variants_complete)} variants"
+            )
+            yield (name, variants_complete)
+
+
+def generate_report(variants: dict, samples: SampleFile, report_file: str) -> None:
+    """Generate variants report
+
+    - Iterates through all variants by color, and reports each variant.
+    - Iterates through all samples, and reports each variant.
+
+    Code does not assume only 1 variant per color or sample
+
+    If the variants are on more than one contig, positions are reported as contig:position
+
+    The report is written by a ReportWriter, which can also be fed samples as they finish.
+
+    Args:
+        variants (dict): dictionary of {name:list[VariantCalls]}
+        samples (SampleFile): sample object
+        report_file (str): path to write report
+    """
+    with ReportWriter(samples, report_file) as report:
+        for (name, name_variants) in variants.items():
+            report.add(name, name_variants)
+
+
+def write_vcf(table: VariantTable, vcf_file: str, reference: str = None) -> None:
+    """write the variants as a multi-sample VCF
+
+    One record per site (contig, position, wildtype, mutation), in contig & position order.
+    Per sample: depth (DP), reference & mutation allele depths (AD) and mutation frequency (AF);
+    samples without the variant are missing (.).
+
+    Args:
+        table (VariantTable): variants
+        vcf_file (str): output path
+        reference (str, optional): indexed reference fasta (for contig order & lengths). Defaults to None.
+    """
+    contig_lengths = {}
+    if reference is not None:
+        with ReferenceFasta(reference) as reference_fasta:
+            contig_lengths = {
+                contig: reference_fasta.length(contig)
+                for contig in reference_fasta.contigs
+            }
+    contigs = [str(contig) for contig in table.contigs]
+    if contig_lengths:
+        contigs = [contig for contig in contig_lengths if contig in contigs]
+    base_index = {base: i for (i, base) in enumerate(PILEUP_BASES)}
+
+    with open(vcf_file, "w") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write(f"##source={os.path.basename(__file__)}\n")
+        if reference is not None:
+            f.write(f"##reference=file://{os.path.abspath(reference)}\n")
+        for contig in contigs:
+            length = (
+                f",length={contig_lengths[contig]}" if contig in contig_lengths else ""
+            )
+            f.write(f"##contig=<ID={contig}{length}>\n")
+        f.write(
+            '##INFO=<ID=NS,Number=1,Type=Integer,Description="Number of samples with the variant">\n'
+            '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth of the samples with the variant">\n'
+            '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n'
+            '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths of the reference and alternate alleles">\n'
+            '##FORMAT=<ID=AF,Number=A,Type=Float,Description="Alternate allele frequency">\n'
+        )
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+            + table.samples
+        )
+        for rows in table.sites(contigs):
+            row = rows[0]
+            (wildtype, mutation) = (table.wildtype[row], table.mutation[row])
+            sample_fields = ["."] * len(table.samples)
+            for row in rows.tolist():
+                depth = int(table.depth[row])
+                # an indel's reads are counted in its anchor base
+                alt_depth = int(table.mutation_count[row])
+                ref_depth = (
+                    int(table.counts[row, base_index[wildtype[0]]])
+                    if wildtype[0] in base_index
+                    else 0
+                )
+                if len(wildtype) != len(mutation):
+                    ref_depth -= alt_depth
+                sample_fields[table.sample[row]] = (
+                    f"{depth}:{ref_depth},{alt_depth}:{alt_depth / max(depth, 1):.4g}"
+                )
+            writer.writerow(
+                [
+                    table.contigs[table.contig[rows[0]]],
+                    table.position[rows[0]],
+                    ".",
+                    wildtype,
+                    mutation,
+                    ".",
+                    ".",
+                    f"NS={len(rows)};DP={table.depth[rows].sum()}",
+                    "DP:AD:AF",
+                ]
+                + sample_fields
+            )
+
+
+def write_tsv(table: VariantTable, samples: SampleFile, tsv_file: str) -> None:
+    """write the variants as a tab-delimited table: one row per sample and variant
+
+    Args:
+        table (VariantTable): variants
+        samples (SampleFile): sample object (for colors)
+        tsv_file (str): output path
+    """
+    with open(tsv_file, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(
+            ["sample", "color", "contig", "position", "wildtype", "mutation", "depth"]
+            + list(PILEUP_BASES)
+            + ["mutation_frequency"]
+        )
+        for row in range(len(table)):
+            name = table.samples[table.sample[row]]
+            depth = int(table.depth[row])
+            writer.writerow(
+                [
+                    name,
+                    samples.name_color.get(name, ""),
+                    table.contigs[table.contig[row]],
+                    table.position[row],
+                    table.wildtype[row],
+                    table.mutation[row],
+                    depth,
+                ]
+                + table.counts[row].tolist()
+                + [f"{table.mutation_count[row] / depth:.4g}" if depth else ""]
+            )
+
+
+def write_batch_summary(
+    runs: list, samples: dict, stats: dict, variants: dict, summary_file: str
+) -> None:
+    """write the combined summary of a batch: one row per run and sample
+
+    Columns: run, sample, color, reads (assigned to the sample), variants (#),
+    and the variants as location wildtype>mutation (frequency), separated by ;
+
+    Args:
+        runs (list): BatchRun tuples
+        samples (dict): {run name: SampleFile}
+        stats (dict): {run name: DemultiplexStats}
+        variants (dict): {run name: {sample name: list of VariantFrequency tuples}}
+        summary_file (str): output path
+    """
+    with open(summary_file, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["run", "sample", "color", "reads", "variants", "mutations"])
+        for run in runs:
+            table = VariantTable.from_variants(variants[run.name])
+            sample_rows = table.sample_rows()
+            locations = table.locations()
+            frequencies = table.mutation_count / np.maximum(table.depth, 1)
+            for (name, color) in samples[run.name].name_color.items():
+                counts = stats[run.name].samples.get(name)
+                rows = sample_rows.get(name, np.arange(0)).tolist()
+                writer.writerow(
+                    [
+                        run.name,
+                        name,
+                        color,
+                        counts.exact + counts.corrected if counts else 0,
+                        len(rows),
+                        "; ".join(
+                            f"{locations[row]} {table.wildtype[row]}>{table.mutation[row]} ({frequencies[row]:.0%})"
+                            for row in rows
+                        ),
+                    ]
+                )
+
+
+#
+# pipeline stages (see StageManifest: with --manifest, up to date stages and samples are skipped)
+#
+
+
+def _demultiplex_stage(
+    args: argparse.Namespace,
+    samples: SampleFile,
+    manifest: StageManifest,
+    counters: dict = None,
+) -> tuple:
+    """create the trimmed fastqs unless the pooled fastq & barcodes are unchanged
+
+    Args:
+        args (argparse.Namespace): arguments
+        samples (SampleFile): sample object
+        manifest (StageManifest): stage manifest
+        counters (dict, optional): stage metrics to fill in. Defaults to None.
+
+    Returns:
+        tuple: (names of the samples with a trimmed fastq,
+                DemultiplexStats (from the manifest if up to date; None if not recorded))
+    """
+    counters = {} if counters is None else counters
+    inputs = {"fastq": manifest.checksum(args.fastq), "barcodes": samples.bc_name}
+    parameters = {
+        "low_quality": LOW_QUALITY_SCORES.decode(),
+        "min_quality": args.min_quality,
+        "compression": args.compress,
+        "compress_level": args.compress_level,
+        "barcode_mismatches": samples.max_mismatches,
+    }
+    if manifest.is_current("demultiplex", StageManifest.ALL, inputs, parameters):
+        LOGGER.info("fastqs are up to date")
+        counters["skipped"] = True
+        recorded = manifest.result("demultiplex", StageManifest.ALL)
+        stats = None
+        if recorded is not None:
+            stats = DemultiplexStats(
+                samples={
+                    name: SampleCounts(**counts)
+                    for (name, counts) in recorded["samples"].items()
+                },
+                unassigned=collections.Counter(recorded["unassigned"]),
+            )
+    else:
+        # fastqs are appended to, so start from scratch
+        if os.path.exists(args.fastqs_dir):
+            _rm_tree(args.fastqs_dir)
+        stats = create_fastqs(
+            samples,
+            args.fastq,
+            args.fastqs_dir,
+            buffer_size=args.buffer_size,
+            max_open=args.max_open_fastqs,
+            workers=args.workers,
+            min_quality=args.min_quality,
+            compression=args.compress,
+            compress_level=args.compress_level,
+        )
+        manifest.record(
+            "demultiplex",
+            StageManifest.ALL,
+            inputs,
+            parameters,
+            [os.path.join(args.fastqs_dir, f) for f in os.listdir(args.fastqs_dir)],
+            result={
+                "samples": {
+                    name: counts._asdict() for (name, counts) in stats.samples.items()
+                },
+                "unassigned": stats.unassigned,
+            },
+        )
+        counters["skipped"] = False
+
+        # counts of the reads processed (a skipped stage processed none)
+        assigned = sum(
+            counts.exact + counts.corrected for counts in stats.samples.values()
+        )
+        counters["reads"] = assigned + sum(stats.unassigned.values())
+        counters["assigned_reads"] = assigned
+        counters["corrected_reads"] = sum(
+            counts.corrected for counts in stats.samples.values()
+        )
+        counters["bases"] = sum(counts.bases for counts in stats.samples.values())
+    return (sorted(_trimmed_fastqs(args.fastqs_dir)), stats)
+
+
+def _align_stage(
+    args: argparse.Namespace,
+    names: list,
+    manifest: StageManifest,
+    counters: dict = None,
+    stats: DemultiplexStats = None,
+) -> None:
+    """create sorted bams of the samples whose trimmed fastq or reference changed
+
+    Args:
+        args (argparse.Namespace): arguments
+        names (list): sample names
+        manifest (StageManifest): stage manifest
+        counters (dict, optional): stage metrics to fill in. Defaults to None.
+        stats (DemultiplexStats, optional): read counts (for reads/sec). Defaults to None.
+    """
+    counters = {} if counters is None else counters
+    reference_inputs = {"reference": manifest.checksum(args.reference)}
+    # a changed reference must be re-indexed (cached indexes are keyed by content)
+    reindex = args.reindex or (
+        manifest.enabled
+        and args.index_cache is None
+        and not manifest.is_current("index", StageManifest.ALL, reference_inputs, {})
+    )
+    parameters = {"bwa_batch_bases": BWA_BATCH_BASES}
+    fastqs = _trimmed_fastqs(args.fastqs_dir)
+    sample_inputs = {
+        name: dict(
+            reference_inputs,
+            fastq=manifest.checksum(fastqs[name]),
+        )
+        for name in names
+    }
+    stale = _stale_samples(manifest, "align", sample_inputs, parameters)
+    counters["samples"] = len(names)
+    counters["processed_samples"] = len(stale)
+    if stats is not None:
+        counters["reads"] = sum(
+            stats.samples[name].exact + stats.samples[name].corrected
+            for name in stale
+            if name in stats.samples
+        )
+
+    with contextlib.ExitStack() as stack:
+        index = None
+        if args.index_cache is not None:
+            index_cache = BwaIndexCache(
+                args.index_cache,
+                max_entries=args.index_cache_entries,
+                max_bytes=args.index_cache_size,
+            )
+            index = stack.enter_context(
+                index_cache.open(args.reference, rebuild=args.reindex)
+            )
+        align_reads(
+            args.reference,
+            args.fastqs_dir,
+            args.bams_dir,
+            reindex=reindex,
+            threads=args.threads,
+            stream=args.stream,
+            savesam=args.savesam,
+            sort_memory=args.sort_memory,
+            memory=args.memory,
+            names=stale,
+            index=index,
+        )
+    if index is None:
+        manifest.record(
+            "index",
+            StageManifest.ALL,
+            reference_inputs,
+            {},
+            [args.reference + ext for ext in BWA_INDEX_EXTENSIONS],
+        )
+    if not args.stream:
+        LOGGER.info("-- Create sorted indexed bam files --")
+        sam_to_bam(
+            args.bams_dir,
+            savesam=args.savesam,
+            threads=args.threads,
+            memory=args.memory,
+            sort_memory=args.sort_memory,
+            names=stale,
+        )
+    for name in stale:
+        bamfile = os.path.join(args.bams_dir, f"{name}{SORTED_BAM}")
+        manifest.record(
+            "align", name, sample_inputs[name], parameters, [bamfile, f"{bamfile}.bai"]
+        )
+
+
+def _call_variants_stage(
+    args: argparse.Namespace,
+    names: list,
+    manifest: StageManifest,
+    counters: dict = None,
+) -> dict:
+    """call the variants of the samples whose bam or reference changed
+
+    The variants of up to date samples are read from the manifest.
+
+    Args:
+        args (argparse.Namespace): arguments
+        names (list): sample names
+        manifest (StageManifest): stage manifest
+        counters (dict, optional): stage metrics to fill in. Defaults to None.
+
+    Returns:
+        dict: dictionary of {name: list of VariantFrequency tuples} (see call_variants)
+    """
+    counters = {} if counters is None else counters
+    reference_checksum = manifest.checksum(args.reference)
+    sample_inputs = {
+        name: {
+            "bam": manifest.checksum(
+                os.path.join(args.bams_dir, f"{name}{SORTED_BAM}")
+            ),
+            "reference": reference_checksum,
+        }
+        for name in names
+    }
+    parameters = {
+        "thresholds": args.call_thresholds and args.call_thresholds._asdict(),
+        "min_base_quality": args.min_base_quality,
+    }
+    stale = _stale_samples(manifest, "call_variants", sample_inputs, parameters)
+    counters["samples"] = len(names)
+    counters["processed_samples"] = len(stale)
+
+    variants = call_variants(
+        args.bams_dir,
+        args.reference,
+        workers=args.workers,
+        reindex=args.reindex,
+        names=stale,
+        thresholds=args.call_thresholds,
+        min_base_quality=args.min_base_quality,
+    )
+    for name in names:
+        if name in stale:
+            manifest.record(
+                "call_variants",
+                name,
+                sample_inputs[name],
+                parameters,
+                result=[variant._asdict() for variant in variants.get(name, [])],
+            )
+        else:
+            recorded = manifest.result("call_variants", name)
+            if recorded:
+                variants[name] = [
+                    VariantFrequency(
+                        **dict(
+                            variant,
+                            frequencies=tuple(map(tuple, variant["frequencies"])),
+                        )
+                    )
+                    for variant in recorded
+                ]
+    counters["variants"] = sum(
+        len(name_variants) for name_variants in variants.values()
+    )
+    return {name: variants[name] for name in sorted(variants)}
+
+
+def _report_stage(
+    args: argparse.Namespace,
+    samples: SampleFile,
+    variants: dict,
+    manifest: StageManifest,
+    counters: dict = None,
+) -> None:
+    """write the report (and VCF/TSV exports) unless the sample file and variants are unchanged
+
+    Args:
+        args (argparse.Namespace): arguments
+        samples (SampleFile): sample object
+        variants (dict): dictionary of {name: list of VariantFrequency tuples}
+        manifest (StageManifest): stage manifest
+        counters (dict, optional): stage metrics to fill in. Defaults to None.
+    """
+    counters = {} if counters is None else counters
+    variants_json = json.dumps(
+        {
+            name: [variant._asdict() for variant in name_variants]
+            for (name, name_variants) in variants.items()
+        }
+    )
+    inputs = {
+        "samples": manifest.checksum(args.samples),
+        "variants": hashlib.md5(variants_json.encode()).hexdigest(),
+    }
+    parameters = {"vcf": args.vcf, "tsv": args.tsv}
+    outputs = [output for output in [args.report, args.vcf, args.tsv] if output]
+    counters["skipped"] = manifest.is_current(
+        "report", StageManifest.ALL, inputs, parameters
+    )
+    if counters["skipped"]:
+        LOGGER.info("report is up to date")
+        return
+
+    generate_report(variants, samples, args.report)
+    if args.vcf or args.tsv:
+        table = VariantTable.from_variants(variants)
+    if args.vcf:
+        write_vcf(table, args.vcf, args.reference)
+        LOGGER.info(f"VCF written to {args.vcf}")
+    if args.tsv:
+        write_tsv(table, samples, args.tsv)
+        LOGGER.info(f"TSV written to {args.tsv}")
+    manifest.record("report", StageManifest.ALL, inputs, parameters, outputs)
+
+
+def _stream_report_stage(
+    args: argparse.Namespace,
+    samples: SampleFile,
+    names: list,
+    counters: dict = None,
+) -> None:
+    """call the variants of the samples and stream them into the report as each sample finishes
+
+    Used when no manifest or VCF/TSV export needs all the variants at once,
+    so only the report's per-color aggregates are held in memory.
+
+    Args:
+        args (argparse.Namespace): arguments
+        samples (SampleFile): sample object
+        names (list): sample names
+        counters (dict, optional): stage metrics to fill in. Defaults to None.
+    """
+    counters = {} if counters is None else counters
+    counters["samples"] = len(names)
+    counters["processed_samples"] = len(names)
+    counters["variants"] = 0
+    with ReportWriter(samples, args.report) as report:
+        for (name, name_variants) in iter_variants(
+            args.bams_dir,
+            args.reference,
+            workers=args.workers,
+            reindex=args.reindex,
+            names=names,
+            thresholds=args.call_thresholds,
+            min_base_quality=args.min_base_quality,
+        ):
+            report.add(name, name_variants)
+            counters["variants"] += len(name_variants)
+
+
+def _batch_run_args(args: argparse.Namespace, run: BatchRun) -> argparse.Namespace:
+    """arguments of one run of a batch: its inputs, and outputs in <batch dir>/<run name>
+
+    Args:
+        args (argparse.Namespace): batch arguments
+        run (BatchRun): run
+
+    Returns:
+        argparse.Namespace: run arguments
+    """
+    run_dir = os.path.join(args.batch_dir, run.name)
+    return argparse.Namespace(
+        **dict(
+            vars(args),
+            fastq=run.fastq,
+            samples=run.samples,
+            reference=run.reference,
+            fastqs_dir=os.path.join(run_dir, "fastqs"),
+            bams_dir=os.path.join(run_dir, "bams"),
+            report=os.path.join(run_dir, "report.txt"),
+            vcf=os.path.join(run_dir, "variants.vcf"),
+            tsv=os.path.join(run_dir, "variants.tsv"),
+        )
+    )
+
+
+def _run_batch(args: argparse.Namespace, metrics: PipelineMetrics) -> None:
+    """run the pipeline over every run of a batch file in one process
+
+    - each distinct reference is indexed once (bwa and .fai), in place or in the index cache
+    - runs are demultiplexed in turn (each with the worker pool of create_fastqs)
+    - the alignment (and SAM to BAM) jobs of all samples of all runs are scheduled
+      together within the thread & memory budgets
+    - the variants of all samples of all runs are called on one process pool
+    - each run gets a report, a VCF and a TSV; the batch gets a combined summary.tsv
+
+    Args:
+        args (argparse.Namespace): arguments (see parse_arguments)
+        metrics (PipelineMetrics): metrics (stages cover all runs)
+    """
+    runs = BatchFile(args.batch).runs
+    for run in runs:
+        for input_file in [run.fastq, run.samples, run.reference]:
+            if not os.path.exists(input_file):
+                LOGGER.info(f"{run.name}: {input_file} not found.  Exiting...")
+                sys.exit(1)
+    LOGGER.info(f"{len(runs)} runs: {', '.join(run.name for run in runs)}")
+    run_args = {run.name: _batch_run_args(args, run) for run in runs}
+    samples = {
+        run.name: SampleFile(run.samples, max_mismatches=args.barcode_mismatches)
+        for run in runs
+    }
+    manifest = StageManifest()  # disabled: batch runs start from scratch
+    os.makedirs(args.batch_dir, exist_ok=True)
+
+    with contextlib.ExitStack() as stack:
+        LOGGER.info("-- Index references --")
+        with metrics.stage("index") as counters:
+            (indexes, cached) = ({}, {})
+            for reference in sorted({run.reference for run in runs}):
+                ReferenceFasta.index(reference, reindex=args.reindex)
+                if args.index_cache is not None:
+                    # identical references share an entry, which is opened (locked) once
+                    key = BwaIndexCache.key(reference)
+                    if key not in cached:
+                        index_cache = BwaIndexCache(
+                            args.index_cache,
+                            max_entries=args.index_cache_entries,
+                            max_bytes=args.index_cache_size,
+                        )
+                        cached[key] = stack.enter_context(
+                            index_cache.open(reference, rebuild=args.reindex)
+                        )
+                    indexes[reference] = cached[key]
+                else:
+                    if args.reindex or not _bwa_index_current(reference):
+                        _run_subprocess(["bwa", "index", reference], None)
+                    indexes[reference] = reference
+            counters["references"] = len(indexes)
+            counters["indexes"] = len(set(indexes.values()))
+
+        LOGGER.info("-- Create demultiplexed trimmed fastqs --")
+        with metrics.stage("demultiplex") as counters:
+            (names, stats) = ({}, {})
+            for run in runs:
+                LOGGER.info(f"run {run.name}")
+                run_counters = {}
+                (names[run.name], stats[run.name]) = _demultiplex_stage(
+                    run_args[run.name], samples[run.name], manifest, run_counters
+                )
+                _add_counters(counters, run_counters)
+
+        LOGGER.info("-- Align reads --")
+        with metrics.stage("align") as counters:
+            fastqs = {}
+            for run in runs:
+                os.makedirs(run_args[run.name].bams_dir)
+                run_fastqs = _trimmed_fastqs(run_args[run.name].fastqs_dir)
+                for (name, fastq) in run_fastqs.items():
+                    fastqs[(run.name, name)] = fastq
+            fastq_sizes = {
+                key: os.path.getsize(fastq) for (key, fastq) in fastqs.items()
+            }
+            sample_threads = _split_threads(fastq_sizes, args.threads)
+            (jobs, job_samples) = ([], {})
+            reference = {run.name: run.reference for run in runs}
+            for key in sorted(fastq_sizes, key=fastq_sizes.get, reverse=True):
+                (run_name, name) = key
+                run_jobs = _align_jobs(
+                    indexes[reference[run_name]],
+                    {name: fastqs[key]},
+                    run_args[run_name].bams_dir,
+                    {name: sample_threads[key]},
+                    stream=args.stream,
+                    savesam=args.savesam,
+                    sort_memory=args.sort_memory,
+                    label=f"{run_name}/",
+                )
+                jobs.extend(run_jobs)
+                job_samples[run_jobs[0].name] = key
+            usages = _run_jobs(jobs, args.threads, args.memory)
+            for job in jobs:
+                (run_name, name) = job_samples[job.name]
+                bams_dir = run_args[run_name].bams_dir
+                _log_alignment(job, usages[job.name], bams_dir, name, args.stream)
+            counters["samples"] = len(jobs)
+            counters["reads"] = sum(
+                counts.exact + counts.corrected
+                for run_stats in stats.values()
+                for counts in run_stats.samples.values()
+            )
+
+            if not args.stream:
+                LOGGER.info("-- Create sorted indexed bam files --")
+                sam_sizes = {
+                    (run_name, name): os.path.getsize(
+                        os.path.join(run_args[run_name].bams_dir, f"{name}.sam")
+                    )
+                    for (run_name, name) in fastqs
+                }
+                sample_threads = _split_threads(sam_sizes, args.threads)
+                jobs = []
+                for key in sorted(sam_sizes, key=sam_sizes.get, reverse=True):
+                    (run_name, name) = key
+                    jobs.extend(
+                        _sam_to_bam_jobs(
+                            run_args[run_name].bams_dir,
+                            [name],
+                            {name: sample_threads[key]},
+                            args.sort_memory,
+                            savesam=args.savesam,
+                            label=f"{run_name}/",
+                        )
+                    )
+                results = _run_jobs(jobs, args.threads, args.memory)
+                for job in jobs:
+                    (usage, bytes_written) = results[job.name]
+                    _log_usage(f"converted {job.name}", usage, job.threads)
+                    _log_bytes_written(job.name, bytes_written)
+
+    LOGGER.info("-- Call variants --")
+    with metrics.stage("call_variants") as counters:
+        with contextlib.ExitStack() as stack:
+            executor = None
+            if args.workers > 1:
+                executor = stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(args.workers)
+                )
+            call = functools.partial(
+                _call_batch_run_variants,
+                thresholds=args.call_thresholds,
+                min_base_quality=args.min_base_quality,
+                executor=executor,
+            )
+            run_calls = [(run, run_args[run.name].bams_dir) for run in runs]
+            if executor is None:
+                results = map(call, run_calls)
+            else:
+                # each run submits its samples to the shared pool from its own thread
+                results = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(len(runs))
+                ).map(call, run_calls)
+            variants = dict(zip([run.name for run in runs], results))
+        counters["samples"] = sum(len(run_names) for run_names in names.values())
+        counters["variants"] = sum(
+            len(name_variants)
+            for run_variants in variants.values()
+            for name_variants in run_variants.values()
+        )
+
+    LOGGER.info("-- Generate reports --")
+    with metrics.stage("report") as counters:
+        for run in runs:
+            _report_stage(
+                run_args[run.name], samples[run.name], variants[run.name], manifest
+            )
+        summary_file = os.path.join(args.batch_dir, "summary.tsv")
+        write_batch_summary(runs, samples, stats, variants, summary_file)
+        LOGGER.info(f"batch summary written to {summary_file}")
+        counters["runs"] = len(runs)
+
+
+def _stale_samples(
+    manifest: StageManifest, stage: str, sample_inputs: dict, parameters: dict
+) -> list:
+    """samples of a per-sample stage which must be (re-)run
+
+    Records of samples which no longer exist are dropped.
+
+    Args:
+        manifest (StageManifest): stage manifest
+        stage (str): stage name
+        sample_inputs (dict): {name: {input label: checksum}}
+        parameters (dict): stage parameters
+
+    Returns:
+        list: sample names
+    """
+    manifest.discard(stage, sample_inputs)
+    stale = [
+        name
+        for (name, inputs) in sample_inputs.items()
+        if not manifest.is_current(stage, name, inputs, parameters)
+    ]
+    if manifest.enabled:
+        LOGGER.info(
+            f"{len(sample_inputs) - len(stale)} of {len(sample_inputs)} samples are up to date"
+        )
+    return stale
+
+
+#
+# helper code
+#
+
+
+def _sorted_bams(bams_dir: str, names: typing.Iterable = None) -> list:
+    """sorted bam files of a folder, in file name order
+
+    Args:
+        bams_dir (str): bam file directory (name_sorted.bam)
+        names (typing.Iterable, optional): only these samples. Defaults to None (all bam files).
+
+    Returns:
+        list: tuples (name, bam path)
+    """
+    return [
+        (f.split("_")[0], os.path.join(bams_dir, f))
+        for f in sorted(os.listdir(bams_dir))
+        if f.endswith(SORTED_BAM) and (names is None or f.split("_")[0] in names)
+    ]
+
+
+def _call_batch_run_variants(
+    run_call: tuple,
+    thresholds: CallThresholds = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+    executor: concurrent.futures.Executor = None,
+) -> dict:
+    """call the variants of one run of a batch (see call_variants)
+
+    Args:
+        run_call (tuple): (BatchRun, bam folder)
+        thresholds (CallThresholds, optional): allele calling thresholds. Defaults to None.
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+        executor (concurrent.futures.Executor, optional): shared pool. Defaults to None.
+
+    Returns:
+        dict: dictionary of {name: list of VariantFrequency tuples}
+    """
+    (run, bams_dir) = run_call
+    return call_variants(
+        bams_dir,
+        run.reference,
+        thresholds=thresholds,
+        min_base_quality=min_base_quality,
+        executor=executor,
+    )
+
+
+def _add_counters(total: dict, counters: dict) -> None:
+    """add numeric stage counters (e.g. of one run of a batch) to totals
+
+    Args:
+        total (dict): totals (updated)
+        counters (dict): counters
+    """
+    for (key, value) in counters.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+
+
+def _setup_logger(debug: bool, logfile: str) -> None:
+    """set up logger
+
+    Set up a handler for both a log file and stdout/stderr
+
+    Args:
+        debug (bool): if level should be set to debug
+        logfile (str): log file name.
+    """
+    log_dir = os.path.dirname(logfile)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    LOGGER.setLevel(logging.DEBUG) # base level
+
+    level = logging.DEBUG if debug else logging.INFO
+
+    # stream handler
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(level)
+    LOGGER.addHandler(handler)
+
+    # file handler
+    handler = logging.FileHandler(logfile)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s: %(message)s"))
+    LOGGER.addHandler(handler)
+
+
+def _init_demultiplex_worker(
+    fastq_file: str,
+    bc_lookup: dict,
+    bc_exact: set,
+    bc_length: int,
+    low_quality: np.ndarray,
+    compression: str = "none",
+    compress_level: int = COMPRESS_LEVEL,
+) -> None:
+    """set up the (per-process) state used by _demultiplex_chunk
 
     Args:
-        reference (str): reference fasta
-        fastqs_dir (str): input trimmed fastqs (filename convention: name_trimmed.fastq)
-        bams_dir (str): output folder (filename convention: name.sam)
-        reindex (bool): force reference re-index (default False)
+        fastq_file (str): fastq input sequence data
+        bc_lookup (dict): {barcode or tolerated neighbor (bytes): sample name}
+        bc_exact (set): sample barcodes (bytes)
+        bc_length (int): barcode length
+        low_quality (np.ndarray): low-quality lookup table (see low_quality_table)
+        compression (str, optional): output compression (see compress_fastq). Defaults to "none".
+        compress_level (int, optional): output compression level. Defaults to COMPRESS_LEVEL.
     """
+    _DEMULTIPLEX_STATE["reader"] = FastqReader(fastq_file)
+    _DEMULTIPLEX_STATE["bc_lookup"] = bc_lookup
+    _DEMULTIPLEX_STATE["bc_exact"] = bc_exact
+    _DEMULTIPLEX_STATE["bc_length"] = bc_length
+    _DEMULTIPLEX_STATE["low_quality"] = low_quality
+    _DEMULTIPLEX_STATE["compression"] = (compression, compress_level)
 
-    # setup
-    os.makedirs(bams_dir)
 
-    # index reference (if needed)
-    if not os.path.exists(reference + ".amb") or reindex:
-        LOGGER.debug("generate index...")
-        cmd = ["bwa", "index", reference]
-        _run_subprocess(cmd, None)
+def _demultiplex_chunk(numbered_chunk: tuple) -> tuple:
+    """demultiplex and trim one record-aligned fastq chunk
 
-    # call bwa mem on every trimmed fastq - write to a SAM file
-    for fastq_filename in [
-        f for f in os.listdir(fastqs_dir) if f.endswith(TRIMMED_FASTQ)
-    ]:
-        name = fastq_filename.split("_")[0]
-        cmd = ["bwa", "mem", reference, os.path.join(fastqs_dir, fastq_filename)]
-        samfile = os.path.join(bams_dir, f"{name}.sam")
-        with open(samfile, "w") as f:
-            _run_subprocess(cmd, f)
+    Args:
+        numbered_chunk (tuple): (# records preceding the chunk, chunk bytes) from FastqReader.chunks
 
+    Returns:
+        tuple: ({sample name: trimmed (and compressed) fastq records (bytes)},
+                {sample name: (# reads, # corrected barcodes, # bases)},
+                collections.Counter of unassigned barcodes)
+    """
+    (first_record, chunk) = numbered_chunk
+    columns = _DEMULTIPLEX_STATE["reader"].parse_chunk(chunk, first_record)
+    bc_lookup = _DEMULTIPLEX_STATE["bc_lookup"]
+    bc_exact = _DEMULTIPLEX_STATE["bc_exact"]
+    bc_length = _DEMULTIPLEX_STATE["bc_length"]
+    correcting = len(bc_lookup) > len(bc_exact)
+
+    # find the starting point for trimming low-quality bases of every read at once
+    cuts = trim_positions(columns[3], _DEMULTIPLEX_STATE["low_quality"])
+    trimmed_lengths = np.maximum(cuts - bc_length, 0)
+
+    sample_records = collections.defaultdict(list)
+    corrected = collections.Counter()
+    bases = collections.defaultdict(int)
+    unassigned = collections.Counter()
+    for (header, seq, qual_header, qual, end_pos, nbases) in zip(
+        *columns, cuts.tolist(), trimmed_lengths.tolist()
+    ):
+        # get the barcode
+        bc = seq[:bc_length]
+        name = bc_lookup.get(bc)
+        if name:
+            if correcting and bc not in bc_exact:
+                corrected[name] += 1
+            bases[name] += nbases
 
-def sam_to_bam(bams_dir: str, savesam=False) -> None:
-    """Convert sam files to sorted, indexed bam files
+            # trim
+            sample_records[name].append(
+                b"%s\n%s\n%s\n%s\n"
+                % (header, seq[bc_length:end_pos], qual_header, qual[bc_length:end_pos])
+            )
+        else:
+            unassigned[bc] += 1
+
+    (compression, compress_level) = _DEMULTIPLEX_STATE["compression"]
+    return (
+        {
+            name: compress_fastq(b"".join(records), compression, compress_level)
+            for (name, records) in sample_records.items()
+        },
+        {
+            name: (len(records), corrected[name], bases[name])
+            for (name, records) in sample_records.items()
+        },
+        unassigned,
+    )
 
-    Takes a directory of sam files
-    For each sam file
-    (1) converts to bam file and deletes the sam file
-    (2) sorts and indexes the bam file and deletes the unsorted bam file
 
-    Deletion occurs immediately to minimize disk usage.
+def _read_blocks(
+    file_path: str, block_size: int, prefetch: int = FASTQ_PREFETCH_BLOCKS
+) -> typing.Iterator[bytes]:
+    """read a file in blocks; a .gz file is decompressed
+
+    With prefetch > 0, a .gz file is decompressed by a background thread up to
+    prefetch blocks ahead of the consumer (zlib releases the GIL while inflating,
+    so decompression overlaps with the consumer's work).
 
     Args:
-        bams_dir (str): working directory of sam/bam files
-        savesam (bool): do not delete intermediate SAM file (Defaults to False).
+        file_path (str): file path
+        block_size (int): block size in bytes
+        prefetch (int, optional): # blocks to decompress ahead. Defaults to FASTQ_PREFETCH_BLOCKS.
+
+    Yields:
+        bytes: blocks of (decompressed) data
     """
-    for sam_filename in [f for f in os.listdir(bams_dir) if f.endswith(".sam")]:
-        # get filenames
-        name = os.path.splitext(sam_filename)[0]
-        samfile = os.path.join(bams_dir, sam_filename)
-        bamfile = os.path.join(bams_dir, f"{name}.bam")
-        sorted_bamfile = os.path.join(bams_dir, f"{name}{SORTED_BAM}")
-
-        # SAM to BAM
-        cmd = ["samtools", "view", "-bS", samfile]
-        with open(bamfile, "w") as f:
-            _run_subprocess(cmd, f)
-        if not savesam:
-            pathlib.Path(samfile).unlink()
-
-        # sort BAM
-        cmd = ["samtools", "sort", "-m", "100M", "-o", sorted_bamfile, bamfile]
-        _run_subprocess(cmd, None)
-        pathlib.Path(bamfile).unlink()
+    gzipped = file_path.endswith(".gz")
+    if not gzipped or prefetch < 1:
+        with (gzip.open if gzipped else open)(file_path, "rb") as f:
+            yield from iter(functools.partial(f.read, block_size), b"")
+        return
+
+    blocks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()  # set if the consumer stops early
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decompress() -> None:
+        try:
+            with gzip.open(file_path, "rb") as f:
+                for block in iter(functools.partial(f.read, block_size), b""):
+                    if not put(block):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = blocks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
-        # index BAM
-        cmd = ["samtools", "index", sorted_bamfile]
-        _run_subprocess(cmd, None)
 
+def _ordered_map(
+    executor: concurrent.futures.Executor,
+    fn: typing.Callable,
+    iterable: typing.Iterable,
+    max_pending: int,
+) -> typing.Iterator:
+    """like executor.map, but consumes the input lazily
 
-def call_variants(bams_dir: str, reference: str) -> dict:
-    """Reports bases for each bam where there is more than 1 base at a position
+    At most max_pending tasks are in flight, so a large input
+    is never read entirely into memory; results are yielded in input order.
 
     Args:
-        bams_dir (str): bam file directory (name_sorted.bam)
-        reference (str): reference fasta path
+        executor (concurrent.futures.Executor): executor
+        fn (typing.Callable): function to apply
+        iterable (typing.Iterable): function inputs
+        max_pending (int): maximum number of submitted but unconsumed tasks
 
-    One could in principle get the wildtype from the bam file MD tag
-    which would mitigate the need to read the reference
+    Yields:
+        results of fn, in input order
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _trimmed_fastqs(fastqs_dir: str) -> dict:
+    """find the trimmed fastqs (compressed or not) in a folder
+
+    Args:
+        fastqs_dir (str): folder of <name>_trimmed.fastq(.gz) files
 
     Returns:
-        dict: dictionary of {name: list of VariantFrequency tuples}
+        dict: {name: fastq path}
     """
+    return {
+        f.split("_")[0]: os.path.join(fastqs_dir, f)
+        for f in os.listdir(fastqs_dir)
+        if f.endswith((TRIMMED_FASTQ, TRIMMED_FASTQ_GZ))
+    }
 
-    def _get_mutation_base(wildtype: str, frequencies: tuple) -> str:
-        """Inner function to get a mutation from a tuple of frequencies
 
-        Assumes exactly one mutation base
+def _split_threads(sizes: dict, threads: int) -> dict:
+    """split a thread budget across samples in proportion to their input size
 
-        Args:
-            wildtype (str): wildtype base
-            frequencies (tuple): (base, frequency)
+    Every sample gets at least 1 thread and at most the whole budget.
 
-        Returns:
-            str: mutation
-        """
-        mutation = None
-        for (base, frequency) in frequencies:
-            if base != wildtype and frequency > 0:
-                mutation = base
+    Args:
+        sizes (dict): {name: input size}
+        threads (int): total threads available
+
+    Returns:
+        dict: {name: threads}
+    """
+    total_size = sum(sizes.values())
+    sample_threads = {}
+    for (name, size) in sizes.items():
+        share = round(threads * size / total_size) if total_size else 1
+        sample_threads[name] = min(threads, max(1, share))
+    return sample_threads
+
+
+def _run_jobs(jobs: list, threads: int, memory: int = None) -> dict:
+    """run jobs concurrently within a thread budget (and optionally a memory budget)
+
+    Jobs are started in list order as soon as enough of the budget is free
+    (a job needing more than the whole budget runs alone).
+    Exits if a subprocess of any job fails (see _run_subprocess).
+
+    Args:
+        jobs (list): PipelineJob objects (unique names)
+        threads (int): total threads available
+        memory (int, optional): total memory available (bytes). Defaults to None (unlimited).
+
+    Returns:
+        dict: {job name: value returned by the job}
+    """
+    condition = threading.Condition()
+    free_threads = threads
+    free_memory = memory
+    results = {}
+    errors = []
+
+    def _job_threads(job: PipelineJob) -> int:
+        return min(job.threads, threads)
+
+    def _job_memory(job: PipelineJob) -> int:
+        return 0 if memory is None else min(job.memory, memory)
+
+    def _run_job(job: PipelineJob) -> None:
+        nonlocal free_threads, free_memory
+        try:
+            results[job.name] = job.run()
+        except Exception as err:
+            errors.append(err)
+        finally:
+            with condition:
+                free_threads += _job_threads(job)
+                if memory is not None:
+                    free_memory += _job_memory(job)
+                condition.notify_all()
+
+    runners = []
+    for job in jobs:
+        with condition:
+            condition.wait_for(
+                lambda: errors
+                or (
+                    free_threads >= _job_threads(job)
+                    and (memory is None or free_memory >= _job_memory(job))
+                )
+            )
+            if errors:
                 break
-        assert mutation is not None  # you must have one mutation
-        return mutation
+            free_threads -= _job_threads(job)
+            if memory is not None:
+                free_memory -= _job_memory(job)
+        runner = threading.Thread(target=_run_job, args=(job,))
+        runner.start()
+        runners.append(runner)
+    for runner in runners:
+        runner.join()
+
+    if errors:
+        err = errors[0]
+        if isinstance(err, subprocess.CalledProcessError):
+            LOGGER.error(f"{' '.join(err.cmd)} failed: {str(err)}")
+            sys.exit(err.returncode)
+        raise err
+
+    return results
+
+
+def _align_jobs(
+    index: str,
+    fastqs: dict,
+    bams_dir: str,
+    sample_threads: dict,
+    stream=False,
+    savesam=False,
+    sort_memory: int = SORT_MEMORY,
+    label: str = "",
+) -> list:
+    """bwa mem jobs of samples (see align_reads)
+
+    Args:
+        index (str): bwa index prefix
+        fastqs (dict): {name: trimmed fastq}, in the order the jobs should start
+        bams_dir (str): output folder
+        sample_threads (dict): {name: bwa mem threads}
+        stream (bool, optional): stream alignments into sorted bam files. Defaults to False.
+        savesam (bool, optional): streaming mode only - also write the SAM file. Defaults to False.
+        sort_memory (int, optional): streaming mode only - samtools sort memory in bytes. Defaults to SORT_MEMORY.
+        label (str, optional): job name prefix (to keep job names unique across runs). Defaults to "".
+
+    Returns:
+        list: PipelineJob objects
+    """
+    jobs = []
+    for (name, fastq) in fastqs.items():
+        cmd = [
+            "bwa",
+            "mem",
+            "-t",
+            str(sample_threads[name]),
+            "-K",
+            str(BWA_BATCH_BASES),
+            index,
+            fastq,
+        ]
+        samfile = os.path.join(bams_dir, f"{name}.sam")
+        if stream:
+            run = functools.partial(
+                _stream_to_sorted_bam,
+                cmd,
+                os.path.join(bams_dir, f"{name}{SORTED_BAM}"),
+                samfile if savesam else None,
+                sort_memory,
+            )
+            job_memory = sort_memory
+        else:
+            run = functools.partial(_run_subprocess_to_file, cmd, samfile)
+            job_memory = 0
+        jobs.append(
+            PipelineJob(
+                name=f"{label}{name}",
+                threads=sample_threads[name],
+                run=run,
+                memory=job_memory,
+            )
+        )
+    return jobs
+
+
+def _sam_to_bam_jobs(
+    bams_dir: str,
+    names: list,
+    sample_threads: dict,
+    sort_memory: int,
+    savesam=False,
+    label: str = "",
+) -> list:
+    """SAM to sorted, indexed BAM jobs of samples (see sam_to_bam)
+
+    Args:
+        bams_dir (str): working directory of sam/bam files
+        names (list): sample names, in the order the jobs should start
+        sample_threads (dict): {name: samtools threads}
+        sort_memory (int): samtools sort memory per thread in bytes
+        savesam (bool, optional): do not delete intermediate SAM file. Defaults to False.
+        label (str, optional): job name prefix (to keep job names unique across runs). Defaults to "".
+
+    Returns:
+        list: PipelineJob objects
+    """
+    return [
+        PipelineJob(
+            name=f"{label}{name}",
+            threads=sample_threads[name],
+            run=functools.partial(
+                _sam_to_sorted_bam,
+                bams_dir,
+                name,
+                sample_threads[name],
+                sort_memory,
+                savesam,
+            ),
+            memory=sample_threads[name] * sort_memory,
+        )
+        for name in names
+    ]
+
+
+def _log_alignment(
+    job: PipelineJob, usage: SubprocessUsage, bams_dir: str, name: str, stream=False
+) -> None:
+    """log the resource usage (and streaming mode outputs) of an alignment job
+
+    Args:
+        job (PipelineJob): alignment job
+        usage (SubprocessUsage): resource usage
+        bams_dir (str): output folder
+        name (str): sample name
+        stream (bool, optional): streaming mode. Defaults to False.
+    """
+    _log_usage(f"aligned {job.name}", usage, job.threads)
+    if stream:
+        _log_bytes_written(
+            job.name,
+            {
+                "SAM": os.path.join(bams_dir, f"{name}.sam"),
+                "sorted BAM": os.path.join(bams_dir, f"{name}{SORTED_BAM}"),
+                "BAM index": os.path.join(bams_dir, f"{name}{SORTED_BAM}.bai"),
+            },
+        )
+
+
+def _log_usage(label: str, usage: SubprocessUsage, threads: int) -> None:
+    """log the wall time and CPU utilization of a subprocess
+
+    Args:
+        label (str): description of the work done
+        usage (SubprocessUsage): resource usage
+        threads (int): threads allotted to the work
+    """
+    utilization = (
+        usage.cpu_time / (usage.wall_time * threads) if usage.wall_time else 0.0
+    )
+    LOGGER.info(
+        f"{label}: {usage.wall_time:.2f}s wall, {usage.cpu_time:.2f}s cpu, {threads} threads ({utilization:.0%} utilization)"
+    )
+
+
+def _sort_memory_per_thread(memory: int, threads: int) -> int:
+    """size samtools sort memory per thread so that all threads fit the memory budget
+
+    Args:
+        memory (int): total memory available in bytes (None: unlimited)
+        threads (int): total threads
+
+    Returns:
+        int: memory per thread in bytes (SORT_MEMORY if there is no budget)
+    """
+    if memory is None:
+        return SORT_MEMORY
+    return min(SORT_MEMORY_MAX, max(SORT_MEMORY_MIN, memory // threads))
+
+
+def _samtools_memory(nbytes: int) -> str:
+    """format a memory size for samtools (e.g. sort -m)
+
+    Args:
+        nbytes (int): size in bytes
+
+    Returns:
+        str: size in whole megabytes (at least 1M)
+    """
+    return f"{max(1, nbytes // (1024 * 1024))}M"
+
+
+def _parse_memory(size: str) -> int:
+    """parse a memory size such as 512M or 4G (argparse type)
+
+    Args:
+        size (str): size in bytes, optionally with a K, M or G suffix
+
+    Raises:
+        argparse.ArgumentTypeError: if the size cannot be parsed
+
+    Returns:
+        int: size in bytes
+    """
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    suffix = size[-1:].upper()
+    try:
+        if suffix in multipliers:
+            return int(float(size[:-1]) * multipliers[suffix])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid memory size: {size}")
+
+
+def _parse_fraction(value: str) -> float:
+    """parse a fraction between 0 and 1 (argparse type)
+
+    Args:
+        value (str): fraction
 
-    # get the reference (for wildtype data)
-    with open(reference) as f:
-        f.readline()  # skip header
-        reference_sequence = f.readline().strip()
-
-    sample_variants = {}
-    for bam_filename in [f for f in os.listdir(bams_dir) if f.endswith(SORTED_BAM)]:
-        LOGGER.debug(f"Processing {bam_filename}...")
-        bamfile = os.path.join(bams_dir, bam_filename)
-        name = bam_filename.split("_")[0]
-        # run the pileup method to get position/# reads/frequencies
-        bam_variants = pileup(bamfile)
-
-        # convert each variant into a NamedTuple (add wildtype & mutation)
-        if bam_variants:
-            variants_complete = []
+    Raises:
+        argparse.ArgumentTypeError: if the value is not a number between 0 and 1
+
+    Returns:
+        float: fraction
+    """
+    try:
+        fraction = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid fraction: {value}")
+    if not 0 <= fraction <= 1:
+        raise argparse.ArgumentTypeError(f"fraction must be between 0 and 1: {value}")
+    return fraction
+
+
+def _available_memory() -> int:
+    """available physical memory in bytes (MemAvailable on Linux, else total)
+
+    Returns:
+        int: available memory in bytes
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _log_bytes_written(name: str, outputs: dict) -> None:
+    """log the bytes written to disk for a sample (intermediates included)
+
+    Args:
+        name (str): sample name
+        outputs (dict): {description: size in bytes, or path (skipped if absent)}
+    """
+    sizes = {}
+    for (description, output) in outputs.items():
+        if isinstance(output, int):
+            sizes[description] = output
+        elif os.path.exists(output):
+            sizes[description] = os.path.getsize(output)
+    detail = ", ".join(
+        f"{description} {size:,}" for (description, size) in sizes.items()
+    )
+    LOGGER.info(f"{name}: {sum(sizes.values()):,} bytes written ({detail})")
+
+
+def _call_sample_variants(
+    bamfile: str,
+    reference: str,
+    thresholds: CallThresholds = None,
+    min_base_quality: int = MIN_BASE_QUALITY,
+) -> tuple:
+    """call the variants of one sample (see call_variants)
+
+    Args:
+        bamfile (str): indexed, sorted bam file
+        reference (str): indexed reference fasta (for wildtype bases)
+        thresholds (CallThresholds, optional): allele calling thresholds. Defaults to None (pileup calling).
+        min_base_quality (int, optional): minimum base quality to count a base. Defaults to MIN_BASE_QUALITY.
+
+    Raises:
+        KeyError: if a contig of the bam is not in the reference
+
+    Returns:
+        tuple: (list of VariantFrequency tuples, elapsed seconds)
+    """
+    start = time.perf_counter()
+
+    with pysam.AlignmentFile(bamfile, "rb") as samfile:
+        contigs = samfile.references
+
+    variants_complete = []
+    with ReferenceFasta(reference) as reference_fasta:
+        for contig in contigs:
+            if contig not in reference_fasta.contigs:
+                raise KeyError(f"{bamfile} contig {contig} is not in {reference}")
+
+            if thresholds is not None:
+                alleles = call_alleles(
+                    bamfile,
+                    reference_fasta,
+                    region=contig,
+                    min_allele_freq=thresholds.min_allele_freq,
+                    min_depth=thresholds.min_depth,
+                    min_base_quality=min_base_quality,
+                )
+                # increment position by one since pysam pileups are 0-based
+                for (_, position, nreads, frequencies, wildtype, mutation) in alleles:
+                    variants_complete.append(
+                        VariantFrequency(
+                            position=position + 1,
+                            nreads=nreads,
+                            wildtype=wildtype,
+                            mutation=mutation,
+                            frequencies=frequencies,
+                            contig=contig,
+                        )
+                    )
+                continue
+
+            # run the pileup method to get position/# reads/frequencies
+            bam_variants = pileup(
+                bamfile, region=contig, min_base_quality=min_base_quality
+            )
+
+            # convert each variant into a NamedTuple (add wildtype & mutation)
             for (position, nreads, frequencies) in bam_variants:
-                wildtype = reference_sequence[position]
+                wildtype = reference_fasta.base(contig, position)
                 mutation = _get_mutation_base(wildtype, frequencies)
-                # increment position by one since pysam pileups and python lists are 0-based
+                # increment position by one since pysam pileups are 0-based
                 variants_complete.append(
                     VariantFrequency(
                         position=position + 1,
@@ -562,105 +3973,112 @@ def call_variants(bams_dir: str, reference: str) -> dict:
                         wildtype=wildtype,
                         mutation=mutation,
                         frequencies=frequencies,
+                        contig=contig,
                     )
                 )
-            sample_variants[name] = variants_complete
 
-    return sample_variants
+    return (variants_complete, time.perf_counter() - start)
 
 
-def generate_report(variants: dict, samples: SampleFile, report_file: str) -> None:
-    """Generate variants report
+def _mutation_count(variant: VariantFrequency) -> int:
+    """# reads with the mutation of a variant (frequencies are count / depth, so the count is exact)
 
-    - Iterates through all variants by color, and reports each variant.
-    - Iterates through all samples, and reports each variant.
+    Args:
+        variant (VariantFrequency): variant
 
-    Code does not assume only 1 variant per color or sample
+    Returns:
+        int: # reads
+    """
+    label = allele_label(variant.wildtype, variant.mutation)
+    return round(dict(variant.frequencies).get(label, 0) * variant.nreads)
+
+
+def _get_mutation_base(wildtype: str, frequencies: tuple) -> str:
+    """get a mutation from a tuple of frequencies
+
+    Assumes exactly one mutation base
 
     Args:
-        variants (dict): dictionary of {name:list[VariantCalls]}
-        samples (SampleFile): sample object
-        report_file (str): path to write report
+        wildtype (str): wildtype base
+        frequencies (tuple): (base, frequency)
+
+    Returns:
+        str: mutation
     """
-    # write the report
-    with open(report_file, "w") as f:
-
-        # get all the variants for a color
-        for color, names in samples.color_names.items():
-            color_variants = []
-            for name in names:
-                color_variants.extend(variants.get(name, []))
-
-            unique_variants = []
-            for color_variant in color_variants:
-                variant_tuple = (
-                    color_variant.position,
-                    color_variant.wildtype,
-                    color_variant.mutation,
-                )
-                if variant_tuple not in unique_variants:
-                    unique_variants.append(variant_tuple)
+    mutation = None
+    for (base, frequency) in frequencies:
+        if base != wildtype and frequency > 0:
+            mutation = base
+            break
+    assert mutation is not None  # you must have one mutation
+    return mutation
 
-            # in the event a color has # SNPs != 1
-            if len(unique_variants) != 1:
-                f.write(f"{len(unique_variants)} variants identified for {color}\n")
 
-            for (position, wildtype, mutation) in unique_variants:
-                msg = f"The {color} mold was caused by a mutation in position {position}.  The wildtype base was {wildtype} and the mutation was {mutation}\n"
-                f.write(msg)
+def _parse_region(region: str) -> tuple:
+    """parse a samtools-style region (contig, contig:start or contig:start-stop; 1-based inclusive)
 
-        f.write("\n")
+    Args:
+        region (str): region
 
-        # report all the per-sample results
-        for name in samples.name_color.keys():
-            color = samples.name_color[name]
-            name_variants = variants.get(name, [])
+    Raises:
+        ValueError: if the region cannot be parsed
 
-            # in the event a name has # SNPs != 1
-            if len(name_variants) != 1:
-                f.write(f"{len(name_variants)} variants identified for {name}\n")
+    Returns:
+        tuple: (contig, 0-based start, 0-based exclusive stop or None for the contig end)
+    """
+    (contig, _, interval) = region.rpartition(":")
+    if not contig or not re.fullmatch(r"[\d,]+(-[\d,]*)?", interval):
+        return (region, 0, None)
+    (start, _, stop) = interval.replace(",", "").partition("-")
+    if int(start) < 1 or (stop and int(stop) < int(start)):
+        raise ValueError(f"invalid region: {region}")
+    return (contig, int(start) - 1, int(stop) if stop else None)
 
-            for variant in name_variants:
-                for base, frequency in variant.frequencies:
-                    if base == variant.mutation:
-                        mutation_frequency = frequency
-                        break
-                msg = f"Sample {name} had a {color} mold, {variant.nreads} reads, and had {mutation_frequency:.0%} of the reads at position {variant.position} had the mutation {variant.mutation}\n"
-                f.write(msg)
 
+def _to_json(value):
+    """normalize a value to its JSON round trip (e.g. tuples become lists)
 
-#
-# helper code
-#
+    Args:
+        value: JSON-serializable value
 
+    Returns:
+        value as it would be read back from JSON
+    """
+    return json.loads(json.dumps(value))
 
-def _setup_logger(debug: bool, logfile: str) -> None:
-    """set up logger
 
-    Set up a handler for both a log file and stdout/stderr
+@functools.lru_cache(maxsize=None)
+def _bwa_version() -> str:
+    """bwa version (bwa prints its usage, with the version, to stderr)
 
-    Args:
-        debug (bool): if level should be set to debug
-        logfile (str): log file name.
+    Returns:
+        str: version (unknown if it cannot be parsed)
     """
-    log_dir = os.path.dirname(logfile)
-    if log_dir and not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    result = subprocess.run(
+        ["bwa"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    match = re.search(r"^Version:\s*(\S+)", result.stderr, re.MULTILINE)
+    return match.group(1) if match else "unknown"
 
-    LOGGER.setLevel(logging.DEBUG) # base level
 
-    level = logging.DEBUG if debug else logging.INFO
+def _bwa_index_current(reference: str) -> bool:
+    """check that the bwa index files of a reference exist and are newer than it
 
-    # stream handler
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(level)
-    LOGGER.addHandler(handler)
+    Args:
+        reference (str): reference fasta (index prefix)
 
-    # file handler
-    handler = logging.FileHandler(logfile)
-    handler.setLevel(level)
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s: %(message)s"))
-    LOGGER.addHandler(handler)
+    Returns:
+        bool: True if the index can be used
+    """
+    reference_mtime = os.path.getmtime(reference)
+    for ext in BWA_INDEX_EXTENSIONS:
+        index_file = reference + ext
+        if (
+            not os.path.exists(index_file)
+            or os.path.getmtime(index_file) < reference_mtime
+        ):
+            return False
+    return True
 
 
 def _rm_tree(pth: str) -> None:
@@ -700,6 +4118,199 @@ def _run_subprocess(cmd:list, stdout: typing.IO=None) -> None:
         sys.exit(err.returncode)
 
 
+def _run_subprocess_to_file(cmd: list, output_file: str = None) -> SubprocessUsage:
+    """run a subprocess writing stdout to a file and measure its resource usage
+
+    Unlike _run_subprocess, failure raises an exception
+    (so it can be used from worker threads).
+
+    Args:
+        cmd (list): command as a list of strings
+        output_file (str, optional): path for stdout. Defaults to None (inherit stdout).
+
+    Raises:
+        subprocess.CalledProcessError: if the command fails
+
+    Returns:
+        SubprocessUsage: wall and CPU time of the command
+    """
+    cmdstring = " ".join(cmd)
+    redirect = f" > {output_file}" if output_file else ""
+    LOGGER.debug(f"running {cmdstring}{redirect}...")
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open(output_file, "w")) if output_file else None
+        proc = subprocess.Popen(cmd, stdout=f)
+        cpu_time = _wait_cpu_time(proc)
+    _check_returncodes([proc])
+    return SubprocessUsage(wall_time=time.perf_counter() - start, cpu_time=cpu_time)
+
+
+def _sam_to_sorted_bam(
+    bams_dir: str, name: str, threads: int, sort_memory: int, savesam: bool
+) -> tuple:
+    """convert one sample's SAM to a sorted, indexed bam (see sam_to_bam)
+
+    Args:
+        bams_dir (str): working directory of sam/bam files
+        name (str): sample name (name.sam)
+        threads (int): samtools threads
+        sort_memory (int): samtools sort memory per thread in bytes
+        savesam (bool): do not delete the SAM file
+
+    Raises:
+        subprocess.CalledProcessError: if any command fails
+
+    Returns:
+        tuple: (SubprocessUsage, {description: bytes written})
+    """
+    # get filenames
+    samfile = os.path.join(bams_dir, f"{name}.sam")
+    bamfile = os.path.join(bams_dir, f"{name}.bam")
+    sorted_bamfile = os.path.join(bams_dir, f"{name}{SORTED_BAM}")
+    bytes_written = {"SAM": os.path.getsize(samfile)}
+    start = time.perf_counter()
+    cpu_time = 0.0
+
+    # SAM to BAM (view/index -@ counts threads in addition to the main thread)
+    cmd = ["samtools", "view", "-@", str(threads - 1), "-bS", samfile]
+    cpu_time += _run_subprocess_to_file(cmd, bamfile).cpu_time
+    bytes_written["unsorted BAM"] = os.path.getsize(bamfile)
+    if not savesam:
+        pathlib.Path(samfile).unlink()
+
+    # sort BAM
+    cmd = [
+        "samtools",
+        "sort",
+        "-@",
+        str(threads),
+        "-m",
+        _samtools_memory(sort_memory),
+        "-o",
+        sorted_bamfile,
+        bamfile,
+    ]
+    cpu_time += _run_subprocess_to_file(cmd).cpu_time
+    pathlib.Path(bamfile).unlink()
+
+    # index BAM
+    cmd = ["samtools", "index", "-@", str(threads - 1), sorted_bamfile]
+    cpu_time += _run_subprocess_to_file(cmd).cpu_time
+
+    bytes_written["sorted BAM"] = os.path.getsize(sorted_bamfile)
+    bytes_written["BAM index"] = os.path.getsize(f"{sorted_bamfile}.bai")
+    usage = SubprocessUsage(wall_time=time.perf_counter() - start, cpu_time=cpu_time)
+    return (usage, bytes_written)
+
+
+def _stream_to_sorted_bam(
+    cmd: list,
+    sorted_bamfile: str,
+    samfile: str = None,
+    sort_memory: int = SORT_MEMORY,
+) -> SubprocessUsage:
+    """pipe the SAM output of a subprocess into samtools sort, then index the result
+
+    Args:
+        cmd (list): command writing SAM to stdout, as a list of strings
+        sorted_bamfile (str): output sorted bam path
+        samfile (str, optional): if given, also write (tee) the SAM to this path. Defaults to None.
+        sort_memory (int, optional): samtools sort memory in bytes. Defaults to SORT_MEMORY.
+
+    Raises:
+        subprocess.CalledProcessError: if any command fails
+
+    Returns:
+        SubprocessUsage: wall and CPU time of all the commands
+    """
+    sort_cmd = [
+        "samtools",
+        "sort",
+        "-m",
+        _samtools_memory(sort_memory),
+        "-o",
+        sorted_bamfile,
+        "-",
+    ]
+    LOGGER.debug(f"running {' '.join(cmd)} | {' '.join(sort_cmd)}...")
+    start = time.perf_counter()
+    producer = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    if samfile is None:
+        sorter = subprocess.Popen(sort_cmd, stdin=producer.stdout)
+        producer.stdout.close()  # sorter owns the pipe now
+        tee = None
+    else:
+        sorter = subprocess.Popen(sort_cmd, stdin=subprocess.PIPE)
+        tee = threading.Thread(
+            target=_tee, args=(producer.stdout, (sorter.stdin, samfile))
+        )
+        tee.start()
+    cpu_time = _wait_cpu_time(producer)
+    if tee is not None:
+        tee.join()
+    cpu_time += _wait_cpu_time(sorter)
+    _check_returncodes([producer, sorter])
+
+    index_cmd = ["samtools", "index", sorted_bamfile]
+    LOGGER.debug(f"running {' '.join(index_cmd)}...")
+    indexer = subprocess.Popen(index_cmd)
+    cpu_time += _wait_cpu_time(indexer)
+    _check_returncodes([indexer])
+    return SubprocessUsage(wall_time=time.perf_counter() - start, cpu_time=cpu_time)
+
+
+def _tee(source: typing.IO, destinations: tuple) -> None:
+    """copy a binary stream to a pipe and a file, then close the pipe and source
+
+    Args:
+        source (typing.IO): binary stream to read
+        destinations (tuple): (binary pipe to write, output file path)
+    """
+    (pipe, output_file) = destinations
+    with open(output_file, "wb") as f:
+        try:
+            for block in iter(functools.partial(source.read, FASTQ_BLOCK_SIZE), b""):
+                f.write(block)
+                pipe.write(block)
+        except BrokenPipeError:
+            pass  # reader failed; reported by its exit status
+        finally:
+            source.close()
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+
+def _wait_cpu_time(proc: subprocess.Popen) -> float:
+    """wait for a subprocess (setting its returncode) and return its CPU time
+
+    Args:
+        proc (subprocess.Popen): running subprocess
+
+    Returns:
+        float: user + system CPU seconds
+    """
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def _check_returncodes(procs: list) -> None:
+    """raise an error for the first failed subprocess
+
+    Args:
+        procs (list): completed subprocess.Popen objects
+
+    Raises:
+        subprocess.CalledProcessError: if any subprocess failed
+    """
+    for proc in procs:
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
 #
 # main
 #
@@ -710,18 +4321,46 @@ def main():
     args = parse_arguments()
     LOGGER.info("-- Verify prerequisites --")
     verify_prerequisites()
+    metrics = PipelineMetrics(args.metrics_file)
+    if args.batch is not None:
+        try:
+            _run_batch(args, metrics)
+        finally:
+            metrics.save()
+        LOGGER.info("-- END ANALYSIS --")
+        return
     LOGGER.info("-- Parse sample file --")
-    samples = SampleFile(args.samples)
-    LOGGER.info("-- Create demultiplexed trimmed fastqs --")
-    create_fastqs(samples, args.fastq, args.fastqs_dir)
-    LOGGER.info("-- Align reads --")
-    align_reads(args.reference, args.fastqs_dir, args.bams_dir, reindex=args.reindex)
-    LOGGER.info("-- Create sorted indexed bam files --")
-    sam_to_bam(args.bams_dir, savesam=args.savesam)
-    LOGGER.info("-- Call variants --")
-    variants = call_variants(args.bams_dir, args.reference)
-    LOGGER.info("-- Generate report --")
-    generate_report(variants, samples, args.report)
+    samples = SampleFile(args.samples, max_mismatches=args.barcode_mismatches)
+    manifest = StageManifest(args.manifest)
+    try:
+        LOGGER.info("-- Create demultiplexed trimmed fastqs --")
+        with metrics.stage("demultiplex") as counters:
+            (names, stats) = _demultiplex_stage(args, samples, manifest, counters)
+        if stats is not None:
+            metrics.set(
+                "samples",
+                {name: counts._asdict() for (name, counts) in stats.samples.items()},
+            )
+            metrics.set(
+                "unassigned_barcodes",
+                dict(stats.unassigned.most_common(TOP_UNASSIGNED_BARCODES)),
+            )
+        LOGGER.info("-- Align reads --")
+        with metrics.stage("align") as counters:
+            _align_stage(args, names, manifest, counters, stats)
+        if manifest.enabled or args.vcf or args.tsv:
+            LOGGER.info("-- Call variants --")
+            with metrics.stage("call_variants") as counters:
+                variants = _call_variants_stage(args, names, manifest, counters)
+            LOGGER.info("-- Generate report --")
+            with metrics.stage("report") as counters:
+                _report_stage(args, samples, variants, manifest, counters)
+        else:
+            LOGGER.info("-- Call variants & generate report --")
+            with metrics.stage("call_variants") as counters:
+                _stream_report_stage(args, samples, names, counters)
+    finally:
+        metrics.save()
     LOGGER.info("-- END ANALYSIS --")
 
 
@@ -0,0 +1,10 @@
+#!/bin/bash -xe
+time python3 pipeline.py --batch ../data/batch.txt --batch-dir ../analysis/batch --reindex --force --debug
+WORKINGDIR="$(pwd)"
+for ANALYSIS in tinytest test tiny0vartest tiny2vartest assignment; do
+    cd ../analysis/batch/${ANALYSIS}/fastqs
+    md5sum *.fastq > ../../../md5sum_batch_${ANALYSIS}_fastqs.txt
+    diff ../../../md5sum_batch_${ANALYSIS}_fastqs.txt ../../../md5sum_${ANALYSIS}_fastqs_baseline.txt
+    cd "${WORKINGDIR}"
+    diff ../analysis/batch/${ANALYSIS}/report.txt ../analysis/${ANALYSIS}/report.txt.baseline
+done